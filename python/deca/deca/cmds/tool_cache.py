@@ -0,0 +1,59 @@
+import os
+import sys
+from deca.db_core import VfsDatabase
+from deca.db_cache import format_size
+from deca.util import Logger
+
+
+def cache_stats(vfs: VfsDatabase):
+    stats = vfs.cache.stats()
+    lookups = stats['hits'] + stats['misses']
+    hit_rate = 0.0
+    if lookups > 0:
+        hit_rate = stats['hits'] / lookups * 100.0
+
+    print('Cache Directory: {}'.format(vfs.cache.cache_dir))
+    print('Entries: {}'.format(stats['entries']))
+    print('Size: {} of {}'.format(format_size(stats['size_total']), format_size(stats['max_size'])))
+    print('Hits|Misses|Hit Rate: {}|{}|{:3.1f}%'.format(stats['hits'], stats['misses'], hit_rate))
+    print('Puts: {}'.format(stats['puts']))
+    print('Evictions: {} ({})'.format(stats['evictions'], format_size(stats['evicted_bytes'])))
+
+
+def cache_trim(vfs: VfsDatabase, target_size=None):
+    freed = vfs.cache.trim(target_size)
+    print('Trimmed {}, cache size now {}'.format(format_size(freed), format_size(vfs.cache.size_total())))
+
+
+def cache_verify(vfs: VfsDatabase):
+    bad_entries, orphan_files = vfs.cache.verify()
+    print('Removed {} bad entries and {} orphaned files, cache size now {}'.format(
+        bad_entries, orphan_files, format_size(vfs.cache.size_total())))
+
+
+def main():
+    if len(sys.argv) < 3 or sys.argv[2] not in {'stats', 'trim', 'verify'}:
+        print('USAGE: python -m deca.cmds.tool_cache <PROJECT_FILE, project.json> stats|trim [MAX_BYTES]|verify',
+              file=sys.stderr)
+        exit(1)
+
+    project_file = sys.argv[1]
+    working_dir = os.path.join(os.path.split(project_file)[0], '')
+    vfs = VfsDatabase(project_file, working_dir, Logger(working_dir))
+
+    cmd = sys.argv[2]
+    if cmd == 'stats':
+        cache_stats(vfs)
+    elif cmd == 'trim':
+        target_size = None
+        if len(sys.argv) > 3:
+            target_size = int(sys.argv[3])
+        cache_trim(vfs, target_size)
+    elif cmd == 'verify':
+        cache_verify(vfs)
+
+    vfs.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+import os
+import sys
+from deca.db_processor import VfsProcessor
+from deca.util import Logger
+
+
+def main():
+    if len(sys.argv) < 2:
+        print('USAGE: python -m deca.cmds.tool_crack <PROJECT_FILE, project.json> [BUDGET]', file=sys.stderr)
+        exit(1)
+
+    project_file = sys.argv[1]
+    working_dir = os.path.join(os.path.split(project_file)[0], '')
+
+    vfs = VfsProcessor(project_file, working_dir, Logger(working_dir))
+    if len(sys.argv) > 2:
+        vfs.crack_budget = int(sys.argv[2])
+
+    # name what the hits resolve right away, the next processing run picks up the newly named nodes
+    vfs.find_vpath_crack()
+    vfs.process_vhash_final_all()
+    vfs.shutdown()
+
+
+if __name__ == "__main__":
+    main()
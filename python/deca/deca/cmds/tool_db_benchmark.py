@@ -0,0 +1,420 @@
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import zlib
+import struct
+import numpy as np
+import zstandard as zstd
+from deca.db_processor import VfsProcessor, vfs_structure_prep
+from deca.db_core import VfsDatabase, VfsNode
+from deca.db_cache import DecompressCache
+from deca.db_commands import Processor, LogWrapper, MultiProcessControl
+from deca.ff_types import compression_v4_03_zstd
+from deca.db_types import db_storage_profiles
+from deca.game_info import game_info_load
+from deca.util import Logger
+
+
+def benchmark_profile(project_file, bench_dir, profile):
+    # process the whole project from scratch in its own working directory, so nothing is shared between profiles.
+    #  the cross game db sits next to the working directory and starts as a fresh copy of the project's, the
+    #  journal mode a profile sets is kept in the db files
+    profile_dir = os.path.join(bench_dir, profile, '')
+    shutil.rmtree(profile_dir, ignore_errors=True)
+    working_dir = os.path.join(profile_dir, 'project', '')
+    os.makedirs(working_dir)
+    project_file_bench = os.path.join(working_dir, 'project.json')
+    shutil.copyfile(project_file, project_file_bench)
+
+    cross_game_file = os.path.join(os.path.split(project_file)[0], '..', 'cross_game.db')
+    if os.path.isfile(cross_game_file):
+        src = sqlite3.connect(cross_game_file)
+        dst = sqlite3.connect(os.path.join(profile_dir, 'cross_game.db'))
+        src.backup(dst)
+        dst.close()
+        src.close()
+
+    # inherited by the worker processes
+    os.environ['DECA_DB_STORAGE_PROFILE'] = profile
+
+    t0 = time.time()
+    vfs = vfs_structure_prep(project_file_bench, working_dir, logger=Logger(working_dir))
+    dt = time.time() - t0
+    contention = vfs.db_contention_str()
+    vfs.shutdown()
+
+    return dt, contention
+
+
+def benchmark_nodes_add(project_file, bench_dir, count, batch_size=16 * 1024, blocks_per_node=4):
+    # insert synthetic compressed nodes with blocks in DbWrap sized batches into a scratch database
+    working_dir = os.path.join(bench_dir, 'nodes_add', '')
+    shutil.rmtree(working_dir, ignore_errors=True)
+    os.makedirs(working_dir)
+
+    vfs = VfsDatabase(project_file, working_dir, Logger(working_dir))
+
+    t0 = time.time()
+    for batch_start in range(0, count, batch_size):
+        nodes = []
+        for i in range(batch_start, min(count, batch_start + batch_size)):
+            blocks = [(i * 0x10000 + bi * 0x1000, 0x800, 0x1000) for bi in range(blocks_per_node)]
+            nodes.append(VfsNode(
+                v_hash=i, pid=1, index=i, offset=i * 0x10000, size_c=0x800 * blocks_per_node,
+                size_u=0x1000 * blocks_per_node, compression_type=compression_v4_03_zstd, blocks=blocks))
+        vfs.nodes_add_many(nodes)
+    dt = time.time() - t0
+
+    # the blocks must land on the node they were given with
+    n_bad = vfs.db_query_one(
+        'SELECT COUNT(*) FROM core_node_blocks b JOIN core_nodes n ON b.node_id == n.node_id '
+        'WHERE b.block_offset != n.parent_offset + b.block_index * 4096')[0]
+    n_blocks = vfs.db_query_one('SELECT COUNT(*) FROM core_node_blocks')[0]
+    vfs.shutdown()
+
+    return dt, n_blocks, n_bad
+
+
+def used_depths_by_level(vfs: VfsDatabase):
+    # the level at a time query loop that update_used_depths used before nodes_update_used_depths
+    level = 0
+    keep_going = True
+    while keep_going:
+        keep_going = False
+        child_nodes = vfs.db_query_all(
+            'SELECT node_id, used_at_runtime_depth FROM core_nodes WHERE parent_id IN '
+            '(SELECT node_id FROM core_nodes WHERE used_at_runtime_depth == (?))', [level])
+        level = level + 1
+        updates = [(level, uid) for uid, depth in child_nodes if depth is None or depth > level]
+        if updates:
+            keep_going = True
+            with vfs.db_transaction(dbg='used_depths_by_level'):
+                vfs.db_execute_many('UPDATE core_nodes SET used_at_runtime_depth=(?) WHERE node_id=(?)', updates)
+
+
+def benchmark_used_depths(project_file, bench_dir, depth, fan_out=4, chains=64):
+    # synthetic deep hierarchy: every root gets chains of nested containers, every container a few leaves.
+    #  only the roots are marked as used at runtime, so each node should end at its distance from its root
+    working_dir = os.path.join(bench_dir, 'used_depths', '')
+    shutil.rmtree(working_dir, ignore_errors=True)
+    os.makedirs(working_dir)
+
+    vfs = VfsDatabase(project_file, working_dir, Logger(working_dir))
+
+    rows = []
+    for ci in range(chains):
+        parent = None
+        for level in range(depth):
+            uid = len(rows) + 1
+            rows.append((uid, parent, 0 if level == 0 else None, level))
+            for _ in range(fan_out):
+                rows.append((len(rows) + 1, uid, None, level + 1))
+            parent = uid
+
+    results = []
+    for name, func in [('by_level', used_depths_by_level), ('columnar', VfsDatabase.nodes_update_used_depths)]:
+        with vfs.db_transaction(dbg='benchmark_used_depths'):
+            vfs.db_execute_one('DELETE FROM core_nodes')
+            vfs.db_execute_many(
+                'INSERT INTO core_nodes (node_id, parent_id, used_at_runtime_depth) VALUES (?,?,?)',
+                [r[:3] for r in rows])
+        t0 = time.time()
+        func(vfs)
+        dt = time.time() - t0
+
+        depths = dict(vfs.db_query_all('SELECT node_id, used_at_runtime_depth FROM core_nodes'))
+        n_bad = sum(1 for r in rows if depths[r[0]] != r[3])
+        results.append((name, dt, n_bad))
+
+    vfs.shutdown()
+
+    return len(rows), results
+
+
+def benchmark_content_hash(
+        project_file, bench_dir, count, duplicates=0.1, block_size=64 * 1024, blocks_per_node=4, rounds=2):
+    # synthetic pack of zstd compressed nodes, some stored twice. compares the content hash of every node against the
+    #  fingerprint of every node plus the content hash of the nodes whose fingerprints collide. times are the mean
+    #  over rounds
+    working_dir = os.path.join(bench_dir, 'content_hash', '')
+    shutil.rmtree(working_dir, ignore_errors=True)
+    os.makedirs(working_dir)
+
+    rng = np.random.default_rng(0)
+    compressor = zstd.ZstdCompressor()
+    pack_file = os.path.join(working_dir, 'pack.bin')
+    entries = []
+    offset = 0
+    with open(pack_file, 'wb') as f:
+        for i in range(count):
+            if entries and rng.random() < duplicates:
+                entries.append(entries[rng.integers(len(entries))])
+                continue
+            blocks = []
+            for bi in range(blocks_per_node):
+                buffer = compressor.compress(rng.integers(0, 16, block_size, dtype=np.uint8).tobytes())
+                f.write(buffer)
+                blocks.append((offset, len(buffer), block_size))
+                offset += len(buffer)
+            entries.append(blocks)
+
+    vfs = VfsDatabase(project_file, working_dir, Logger(working_dir))
+    root = VfsNode(p_path=pack_file, offset=0, size_c=offset, size_u=offset)
+    vfs.nodes_add_many([root])
+    nodes = []
+    for i, blocks in enumerate(entries):
+        nodes.append(VfsNode(
+            v_hash=i, pid=root.uid, index=i, offset=blocks[0][0], size_c=sum(b[1] for b in blocks),
+            size_u=sum(b[2] for b in blocks), compression_type=compression_v4_03_zstd, blocks=blocks))
+    vfs.nodes_add_many(nodes)
+
+    def cold(name):
+        # every pass starts with an empty decompression cache and, where the os allows it, without the pack in the
+        #  page cache, so no pass reads what an earlier one decompressed or loaded
+        vfs.cache = DecompressCache(os.path.join(working_dir, 'cache_{}'.format(name)), None, vfs.logger)
+        # mapped pages stay resident, unmap the pack before asking the os to drop it
+        vfs.mmap_close_all()
+        if hasattr(os, 'posix_fadvise'):
+            fd = os.open(pack_file, os.O_RDONLY)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            os.close(fd)
+
+    def tiered():
+        fingerprints = [vfs.node_fingerprint(node) for node in nodes]
+        fingerprint_count = {}
+        for fp in fingerprints:
+            fingerprint_count[fp] = fingerprint_count.get(fp, 0) + 1
+        collisions = [node for node, fp in zip(nodes, fingerprints) if fingerprint_count[fp] > 1]
+        for node in collisions:
+            vfs.node_content_hash_compute(node)
+        return fingerprints, collisions
+
+    def full():
+        return [vfs.node_content_hash_compute(node) for node in nodes]
+
+    # both orders, so neither pass always runs first
+    dt_tiered = 0.0
+    dt_full = 0.0
+    for i in range(rounds):
+        for name in (['tiered', 'full'] if i % 2 == 0 else ['full', 'tiered']):
+            cold('{}_{}'.format(name, i))
+            t0 = time.time()
+            if name == 'tiered':
+                fingerprints, collisions = tiered()
+                dt_tiered += (time.time() - t0) / rounds
+            else:
+                content_hashes = full()
+                dt_full += (time.time() - t0) / rounds
+
+    # equal fingerprints have to mean equal contents, and with one compressor equal contents mean equal fingerprints
+    n_bad = len(set(zip(fingerprints, content_hashes))) - len(set(content_hashes))
+    n_bad += len(set(fingerprints)) - len(set(content_hashes))
+    vfs.shutdown()
+
+    return offset, len(collisions), dt_full, dt_tiered, n_bad
+
+
+def benchmark_locality(project_file, bench_dir, count, cmd='process_hash_file_contents'):
+    # reads nodes of an already processed project in cost order and in locality order. each order gets its own
+    #  random half of the sample, so neither reads what the other left in the page cache. the database is copied, the
+    #  game files are read in place
+    working_dir_src = os.path.join(os.path.split(project_file)[0], '')
+    working_dir = os.path.join(bench_dir, 'locality', '')
+    shutil.rmtree(working_dir, ignore_errors=True)
+    shutil.copytree(os.path.join(working_dir_src, 'db'), os.path.join(working_dir, 'db'))
+    project_file_bench = os.path.join(working_dir, 'project.json')
+    shutil.copyfile(project_file, project_file_bench)
+
+    vfs = VfsDatabase(project_file_bench, working_dir, Logger(working_dir), use_node_index=True)
+    uids = [r[0] for r in vfs.db_query_all(
+        'SELECT node_id FROM core_nodes WHERE parent_id IS NOT NULL AND parent_offset IS NOT NULL '
+        'ORDER BY RANDOM() LIMIT (?)', [2 * count])]
+    vfs.db_execute_one('UPDATE core_nodes SET content_hash=NULL')
+    vfs.db_commit()
+
+    commander = MultiProcessControl(project_file_bench, working_dir, Logger(working_dir), persistent=True)
+    results = []
+    try:
+        # the first command pays for starting the workers
+        commander.do_map(cmd, uids[:1])
+        for name, sample in [('cost', uids[1::2]), ('locality', uids[2::2])]:
+            costs = vfs.nodes_select_cost_hint(sample)
+            locality = vfs.nodes_select_locality_hint(sample) if name == 'locality' else None
+            t0 = time.time()
+            commander.do_map(cmd, sample, costs=costs, locality=locality)
+            results.append((name, len(sample), time.time() - t0))
+    finally:
+        commander.stop()
+    vfs.shutdown()
+
+    return results
+
+
+def aaf_pack(payload):
+    # single section AAF around payload
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+    buffer = compressor.compress(payload) + compressor.flush()
+    section = struct.pack('<III', len(buffer), len(payload), len(buffer) + 16) + b'EWAM' + buffer
+    return b'AAF\0' + struct.pack('<I', 1) + b'\0' * 28 + struct.pack('<III', len(payload), len(payload), 1) + section
+
+
+def benchmark_content_reuse(project_file, bench_dir, copies=2):
+    # the same contents stored raw and zstd compressed, which only share the content hash, next to an AAF that
+    #  detection switches to v3 zlib. file type detection runs once with content reuse and once on every node alone,
+    #  each node has to end up the same in both runs and read back the same contents
+    cmd = 'process_file_type_find_no_name'
+    payload = b'{"0": ["a/b.bin"]}' * 64
+    compressor = zstd.ZstdCompressor()
+    stored = [(aaf_pack(payload), None)] * copies
+    stored += [(payload, None)] * copies
+    stored += [(compressor.compress(payload), len(payload))] * copies
+
+    results = []
+    reuse_count = 0
+    for name in ['reuse', 'alone']:
+        working_dir = os.path.join(bench_dir, 'content_reuse', name, '')
+        shutil.rmtree(working_dir, ignore_errors=True)
+        os.makedirs(working_dir)
+
+        pack_file = os.path.join(working_dir, 'pack.bin')
+        with open(pack_file, 'wb') as f:
+            f.write(b''.join([buffer for buffer, _ in stored]))
+
+        vfs = VfsProcessor(project_file, working_dir, Logger(working_dir))
+        size = sum([len(buffer) for buffer, _ in stored])
+        root = VfsNode(p_path=pack_file, offset=0, size_c=size, size_u=size)
+        vfs.nodes_add_many([root])
+        nodes = []
+        offset = 0
+        for i, (buffer, size_u) in enumerate(stored):
+            if size_u is None:
+                node = VfsNode(
+                    v_hash=i, pid=root.uid, index=i, offset=offset, size_c=len(buffer), size_u=len(buffer))
+            else:
+                node = VfsNode(
+                    v_hash=i, pid=root.uid, index=i, offset=offset, size_c=len(buffer), size_u=size_u,
+                    compression_type=compression_v4_03_zstd, blocks=[(offset, len(buffer), size_u)])
+            nodes.append(node)
+            offset += len(buffer)
+        vfs.nodes_add_many(nodes)
+        uids = [node.uid for node in nodes]
+
+        if name == 'reuse':
+            vfs.process_time_start = vfs.process_time_last = time.time()
+            vfs.process_no_content_hash(None, 'process_hash_file_contents')
+            vfs.nodes_do_map(cmd, uids, step_id='content_reuse')
+            reuse_count = vfs.reuse_count
+        else:
+            processor = Processor(vfs, LogWrapper(vfs.logger))
+            for uid in uids:
+                processor.process_command(cmd, [[uid]])
+
+        rows = []
+        for uid in uids:
+            row = vfs.db_query_one(
+                'SELECT flags, file_type, file_sub_type, magic, size_u FROM core_nodes WHERE node_id=(?)', [uid])
+            with vfs.file_obj_from(vfs.node_where_uid(uid)) as f:
+                rows.append((row, f.read()))
+        vfs.shutdown()
+        results.append(rows)
+
+    n_bad = len([1 for a, b in zip(*results) if a != b])
+    return len(stored), reuse_count, n_bad
+
+
+def main():
+    cmds = {'process', 'nodes_add', 'used_depths', 'content_hash', 'content_reuse', 'locality'}
+    if len(sys.argv) < 3 or sys.argv[2] not in cmds:
+        print('USAGE: python -m deca.cmds.tool_db_benchmark <PROJECT_FILE, project.json> process [PROFILE ...]',
+              file=sys.stderr)
+        print('       python -m deca.cmds.tool_db_benchmark <PROJECT_FILE, project.json> nodes_add [COUNT]',
+              file=sys.stderr)
+        print('       python -m deca.cmds.tool_db_benchmark <PROJECT_FILE, project.json> used_depths [DEPTH]',
+              file=sys.stderr)
+        print('       python -m deca.cmds.tool_db_benchmark <PROJECT_FILE, project.json> content_hash [COUNT]',
+              file=sys.stderr)
+        print('       python -m deca.cmds.tool_db_benchmark <PROJECT_FILE, project.json> content_reuse',
+              file=sys.stderr)
+        print('       python -m deca.cmds.tool_db_benchmark <PROJECT_FILE, project.json> locality [COUNT]',
+              file=sys.stderr)
+        print('  PROFILES: {}'.format(', '.join(db_storage_profiles.keys())), file=sys.stderr)
+        exit(1)
+
+    project_file = sys.argv[1]
+    cmd = sys.argv[2]
+    bench_dir = os.path.join(os.path.split(project_file)[0], '__BENCH__')
+
+    if cmd == 'nodes_add':
+        count = 1000000
+        if len(sys.argv) > 3:
+            count = int(sys.argv[3])
+        dt, n_blocks, n_bad = benchmark_nodes_add(project_file, bench_dir, count)
+        print('nodes_add: {} nodes, {} blocks in {:0.1f}s, {:0.0f} nodes/s, {} misplaced blocks'.format(
+            count, n_blocks, dt, count / dt, n_bad))
+        return
+
+    if cmd == 'used_depths':
+        depth = 256
+        if len(sys.argv) > 3:
+            depth = int(sys.argv[3])
+        count, results = benchmark_used_depths(project_file, bench_dir, depth)
+        for name, dt, n_bad in results:
+            print('used_depths: {:>8}: {} nodes, depth {} in {:0.2f}s, {} wrong depths'.format(
+                name, count, depth, dt, n_bad))
+        print('columnar vs by_level: {:0.2f}x'.format(results[0][1] / results[1][1]))
+        return
+
+    if cmd == 'content_hash':
+        count = 1000
+        if len(sys.argv) > 3:
+            count = int(sys.argv[3])
+        size_c, n_collisions, dt_full, dt_tiered, n_bad = benchmark_content_hash(project_file, bench_dir, count)
+        print('content_hash: {} nodes, {:0.1f} MiB stored'.format(count, size_c / 1024 / 1024))
+        print('content_hash:     full: {:0.2f}s'.format(dt_full))
+        print('content_hash:   tiered: {:0.2f}s, {} nodes with colliding fingerprints'.format(dt_tiered, n_collisions))
+        print('tiered vs full: {:0.2f}x, {} fingerprint mismatches'.format(dt_full / dt_tiered, n_bad))
+        return
+
+    if cmd == 'locality':
+        count = 20000
+        if len(sys.argv) > 3:
+            count = int(sys.argv[3])
+        results = benchmark_locality(project_file, bench_dir, count)
+        for name, n, dt in results:
+            print('locality: {:>8} order: {} nodes in {:0.2f}s, {:0.0f} nodes/s'.format(name, n, dt, n / dt))
+        print('locality vs cost: {:0.2f}x'.format(results[0][2] / results[1][2]))
+        return
+
+    if cmd == 'content_reuse':
+        count, reuse_count, n_bad = benchmark_content_reuse(project_file, bench_dir)
+        print('content_reuse: {} nodes, {} took results by reuse, {} differ from processing alone'.format(
+            count, reuse_count, n_bad))
+        return
+
+    profiles = sys.argv[3:]
+    if not profiles:
+        profiles = ['compat', 'bulk']
+
+    game_info = game_info_load(project_file)
+    if game_info.cache_dir is not None:
+        print('WARNING: project sets cache_dir, later runs will reuse decompressed data from earlier ones')
+
+    results = []
+    for profile in profiles:
+        dt, contention = benchmark_profile(project_file, bench_dir, profile)
+        results.append((profile, dt, contention))
+
+    for profile, dt, contention in results:
+        print('{:>8}: {:10.1f}s'.format(profile, dt))
+        print('          {}'.format(contention))
+
+    if len(results) > 1:
+        base = results[0][1]
+        for profile, dt, _ in results[1:]:
+            print('{} vs {}: {:0.2f}x'.format(profile, results[0][0], base / dt))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import os
+import sys
+from deca.db_core import VfsDatabase
+from deca.db_processor import vfs_structure_open
+from deca.util import Logger
+
+
+def process_status(vfs: VfsDatabase):
+    print('Version: {}'.format(vfs.db_query_one('PRAGMA user_version')[0]))
+
+    for name, value in vfs.process_checkpoints_select():
+        print('Checkpoint: {} = {}'.format(name, value))
+
+    for chunk_id, cmd, uids in vfs.process_chunks_select():
+        print('In flight: chunk {}: {} with {} nodes'.format(chunk_id, cmd, len(uids)))
+
+    strikes = vfs.node_strikes_select()
+    for uid, (n_strikes, reason) in sorted(strikes.items()):
+        node = vfs.node_where_uid(uid)
+        print('Strikes: {}: {} {} ({})'.format(n_strikes, uid, node.v_path or node.p_path, reason))
+
+
+def main():
+    if len(sys.argv) < 3 or sys.argv[2] not in {'status', 'resume', 'unquarantine'}:
+        print('USAGE: python -m deca.cmds.tool_process <PROJECT_FILE, project.json> status|resume|unquarantine [UID ...]',
+              file=sys.stderr)
+        exit(1)
+
+    project_file = sys.argv[1]
+    working_dir = os.path.join(os.path.split(project_file)[0], '')
+    cmd = sys.argv[2]
+
+    if cmd == 'resume':
+        # processing picks up from the last checkpoint and the per node processed flags
+        vfs = vfs_structure_open(project_file)
+        process_status(vfs)
+    else:
+        vfs = VfsDatabase(project_file, working_dir, Logger(working_dir))
+        if cmd == 'status':
+            process_status(vfs)
+        elif cmd == 'unquarantine':
+            uids = None
+            if len(sys.argv) > 3:
+                uids = [int(v) for v in sys.argv[3:]]
+            vfs.node_strikes_clear(uids)
+
+    vfs.shutdown()
+
+
+if __name__ == "__main__":
+    main()
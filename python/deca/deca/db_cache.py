@@ -0,0 +1,264 @@
+import os
+import re
+import time
+import shutil
+import hashlib
+from deca.db_types import DbBase
+from deca.util import make_dir_for_file
+
+
+cache_stat_names = ['hits', 'misses', 'puts', 'evictions', 'evicted_bytes', 'size_total']
+
+
+re_cache_bucket = re.compile(r'^[0-9a-f]{2}$')
+
+
+def format_size(v):
+    if v is None:
+        return 'unbounded'
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if abs(v) < 1024:
+            return f'{v:.1f} {unit}'
+        v = v / 1024
+    return f'{v:.1f} TiB'
+
+
+# Size bounded cache of decompressed node payloads. Payloads are keyed by the physical archive, the offsets down to
+#  the node and the compression parameters, not by the node's place in the vfs tree. The index (size, last access) is
+#  kept in a small sqlite db next to the payloads, least recently used entries are evicted when over budget.
+class DecompressCache(DbBase):
+    def __init__(self, cache_dir, max_size, logger, flush_interval=256, trim_ratio=0.9):
+        super().__init__(os.path.join(cache_dir, 'cache.db'), logger)
+
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.trim_ratio = trim_ratio
+
+        self._touched = {}
+        self._put = {}
+        self._stats = dict([(k, 0) for k in cache_stat_names])
+        self._ops_since_flush = 0
+
+        self.db_execute_one(
+            '''
+            CREATE TABLE IF NOT EXISTS "cache_entries" (
+                "key" TEXT NOT NULL,
+                "size" INTEGER NOT NULL,
+                "last_access" REAL NOT NULL,
+                PRIMARY KEY ("key")
+            );
+            '''
+        )
+        self.db_execute_one(
+            'CREATE INDEX IF NOT EXISTS "cache_entries_last_access_asc" ON "cache_entries" ("last_access" ASC);')
+        self.db_execute_one(
+            '''
+            CREATE TABLE IF NOT EXISTS "cache_stats" (
+                "name" TEXT NOT NULL,
+                "value" INTEGER NOT NULL,
+                PRIMARY KEY ("name")
+            );
+            '''
+        )
+        self.db_execute_many(
+            'INSERT OR IGNORE INTO cache_stats VALUES (?,0)', [(k,) for k in cache_stat_names])
+        self.db_commit()
+
+    @staticmethod
+    def key_make(*parts):
+        key = '|'.join(['{}'.format(p) for p in parts])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def file_name(self, key):
+        return os.path.join(self.cache_dir, key[0:2], key + '.dat')
+
+    def get(self, key):
+        file_name = self.file_name(key)
+        if os.path.isfile(file_name):
+            self._stats['hits'] += 1
+            self._touched[key] = time.time()
+            self._op_done()
+            return file_name
+
+        self._stats['misses'] += 1
+        self._op_done()
+        return None
+
+    def put(self, key, buffer):
+        file_name = self.file_name(key)
+        make_dir_for_file(file_name)
+
+        # write to a temporary name first so concurrent readers never see a partial file
+        file_name_tmp = '{}.{}.tmp'.format(file_name, os.getpid())
+        with open(file_name_tmp, 'wb') as f:
+            f.write(buffer)
+        os.replace(file_name_tmp, file_name)
+
+        # the index entry waits for the next flush, so workers do not take the write lock for every payload
+        self._put[key] = (len(buffer), time.time())
+        self._op_done()
+
+        return file_name
+
+    def _op_done(self):
+        self._ops_since_flush += 1
+        if self._ops_since_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._ops_since_flush = 0
+
+        if self._put:
+            for key, (size, last_access) in self._put.items():
+                self.db_execute_one(
+                    'INSERT OR IGNORE INTO cache_entries VALUES (?,?,?)', [key, size, last_access],
+                    dbg='cache_flush:put')
+                if self.db_cur.rowcount == 1:
+                    self._stats['puts'] += 1
+                    self._stats['size_total'] += size
+            self._put = {}
+
+        if self._touched:
+            self.db_execute_many(
+                'UPDATE cache_entries SET last_access=(?) WHERE key=(?)',
+                [(v, k) for k, v in self._touched.items()],
+                dbg='cache_flush:touched')
+            self._touched = {}
+
+        stats = [(v, k) for k, v in self._stats.items() if v != 0]
+        if stats:
+            self.db_execute_many(
+                'UPDATE cache_stats SET value=value+(?) WHERE name=(?)', stats, dbg='cache_flush:stats')
+            self._stats = dict([(k, 0) for k in cache_stat_names])
+
+        self.db_commit()
+
+        if self.max_size is not None and self.size_total() > self.max_size:
+            self.trim()
+
+    def size_total(self):
+        return self.db_query_one(
+            "SELECT value FROM cache_stats WHERE name='size_total'", dbg='cache_size_total')[0]
+
+    def size_total_update(self):
+        self.db_execute_one(
+            "UPDATE cache_stats SET value=(SELECT COALESCE(SUM(size), 0) FROM cache_entries) WHERE name='size_total'",
+            dbg='cache_size_total_update')
+
+    def stats(self):
+        self.flush()
+        result = dict(self.db_query_all('SELECT name, value FROM cache_stats', dbg='cache_stats'))
+        result['entries'] = self.db_query_one('SELECT COUNT(*) FROM cache_entries', dbg='cache_stats:count')[0]
+        result['max_size'] = self.max_size
+        return result
+
+    def entry_remove(self, key):
+        try:
+            os.remove(self.file_name(key))
+        except FileNotFoundError:
+            pass
+        except OSError:
+            # file is in use (windows), it will be picked up by a later trim
+            return False
+        return True
+
+    def trim(self, target_size=None):
+        if target_size is None:
+            if self.max_size is None:
+                return 0
+            target_size = int(self.max_size * self.trim_ratio)
+
+        size_total = self.size_total()
+        freed = 0
+        evicted = []
+        examined = 0
+        batch_size = 1024
+        while size_total - freed > target_size:
+            rows = self.db_query_all(
+                'SELECT key, size FROM cache_entries ORDER BY last_access ASC LIMIT (?) OFFSET (?)',
+                [batch_size, examined], dbg='cache_trim:select')
+            if not rows:
+                break
+
+            for key, size in rows:
+                examined += 1
+                if size_total - freed <= target_size:
+                    break
+                if self.entry_remove(key):
+                    evicted.append((key, size))
+                    freed += size
+
+        if evicted:
+            self.db_execute_many(
+                'DELETE FROM cache_entries WHERE key=(?)', [(k,) for k, _ in evicted], dbg='cache_trim:delete')
+            self.db_execute_many(
+                'UPDATE cache_stats SET value=value+(?) WHERE name=(?)',
+                [(len(evicted), 'evictions'), (freed, 'evicted_bytes')],
+                dbg='cache_trim:stats')
+            # another process may have trimmed the same entries, so recount instead of subtracting
+            self.size_total_update()
+            self.db_commit()
+
+            self.logger.log('CACHE: Evicted {} entries, {}'.format(len(evicted), format_size(freed)))
+
+        return freed
+
+    def legacy_remove(self):
+        # before the index the payloads lived in a tree named after the parent archives, nothing reads it anymore.
+        #  anything in the cache dir that is not the index or a key bucket belongs to that tree
+        removed = 0
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if os.path.isdir(path):
+                if re_cache_bucket.match(name):
+                    continue
+                shutil.rmtree(path, ignore_errors=True)
+            elif name.endswith('.dat'):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            else:
+                continue
+            removed += 1
+
+        if removed:
+            self.logger.log('CACHE: Removed {} entries of the old cache layout'.format(removed))
+        return removed
+
+    def verify(self):
+        self.flush()
+
+        # entries in the index that are missing on disk or have the wrong size
+        bad_keys = []
+        for key, size in self.db_query_all('SELECT key, size FROM cache_entries', dbg='cache_verify:select'):
+            file_name = self.file_name(key)
+            if not os.path.isfile(file_name) or os.stat(file_name).st_size != size:
+                bad_keys.append(key)
+                self.entry_remove(key)
+
+        if bad_keys:
+            self.db_execute_many(
+                'DELETE FROM cache_entries WHERE key=(?)', [(k,) for k in bad_keys], dbg='cache_verify:delete')
+
+        # files on disk that are not in the index
+        known_keys = set([r[0] for r in self.db_query_all('SELECT key FROM cache_entries', dbg='cache_verify:keys')])
+        orphans = 0
+        for sub_dir in os.listdir(self.cache_dir):
+            sub_path = os.path.join(self.cache_dir, sub_dir)
+            if len(sub_dir) != 2 or not os.path.isdir(sub_path):
+                continue
+            for fn in os.listdir(sub_path):
+                key, ext = os.path.splitext(fn)
+                if ext == '.tmp' or key not in known_keys:
+                    try:
+                        os.remove(os.path.join(sub_path, fn))
+                        orphans += 1
+                    except OSError:
+                        pass
+
+        self.size_total_update()
+        self.db_commit()
+
+        return len(bad_keys), orphans
@@ -4,13 +4,13 @@ import queue
 import time
 import sys
 import traceback
-import hashlib
+import threading
 import numpy as np
 from typing import List, Optional, Callable
 
 from .file import ArchiveFile
 from .db_core import VfsDatabase, VfsNode, language_codes, node_flag_v_hash_type_4, node_flag_v_hash_type_8
-from .db_wrap import DbWrap, determine_file_type, determine_file_type_by_name
+from .db_wrap import DbWrap, DbBatch, determine_file_type, determine_file_type_by_name
 from .db_types import *
 from .ff_types import *
 from .errors import *
@@ -105,35 +105,244 @@ class LogWrapper:
     def trace(self, msg):
         self._logger.trace(msg)
 
+    def error(self, msg):
+        self._logger.error(msg)
+
     def status(self, i, n):
         self._logger.log(f'STATUS: {i} of {n}')
 
+    def node_failed(self, uid, msg):
+        self._logger.error(f'NODE FAILED {uid}: {msg}')
+
     def exception(self, exc):
         self._logger.error(f'EXCEPTION {exc}')
 
 
+class DbBatchWriter(threading.Thread):
+    # the only writer of the shared database while workers run. batches arrive from the manager loop, whatever has
+    #  queued up while the last transaction ran is merged and applied in one transaction
+    def __init__(self, project_file, working_dir, logger, max_items=64 * 1024):
+        super().__init__(name='DbBatchWriter', daemon=True)
+        self.project_file = project_file
+        self.working_dir = working_dir
+        self.logger = logger
+        self.max_items = max_items
+        self.q_batches = queue.Queue()
+        self.exception_list = []
+        # held while the thread is inside sqlite, workers are only forked while it is free
+        self.db_lock = threading.Lock()
+        self.stats = {'batches': 0, 'items': 0, 'transactions': 0, 'busy': 0.0, 'proposed': 0, 'strings': 0}
+
+    def put(self, batch: DbBatch):
+        self.q_batches.put(batch)
+
+    def drain(self):
+        self.q_batches.join()
+
+    def stop(self):
+        self.q_batches.put(None)
+        self.join()
+
+    def stats_take(self):
+        stats = self.stats
+        self.stats = {'batches': 0, 'items': 0, 'transactions': 0, 'busy': 0.0, 'proposed': 0, 'strings': 0}
+        return 'writer: {batches} batches, {items} items, {transactions} transactions, busy {busy:0.1f}s, ' \
+               'strings: {proposed} proposed, {strings} kept, {dedup:0.1f}x dedup'.format(
+                dedup=stats['proposed'] / max(1, stats['strings']), **stats)
+
+    def run(self):
+        with self.db_lock:
+            vfs = VfsDatabase(self.project_file, self.working_dir, self.logger)
+        keep_running = True
+        while keep_running:
+            batches = [self.q_batches.get()]
+            n_items = 0 if batches[0] is None else batches[0].size()
+            while batches[-1] is not None and n_items < self.max_items:
+                try:
+                    batches.append(self.q_batches.get_nowait())
+                except queue.Empty:
+                    break
+                if batches[-1] is not None:
+                    n_items += batches[-1].size()
+
+            if batches[-1] is None:
+                keep_running = False
+
+            merged = DbBatch()
+            n_batches = 0
+            for batch in batches:
+                if batch is not None:
+                    merged.extend(batch)
+                    n_batches += 1
+
+            if merged.size() > 0 and not self.exception_list:
+                t0 = time.time()
+                try:
+                    with self.db_lock, vfs.db_transaction(dbg='DbBatchWriter'):
+                        merged.apply(vfs)
+                except:
+                    ei = sys.exc_info()
+                    self.exception_list.append([ei[0], ei[1], traceback.format_tb(ei[2])])
+                    self.logger.error('DbBatchWriter: EXCEPTION: {}'.format(self.exception_list[-1]))
+                self.stats['batches'] += n_batches
+                self.stats['items'] += merged.size()
+                self.stats['proposed'] += merged.strings_proposed
+                self.stats['strings'] += len(merged.string_hash_to_add)
+                self.stats['transactions'] += 1
+                self.stats['busy'] += time.time() - t0
+
+            for _ in batches:
+                self.q_batches.task_done()
+
+        with self.db_lock:
+            vfs.shutdown()
+
+
 class MultiProcessControl:
-    def __init__(self, project_file, working_dir, logger):
+    def __init__(self, project_file, working_dir, logger, persistent=False):
         self.project_file = project_file
         self.working_dir = working_dir
         self.logger = logger
         self.progress_update_time_sec = 5.0
+        self.idle_call_time_sec = 1.0
+
+        # a persistent pool is started by the first command and kept, with its db connections, type maps and
+        #  compiled code, until stop()
+        self.persistent = persistent
+        self.mp_processes = None
+        self.mp_q_results = None
+        self.processes_available = set()
+        self.writer = None
 
         # assuming hyper-threading exists and slows down processing
         # self.mp_n_processes = 1
         # self.mp_n_processes = max(1, 2 * multiprocessing.cpu_count() // 4)
         self.mp_n_processes = max(1, 3 * multiprocessing.cpu_count() // 4)
 
-    def do_map(self, cmd, params, step_id=None, idle_call: Optional[Callable] = None):
+        # do_map scheduling, costs are in bytes (size_u of a node), the overhead is the fixed cost of a parameter
+        self.chunk_factor = 4
+        self.chunk_max_items = 4096
+        self.chunk_cost_overhead = 64 * 1024
+        self.chunk_cost_min = 16 * self.chunk_cost_overhead
+
+    def start(self):
+        if self.mp_processes is not None:
+            return
+
+        self.writer = DbBatchWriter(self.project_file, self.working_dir, self.logger)
+        self.writer.start()
+
+        self.mp_q_results = multiprocessing.Queue()
+        self.mp_processes = {}
+        for i in range(self.mp_n_processes):
+            self.process_start('process_{}'.format(i))
+
+        self.processes_available = set(self.mp_processes.keys())
+
+    def process_start(self, name):
+        self.logger.debug('Process Create: {}'.format(name))
+        q_command = multiprocessing.Queue()
+        p = multiprocessing.Process(
+            target=run_mp_vfs_base, args=(name, self.project_file, self.working_dir, q_command, self.mp_q_results))
+        self.mp_processes[name] = (name, p, q_command)
+
+        self.logger.debug('Process Start: {}'.format(p))
+
+        # a fork while the writer thread is inside sqlite copies the sqlite mutexes it holds into the worker, which
+        #  then hangs on them as soon as it opens its own connection
+        with self.writer.db_lock:
+            p.start()
+
+    def process_replace(self, name):
+        # a worker lost to an isolated chunk is replaced, so the phase continues at full strength
+        self.mp_processes[name][1].join()
+        self.process_start(name)
+        self.processes_available.add(name)
+
+    def stop(self):
+        if self.mp_processes is None:
+            return
+
+        # shutdown processes
+        for k in self.processes_available:
+            v = self.mp_processes[k]
+            v[2].put(('exit', []))
+            self.logger.debug('Manager: Issued Exit to {}'.format(k))
+
+        # join
+        for k, v in self.mp_processes.items():
+            self.logger.debug('Manager: Joining {}'.format(k))
+            v[1].join()
+
+        self.writer.stop()
+        self.writer = None
+
+        self.mp_processes = None
+        self.mp_q_results = None
+        self.processes_available = set()
+
+    def chunks_make(self, params, costs=None, isolate=None, locality=None):
+        # guided self scheduling: most expensive params first, chunk cost shrinks with the remaining work so the
+        #  phase ends on many small chunks that idle processes pick up, instead of one process finishing a big stride
+        n_params = len(params)
+        if costs is None:
+            costs = [0] * n_params
+        costs = [c + self.chunk_cost_overhead for c in costs]
+
+        # params under suspicion run alone and last, so a crash points at one param and takes down no other work
+        isolated = []
+        if isolate:
+            isolated = [[params[i]] for i in range(n_params) if params[i] in isolate]
+
+        order = [i for i in range(n_params) if not isolate or params[i] not in isolate]
+        if locality is None:
+            order.sort(key=lambda i: -costs[i])
+        else:
+            # chunks are cut from runs of params that sit next to each other in the same archive / container, a
+            #  worker reads them front to back and reuses the decoded parent, the chunk sizes still shrink
+            order.sort(key=lambda i: locality[i])
+        cost_remaining = sum([costs[i] for i in order])
+        cost_target = max(self.chunk_cost_min, cost_remaining / (self.chunk_factor * self.mp_n_processes))
+
+        chunks = []
+        chunk_costs = []
+        chunk = []
+        chunk_cost = 0
+        for i in order:
+            chunk.append(params[i])
+            chunk_cost += costs[i]
+            if chunk_cost >= cost_target or len(chunk) >= self.chunk_max_items:
+                chunks.append(chunk)
+                chunk_costs.append(chunk_cost)
+                cost_remaining -= chunk_cost
+                cost_target = max(self.chunk_cost_min, cost_remaining / (self.chunk_factor * self.mp_n_processes))
+                chunk = []
+                chunk_cost = 0
+        if chunk:
+            chunks.append(chunk)
+            chunk_costs.append(chunk_cost)
+
+        if locality is not None:
+            # largest runs first, so the phase still ends on the small ones
+            chunks = [chunks[ci] for ci in sorted(range(len(chunks)), key=lambda ci: -chunk_costs[ci])]
+
+        return chunks + isolated
+
+    def do_map(
+            self, cmd, params, step_id=None, idle_call: Optional[Callable] = None, costs=None, isolate=None,
+            journal=None, locality=None):
         self.logger.log(f'Manager: "{cmd}" with {len(params)} parameters using {self.mp_n_processes} processes')
 
-        indexes = [params[v::self.mp_n_processes] for v in range(0, self.mp_n_processes)]
+        chunks = self.chunks_make(params, costs, isolate, locality)
+        n_isolated = len([p for p in params if p in isolate]) if isolate else 0
 
         command_list = []
-        for ii in indexes:
+        for ii in chunks:
             command_list.append([cmd, [ii]])
 
-        results = self.mp_issue_commands(command_list, step_id=step_id, idle_call=idle_call)
+        results = self.mp_issue_commands(
+            command_list, step_id=step_id, idle_call=idle_call, n_params_total=len(params), journal=journal,
+            isolated=set(range(len(chunks) - n_isolated, len(chunks))))
 
         all_results = []
         for r in results:
@@ -141,14 +350,55 @@ class MultiProcessControl:
 
         return all_results
 
-    def mp_issue_commands(self, command_list: list, step_id=None, idle_call: Optional[Callable] = None):
+    def utilization_report(self, step_id, elapsed, names, proc_busy, proc_chunks, manager_cpu=None):
+        if elapsed <= 0:
+            return
+        busy_total = 0.0
+        lines = []
+        for name in names:
+            busy = proc_busy.get(name, 0.0)
+            busy_total += busy
+            lines.append('{}: busy {:5.1f}% idle {:6.1f}s chunks {}'.format(
+                name, busy / elapsed * 100.0, elapsed - busy, proc_chunks.get(name, 0)))
+        self.logger.log('Manager: Utilization{}: {:5.1f}% over {:0.1f} seconds'.format(
+            step_id, busy_total / (elapsed * len(lines)) * 100.0, elapsed))
+        if manager_cpu is not None:
+            self.logger.log('Manager:   manager cpu {:0.2f}s ({:4.1f}% of one core)'.format(
+                manager_cpu, manager_cpu / elapsed * 100.0))
+        for line in lines:
+            self.logger.log('Manager:   {}'.format(line))
+
+    def mp_issue_commands(
+            self, command_list: list, step_id=None, idle_call: Optional[Callable] = None, n_params_total=None,
+            journal=None, isolated=None):
+        # journal, if given, durably records the chunks in flight and the nodes that failed or took a worker down.
+        #  the commands must be node commands, [cmd, [uids]], and a failed command does not fail the run: its worker
+        #  is replaced and its nodes are retried one per command, isolated. a node that fails isolated (or a command
+        #  in isolated, by index) gets None as its result
+        isolated = set(isolated or [])
         command_todo = [(i, cmd) for i, cmd in enumerate(command_list)]
         command_active = {}
+        command_journal = {}
         command_complete = []
 
         command_results = [None] * len(command_list)
 
         exception_list = []
+        contained = set()  # workers lost to a command, replaced once they are done
+
+        def command_failed(name, command):
+            uids = command[1][1][0]
+            if command[0] in isolated or len(uids) == 1:
+                self.logger.warning('Manager: {} failed on node {}, continuing'.format(name, uids))
+                command_results[command[0]] = [(uid, None) for uid in uids]
+            else:
+                self.logger.warning('Manager: {} failed on a chunk of {}, retrying them one by one'.format(
+                    name, len(uids)))
+                command_results[command[0]] = []
+                for uid in uids:
+                    isolated.add(len(command_results))
+                    command_todo.append((len(command_results), [command[1][0], [[uid]]]))
+                    command_results.append(None)
 
         if step_id is None:
             step_id = ''
@@ -158,6 +408,13 @@ class MultiProcessControl:
         status = {}
         last_update = None
         start_time = time.time()
+        start_cpu = time.process_time()
+
+        # per process busy time and chunk count, for the utilization report
+        command_start = {}
+        proc_busy = {}
+        proc_chunks = {}
+        n_done_complete = 0
 
         local = False
         if local:
@@ -169,23 +426,10 @@ class MultiProcessControl:
 
             return command_results
         else:
-            mp_q_results = multiprocessing.Queue()
-
-            mp_processes = {}
-            for i in range(self.mp_n_processes):
-                name = 'process_{}'.format(i)
-
-                self.logger.debug('Process Create: {}'.format(name))
-                q_command = multiprocessing.Queue()
-                p = multiprocessing.Process(
-                    target=run_mp_vfs_base, args=(name, self.project_file, self.working_dir, q_command, mp_q_results))
-                mp_processes[name] = (name, p, q_command)
-
-                self.logger.debug('Process Start: {}'.format(p))
-
-                p.start()
-
-            processes_available = set(mp_processes.keys())
+            self.start()
+            mp_processes = self.mp_processes
+            mp_q_results = self.mp_q_results
+            processes_available = self.processes_available
 
             while len(processes_available) > 0 and (len(command_todo) + len(command_active)) > 0:
                 if idle_call is not None:
@@ -193,90 +437,142 @@ class MultiProcessControl:
 
                 ctime = time.time()
                 if last_update is None or (last_update + self.progress_update_time_sec) < ctime:
-                    n_done = 0
-                    n_total = 0
-                    for k, v in status.items():
-                        n_done += v[0]
-                        n_total += v[1]
+                    n_done = n_done_complete + sum([v[0] for v in status.values()])
+                    n_total = n_params_total
+                    if n_total is None:
+                        n_total = n_done_complete + sum([v[1] for v in status.values()])
                     if n_total > 0:
                         last_update = ctime
                         self.logger.log('Processing{}: {} of {} done ({:3.1f}%) elapsed {:5.1f} seconds'.format(
                             step_id, n_done, n_total, n_done / n_total * 100.0, ctime - start_time))
 
-                if len(command_active) < self.mp_n_processes and len(command_todo) > 0:
-                    # add commands
-                    available_procs = processes_available - set(command_active.keys())
-                    proc = available_procs.pop()
-                    proc = mp_processes[proc]
+                # hand out work to every idle process before waiting
+                available_procs = processes_available - set(command_active.keys())
+                while len(command_active) < self.mp_n_processes and len(command_todo) > 0 and available_procs:
+                    proc = mp_processes[available_procs.pop()]
                     name = proc[0]
                     q_command: queue.Queue = proc[2]
                     command = command_todo.pop(0)
                     command_active[name] = command
+                    command_start[name] = time.time()
+                    if journal is not None:
+                        command_journal[name] = journal.journal_chunk_begin(command[1][0], command[1][1][0])
                     q_command.put(command[1])
+
+                # sleep until a worker reports, waking up for the next progress line or idle_call
+                timeout = self.progress_update_time_sec
+                if last_update is not None:
+                    timeout = max(0.0, last_update + self.progress_update_time_sec - time.time())
+                if idle_call is not None:
+                    timeout = min(timeout, self.idle_call_time_sec)
+                try:
+                    msg = mp_q_results.get(block=True, timeout=timeout)
+                except queue.Empty:
+                    # a worker that dies without a word (native crash, killed) would otherwise be waited on forever
+                    for name in list(processes_available):
+                        proc = mp_processes[name][1]
+                        if not proc.is_alive():
+                            self.logger.error('Manager: {} DIED, exit code {}'.format(name, proc.exitcode))
+                            processes_available.discard(name)
+                            command_start.pop(name, None)
+                            command = command_active.pop(name, None)
+                            if command is not None and name in command_journal:
+                                journal.journal_chunk_crashed(
+                                    command_journal.pop(name), 'worker died in {}, exit code {}'.format(
+                                        command[1][0], proc.exitcode))
+                            if command is not None and journal is not None:
+                                command_failed(name, command)
+                                self.process_replace(name)
+                            else:
+                                exception_list.append([name, 'died', proc.exitcode])
+                    continue
+
+                proc_name = msg[0]
+                proc_cmd = msg[1]
+                proc_params = msg[2]
+
+                if proc_cmd not in {'trace', 'debug', 'log', 'status', 'db_batch', 'node_failed', 'exception', 'process_done'}:
+                    self.logger.debug('Manager: received msg {}:{}'.format(proc_name, proc_cmd))
+
+                if proc_cmd == 'log':
+                    self.logger.log('{}: {}'.format(proc_name, proc_params[0]))
+                elif proc_cmd == 'debug':
+                    self.logger.debug('{}: {}'.format(proc_name, proc_params[0]))
+                elif proc_cmd == 'trace':
+                    self.logger.trace('{}: {}'.format(proc_name, proc_params[0]))
+                elif proc_cmd == 'error':
+                    self.logger.error('{}: {}'.format(proc_name, proc_params[0]))
+                elif proc_cmd == 'warning':
+                    self.logger.warning('{}: {}'.format(proc_name, proc_params[0]))
+                elif proc_cmd == 'exception':
+                    self.logger.error('{}: EXCEPTION: {}'.format(proc_name, proc_params))
+                    if proc_name in command_active and journal is not None:
+                        contained.add(proc_name)
+                    else:
+                        exception_list.append(proc_params)
+                elif proc_cmd == 'status':
+                    status[proc_name] = proc_params
+                elif proc_cmd == 'db_batch':
+                    self.writer.put(proc_params[0])
+                elif proc_cmd == 'node_failed':
+                    if journal is not None:
+                        journal.journal_node_failed(proc_params[0], proc_params[1])
+                elif proc_cmd == 'cmd_done':
+                    command = command_active.pop(proc_name)
+                    proc_busy[proc_name] = proc_busy.get(proc_name, 0.0) + time.time() - command_start.pop(proc_name)
+                    proc_chunks[proc_name] = proc_chunks.get(proc_name, 0) + 1
+                    if proc_name in command_journal:
+                        journal.journal_chunk_end(command_journal.pop(proc_name))
+                    # workers rate limit status messages, so count the finished chunk by its results
+                    status.pop(proc_name, None)
+                    n_done_complete += len(proc_params[1])
+                    command_complete.append([proc_name, proc_params[0]])
+                    command_results[command[0]] = proc_params[1]
+                    self.logger.debug('Manager: {} completed {} {}'.format(proc_name, proc_params[0], len(proc_params[1])))
+                elif proc_cmd == 'process_done':
+                    self.logger.debug('Manager: {} DONE'.format(proc_name))
+                    command = command_active.pop(proc_name, None)
+                    command_start.pop(proc_name, None)
+                    if proc_name in command_journal:
+                        # the worker raised, the node that failed was reported on its own
+                        journal.journal_chunk_end(command_journal.pop(proc_name))
+                    processes_available.discard(proc_name)
+                    if proc_name in contained:
+                        contained.discard(proc_name)
+                        command_failed(proc_name, command)
+                        self.process_replace(proc_name)
                 else:
-                    try:
-                        msg = mp_q_results.get(block=False, timeout=1)
-                        proc_name = msg[0]
-                        proc_cmd = msg[1]
-                        proc_params = msg[2]
-
-                        if proc_cmd not in {'trace', 'debug', 'log', 'status', 'exception', 'process_done'}:
-                            self.logger.debug('Manager: received msg {}:{}'.format(proc_name, proc_cmd))
-
-                        if proc_cmd == 'log':
-                            self.logger.log('{}: {}'.format(proc_name, proc_params[0]))
-                        elif proc_cmd == 'debug':
-                            self.logger.debug('{}: {}'.format(proc_name, proc_params[0]))
-                        elif proc_cmd == 'trace':
-                            self.logger.trace('{}: {}'.format(proc_name, proc_params[0]))
-                        elif proc_cmd == 'error':
-                            self.logger.error('{}: {}'.format(proc_name, proc_params[0]))
-                        elif proc_cmd == 'warning':
-                            self.logger.warning('{}: {}'.format(proc_name, proc_params[0]))
-                        elif proc_cmd == 'exception':
-                            exception_list.append(proc_params)
-                            self.logger.error('{}: EXCEPTION: {}'.format(proc_name, proc_params))
-                        elif proc_cmd == 'status':
-                            status[proc_name] = proc_params
-                        elif proc_cmd == 'cmd_done':
-                            command = command_active.pop(proc_name)
-                            command_complete.append([proc_name, proc_params[0]])
-                            command_results[command[0]] = proc_params[1]
-                            self.logger.debug('Manager: {} completed {} {}'.format(proc_name, proc_params[0], len(proc_params[1])))
-                        elif proc_cmd == 'process_done':
-                            self.logger.debug('Manager: {} DONE'.format(proc_name))
-                            command_active.pop(proc_name)
-                            processes_available.discard(proc_name)
-                        else:
-                            print(msg)
-                    except queue.Empty:
-                        pass
-
-            # shutdown processes
-            for k in processes_available:
-                v = mp_processes[k]
-                v[2].put(('exit', []))
-                self.logger.debug('Manager: Issued Exit to {}'.format(k))
-
-            # join
-            for k, v in mp_processes.items():
-                self.logger.debug('Manager: Joining {}'.format(k))
-                v[1].join()
+                    print(msg)
+
+            # the phase is done once everything the workers produced is in the database
+            self.writer.drain()
+            exception_list += self.writer.exception_list
+            writer_stats = self.writer.stats_take()
+
+            if exception_list or not self.persistent:
+                self.stop()
 
             if exception_list:
                 raise Exception('Manager: PROCESSING FAILED')
 
+            self.utilization_report(
+                step_id, time.time() - start_time, mp_processes.keys(), proc_busy, proc_chunks,
+                time.process_time() - start_cpu)
+
+            self.logger.log('Manager: {}'.format(writer_stats))
             self.logger.log('Manager: Done')
 
             return command_results
 
 
 class Processor:
-    def __init__(self, vfs: VfsDatabase, comm):
+    def __init__(self, vfs: VfsDatabase, comm, batch_sink=None):
         self._vfs = vfs
         self._comm = comm
+        self._batch_sink = batch_sink
 
         self.commands = {
+            'process_fingerprint_file_contents': lambda idxs: self.loop_over_uid_wrapper(idxs, self.process_fingerprint_file_contents),
             'process_hash_file_contents': lambda idxs: self.loop_over_uid_wrapper(idxs, self.process_hash_file_contents),
             'process_file_type_find_no_name': lambda idxs: self.loop_over_uid_wrapper(idxs, self.process_file_type_find_no_name),
             'process_file_type_find_with_name': lambda idxs: self.loop_over_uid_wrapper(idxs, self.process_file_type_find_with_name),
@@ -297,19 +593,22 @@ class Processor:
             'process_vhash_final': lambda idxs: self.loop_over_vhash_wrapper(idxs, self.process_vhash_final),
         }
 
-        nhf = []
+        nhf = {}
         for prefix in self._vfs.game_info.world_navheightfields:
             for v0 in range(64):
                 for v1 in range(64):
                     fn = prefix + '{:02d}_{:02d}.nhf'.format(v0, v1)
-                    nhf.append((fn, self._vfs.file_hash(fn)))
+                    nhf[fn] = [FTYPE_ADF, FTYPE_ADF_BARE]
 
         self.nav_height_field_possible_names = nhf
+        self.nav_height_field_possible_hashes = self._vfs.file_hash_many(list(nhf.keys()))
 
     def process_command(self, cmd, params):
         command = self.commands.get(cmd, None)
         if command is None:
             raise NotImplementedError(f'Command not implemented: {cmd}')
+        # nodes cached by an earlier chunk may have been changed since by the batch writer or another worker
+        self._vfs.node_cache_sync()
         result = command(*params)
         return result
 
@@ -317,25 +616,21 @@ class Processor:
         n_indexes = len(indexes)
         results: List[Optional[tuple]]
         results = [None] * n_indexes
-        with DbWrap(self._vfs, logger=self._comm, index_offset=n_indexes) as db:
+        with DbWrap(self._vfs, logger=self._comm, index_offset=n_indexes, batch_sink=self._batch_sink) as db:
             for i, index in enumerate(indexes):
                 self._comm.status(i, n_indexes)
                 node = db.db().node_where_uid(index)
                 try:
                     results[i] = (index, func(node, db))
                 except:
-                    cn = node
-                    while cn is not None:
-                        try:
-                            self._comm.error(
-                                f'loop_over_uid_wrapper: failed for: id: {cn.uid}, pid:{cn.pid}, v: {cn.v_path}, p: {cn.p_path}')
-
-                            if cn.pid is None:
-                                break
-
-                            cn = db.db().node_where_uid(cn.pid)
-                        except:
-                            cn = None
+                    self._comm.node_failed(index, '{}: {}'.format(sys.exc_info()[0].__name__, sys.exc_info()[1]))
+                    try:
+                        chain = (node,) + db.db().node_ancestors(node.uid)
+                    except:
+                        chain = (node,)
+                    for cn in chain:
+                        self._comm.error(
+                            f'loop_over_uid_wrapper: failed for: id: {cn.uid}, pid:{cn.pid}, v: {cn.v_path}, p: {cn.p_path}')
                     raise
             self._comm.status(n_indexes, n_indexes)
 
@@ -345,7 +640,7 @@ class Processor:
         n_indexes = len(vhashes)
         results: List[Optional[tuple]]
         results = [None] * n_indexes
-        with DbWrap(self._vfs, logger=self._comm, index_offset=n_indexes) as db:
+        with DbWrap(self._vfs, logger=self._comm, index_offset=n_indexes, batch_sink=self._batch_sink) as db:
             for i, v_hash in enumerate(vhashes):
                 self._comm.status(i, n_indexes)
                 results[i] = (v_hash, func(v_hash, db))
@@ -353,20 +648,22 @@ class Processor:
 
         return results
 
-    def process_hash_file_contents(self, node: VfsNode, db: DbWrap):
+    def process_fingerprint_file_contents(self, node: VfsNode, db: DbWrap):
         try:
             if node.offset is not None and (node.size_u is not None or node.size_c is not None):
-                h = hashlib.sha1()
-                with db.db().file_obj_from(node) as f:
-                    while True:
-                        buf = f.read(1024*10124)
-                        if buf is None or len(buf) == 0:
-                            break
-
-                        h.update(buf)
-                v = h.hexdigest()
+                db.node_fingerprint_set(node, db.db().node_fingerprint(node))
+                return True
+            else:
+                return False
+        except EDecaUnknownCompressionType as ae:
+            self._comm.log('DBCmd: Unknown Compression Type {} in {} {} {}'.format(
+                ae.type_id, node.v_hash_to_str(), node.v_path, node.p_path))
+        return False
 
-                node.content_hash = v
+    def process_hash_file_contents(self, node: VfsNode, db: DbWrap):
+        try:
+            if node.offset is not None and (node.size_u is not None or node.size_c is not None):
+                node.content_hash = db.db().node_content_hash_compute(node)
                 db.node_update(node)
 
                 return True
@@ -664,9 +961,6 @@ class Processor:
                             obj0['PatchLod'], obj0['PatchPositionX'], obj0['PatchPositionZ'])
                         fns.append(fn)
 
-                if adf.table_instance[0].name == b'NavHeightfield':
-                    fns = fns + self.nav_height_field_possible_names
-
                 # self name environc files
                 if adf.table_instance[0].name == b'environ':
                     fn = 'environment/weather/{}.environc'.format(obj0['Name'].decode('utf-8'))
@@ -676,22 +970,20 @@ class Processor:
                     fn = 'environment/{}.environc'.format(obj0['Name'].decode('utf-8'))
                     fns.append(fn)
 
-                found_any = False
-                for fne in fns:
-                    if isinstance(fne, str):
-                        fn = fne
-                        fnh = self._vfs.file_hash(fn)
-                    else:
-                        fn = fne[0]
-                        fnh = fne[1]
+                self_hashes = [] if node.v_hash is None else [node.v_hash]
+                found = db.propose_candidates(
+                    {fn: [FTYPE_ADF, FTYPE_ADF_BARE] for fn in fns}, self_hashes, node)
 
-                    if node.v_hash == fnh:
-                        if node.v_path is None:
-                            node.v_path = fn
-                        db.propose_string(fn, node, possible_file_types=[FTYPE_ADF, FTYPE_ADF_BARE])
-                        found_any = True
+                if adf.table_instance[0].name == b'NavHeightfield':
+                    fns = fns + list(self.nav_height_field_possible_names.keys())
+                    found += db.propose_candidates(
+                        self.nav_height_field_possible_names, self_hashes, node,
+                        hashes=self.nav_height_field_possible_hashes)
+
+                if len(found) > 0 and node.v_path is None:
+                    node.v_path = found[0]
 
-                if len(fns) > 0 and not found_any:
+                if len(fns) > 0 and len(found) == 0:
                     self._comm.log('COULD NOT MATCH GENERATED FILE NAME {} {}'.format(node.v_hash_to_str(), fns[0]))
 
             # generate dialog and animation file names from intents table.
@@ -979,10 +1271,12 @@ class Processor:
 
 
 class MultiProcessVfsBase:
-    def __init__(self, name, q_in: multiprocessing.Queue, q_out: multiprocessing.Queue):
+    def __init__(self, name, q_in: multiprocessing.Queue, q_out: multiprocessing.Queue, status_interval_sec=0.5):
         self.name = name
         self.q_in = q_in
         self.q_out = q_out
+        self.status_interval_sec = status_interval_sec
+        self.status_last = 0.0
 
     def send(self, cmd, *params):
         self.q_out.put((self.name, cmd, params, ))
@@ -993,12 +1287,25 @@ class MultiProcessVfsBase:
     def trace(self, msg):
         self.send('debug', msg)
 
+    def error(self, msg):
+        self.send('error', msg)
+
     def status(self, i, n):
-        self.send('status', i, n)
+        # per node calls, only the latest is forwarded at a fixed rate. the manager counts finished chunks itself
+        ctime = time.time()
+        if i < n and ctime - self.status_last >= self.status_interval_sec:
+            self.status_last = ctime
+            self.send('status', i, n)
 
     def exception(self, exc):
         self.send('exception', exc)
 
+    def db_batch(self, batch):
+        self.send('db_batch', batch)
+
+    def node_failed(self, uid, msg):
+        self.send('node_failed', uid, msg)
+
     def run(self, processor: Processor):
         keep_running = True
         while keep_running:
@@ -1023,7 +1330,7 @@ def run_mp_vfs_base(name, project_file, working_dir, q_in, q_out):
     try:
         p = MultiProcessVfsBase(name, q_in, q_out)
         vfs = VfsDatabase(project_file, working_dir, p)
-        processor = Processor(vfs, p)
+        processor = Processor(vfs, p, batch_sink=p.db_batch)
         p.run(processor)
         vfs.shutdown()
     except:
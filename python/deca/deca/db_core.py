@@ -1,5 +1,8 @@
 import os
 import io
+import hashlib
+import mmap
+import threading
 import sqlite3
 import pickle
 import re
@@ -7,20 +10,23 @@ import zstandard as zstd
 import zlib
 import numpy as np
 from typing import List
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from deca.util import common_prefix
 from deca.errors import *
-from deca.file import ArchiveFile, SubsetFile
+from deca.file import ArchiveFile, SubsetFile, BlockFile, MmapFile, FileHandlePool, PooledFile, block_fit
 from deca.ff_types import *
 from deca.ff_aaf import extract_aaf
 from deca.decompress import DecompressorOodleLZ
 from deca.game_info import game_info_load
-from deca.hashes import hash32_func, hash48_func, hash64_func, hash_all_func
+from deca.hashes import hash32_func, hash48_func, hash64_func, hash_all_func, hash32_many, hash64_many
+from deca.hashes import ContentFingerprint
 from deca.ff_gtoc import GtocArchiveEntry, GtocFileEntry
 from deca.db_types import *
 from deca.db_cross_game import DbCrossGame
-
-dumped_cache_dir = False
+from deca.db_cache import DecompressCache
+from deca.db_node_index import NodeIndex
 
 language_codes = [
     'bra',  # Brazil
@@ -227,6 +233,12 @@ class VfsNode:
 
         return self._blocks
 
+    def clone(self):
+        node = VfsNode.__new__(VfsNode)
+        for k in VfsNode.__slots__:
+            setattr(node, k, getattr(self, k))
+        return node
+
 
 core_nodes_definition = \
     '''
@@ -332,7 +344,16 @@ class VfsDatabase(DbBase):
     def __init__(
             self, project_file, working_dir, logger,
             init_display=False,
-            max_uncompressed_cache_size=(2 * 1024**3)
+            max_uncompressed_cache_size=(2 * 1024**3),
+            cache_max_size=(32 * 1024**3),
+            block_stream_min_size=(16 * 1024**2),
+            block_stream_max_cached_blocks=8,
+            use_mmap=True,
+            mmap_max_open=256,
+            file_pool_max_open=64,
+            block_decompress_threads=min(8, os.cpu_count() or 1),
+            node_cache_max=(64 * 1024),
+            use_node_index=False,
     ):
         super().__init__(os.path.join(working_dir, 'db', 'core.db'), logger)
 
@@ -345,12 +366,14 @@ class VfsDatabase(DbBase):
         if 4 == self.game_info.file_hash_size:
             self.file_hash_db_id = 'hash32'
             self.file_hash = hash32_func
+            self.file_hash_many = hash32_many
             self.file_hash_format = format_hash32
             self.file_hash_type = node_flag_v_hash_type_4
             self.ext_hash = hash32_func
         elif 8 == self.game_info.file_hash_size:
             self.file_hash_db_id = 'hash64'
             self.file_hash = hash64_func
+            self.file_hash_many = hash64_many
             self.file_hash_format = format_hash64
             self.file_hash_type = node_flag_v_hash_type_8
             self.ext_hash = hash32_func
@@ -359,26 +382,122 @@ class VfsDatabase(DbBase):
 
         os.makedirs(working_dir, exist_ok=True)
 
+        cache_dir = self.game_info.cache_dir
+        if cache_dir is None:
+            cache_dir = os.path.join(working_dir, '__CACHE__')
+        if self.game_info.cache_max_size is not None:
+            cache_max_size = self.game_info.cache_max_size
+        self.cache = DecompressCache(cache_dir, cache_max_size, logger)
+
         if init_display:
             logger.log('OPENING: {} {}'.format(self.game_info.game_dir, working_dir))
+            logger.log('CACHE DIRECTORY -> {}'.format(cache_dir))
 
         self._lookup_equipment_from_name = None
         self._lookup_equipment_from_hash = None
         self._lookup_translation_from_name = None
         self._lookup_note_from_file_path = None
+        self._adf_type_map = None
+
+        # nodes read by uid are kept in memory, along with the ancestor chains and cache key parts derived from them.
+        #  all of it is dropped on any change to the db by this connection. commits by other connections are picked up
+        #  by node_cache_sync, called once per batch of work rather than per lookup
+        self.node_cache_max = node_cache_max
+        self._node_cache = OrderedDict()
+        self._node_chains = {}
+        self._node_cache_key_parts = {}
+        self._node_cache_data_version = None
+        self.node_cache_stats = dict([(k, 0) for k in ['hits', 'misses', 'chain_hits', 'chain_misses', 'clears']])
+        self.db_changed_signal.connect(self, lambda x: x.node_cache_clear())
 
         self.db_setup()
 
+        # optional columnar snapshot of core_nodes that serves the bulk uid selections, loaded on first use
+        self.node_index = None
+        if use_node_index:
+            self.node_index = NodeIndex(self)
+
+        # compressed nodes at least this large are streamed block by block instead of being fully decompressed
+        self.block_stream_min_size = block_stream_min_size
+        self.block_stream_max_cached_blocks = block_stream_max_cached_blocks
+
+        # blocks of one node are decompressed concurrently on a small thread pool
+        self.block_decompress_threads = block_decompress_threads
+        self._block_executor = None
+
+        # physical files are memory mapped once and shared by all reads of them and their uncompressed children
+        self.use_mmap = use_mmap
+        self.mmap_max_open = mmap_max_open
+        self._mmaps = OrderedDict()
+        self._mmaps_lock = threading.Lock()
+
+        # reads that copy bytes out (compressed data, fingerprints) and files that are not mapped go through a pool
+        #  of open handles with positional reads, the mappings are kept for views
+        self.file_pool = FileHandlePool(file_pool_max_open)
+
         # setup in memory uncompressed cache
         # self.uncompressed_cache_max_size = max_uncompressed_cache_size
         # self.uncompressed_cache_map = {}
         # self.uncompressed_cache_lru = []
 
     def shutdown(self):
+        self.logger.trace(self.node_cache_stats_str())
+        self.logger.trace(self.db_contention_str())
+        self.logger.trace('FILE POOL: opens: {}, reuses: {}'.format(self.file_pool.opens, self.file_pool.reuses))
+        self.cache.flush()
+        if self.node_index is not None:
+            self.node_index.detach()
+        self.mmap_close_all()
+        self.file_pool.close_all()
+        if self._block_executor is not None:
+            self._block_executor.shutdown()
+            self._block_executor = None
         self.decompress_oodle_lz.shutdown()
 
+    def mmap_get(self, p_path):
+        with self._mmaps_lock:
+            mm = self._mmaps.get(p_path, None)
+            if mm is not None:
+                self._mmaps.move_to_end(p_path)
+                return mm
+
+            with open(p_path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return None  # empty files cannot be mapped
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            self._mmaps[p_path] = mm
+            while len(self._mmaps) > self.mmap_max_open:
+                # not closed here, file objects over it may still be in use. the mapping goes when the last one does
+                self._mmaps.popitem(last=False)
+
+        return mm
+
+    @staticmethod
+    def mmap_close(mm):
+        try:
+            mm.close()
+        except BufferError:
+            # views into the mapping are still alive, it is released when they are
+            pass
+
+    def mmap_close_all(self):
+        with self._mmaps_lock:
+            while self._mmaps:
+                _, mm = self._mmaps.popitem()
+                self.mmap_close(mm)
+
+    def file_obj_from_path(self, p_path, copy_out=False):
+        # copy_out: the caller only reads bytes out, it gets no use from a view into the mapping
+        if self.use_mmap and not copy_out:
+            mm = self.mmap_get(p_path)
+            if mm is not None:
+                return MmapFile(mm)
+        return PooledFile(self.file_pool, p_path)
+
     def db_reset(self):
         self.db_execute_one('DROP INDEX IF EXISTS index_core_node_blocks_node_id;')
+        self.db_execute_one('DROP INDEX IF EXISTS index_core_node_fingerprints_fingerprint;')
         self.db_execute_one('DROP INDEX IF EXISTS index_core_nodes_v_path_to_vnode;')
         self.db_execute_one('DROP INDEX IF EXISTS index_core_nodes_v_hash_to_vnode;')
 
@@ -395,20 +514,28 @@ class VfsDatabase(DbBase):
         self.db_execute_one('DROP INDEX IF EXISTS core_gtoc_file_entry_index_asc;')
 
         self.db_execute_one('DROP TABLE IF EXISTS core_node_blocks;')
+        self.db_execute_one('DROP TABLE IF EXISTS core_node_fingerprints;')
         self.db_execute_one('DROP TABLE IF EXISTS core_nodes;')
+        self.db_execute_one('DROP TABLE IF EXISTS core_nodes_changes;')
+        self.db_execute_one('DROP TABLE IF EXISTS core_node_index_readers;')
         self.db_execute_one('DROP TABLE IF EXISTS core_string_references;')
         self.db_execute_one('DROP TABLE IF EXISTS core_strings;')
         self.db_execute_one('DROP TABLE IF EXISTS core_adf_types;')
+        self._adf_type_map = None
 
         self.db_execute_one('DROP TABLE IF EXISTS core_objects;')
         self.db_execute_one('DROP TABLE IF EXISTS core_object_id_ref;')
         self.db_execute_one('DROP TABLE IF EXISTS core_event_id_ref;')
         self.db_execute_one('DROP TABLE IF EXISTS core_gtoc_archive_def;')
         self.db_execute_one('DROP TABLE IF EXISTS core_gtoc_file_entry;')
+        self.db_execute_one('DROP TABLE IF EXISTS core_physical_files;')
+        self.db_execute_one('DROP TABLE IF EXISTS core_process_checkpoints;')
+        self.db_execute_one('DROP TABLE IF EXISTS core_process_chunks;')
+        self.db_execute_one('DROP TABLE IF EXISTS core_process_strikes;')
 
         self.db_execute_one('VACUUM;')
 
-        self.db_conn.commit()
+        self.db_commit()
 
         self.db_changed_signal.call()
 
@@ -432,6 +559,39 @@ class VfsDatabase(DbBase):
             '''
         )
 
+        # change log of core_nodes, used to refresh NodeIndex snapshots incrementally. the triggers only log while some
+        #  snapshot is registered in core_node_index_readers, with the last change it has seen
+        self.db_execute_one(
+            '''
+            CREATE TABLE IF NOT EXISTS "core_nodes_changes" (
+                "seq" INTEGER PRIMARY KEY AUTOINCREMENT,
+                "node_id" INTEGER NOT NULL
+            );
+            '''
+        )
+        self.db_execute_one(
+            '''
+            CREATE TABLE IF NOT EXISTS "core_node_index_readers" (
+                "reader" TEXT NOT NULL,
+                "seq" INTEGER NOT NULL,
+                "time" REAL NOT NULL,
+                PRIMARY KEY ("reader")
+            );
+            '''
+        )
+        for trigger, row in [('insert', 'NEW'), ('update', 'NEW'), ('delete', 'OLD')]:
+            # unconditional triggers of earlier versions
+            self.db_execute_one(f'DROP TRIGGER IF EXISTS "trigger_core_nodes_changes_{trigger}"')
+            self.db_execute_one(
+                f'''
+                CREATE TRIGGER IF NOT EXISTS "trigger_core_nodes_log_{trigger}" AFTER {trigger.upper()} ON "core_nodes"
+                WHEN EXISTS (SELECT 1 FROM core_node_index_readers)
+                BEGIN
+                    INSERT INTO core_nodes_changes (node_id) VALUES ({row}.node_id);
+                END;
+                '''
+            )
+
         self.db_execute_one(
             '''
             CREATE TABLE IF NOT EXISTS "core_node_blocks" (
@@ -450,6 +610,23 @@ class VfsDatabase(DbBase):
             '''
         )
 
+        # first tier of the content hash, a hash of the bytes as stored. content_hash is only filled in when two
+        #  fingerprints collide or someone asks for it
+        self.db_execute_one(
+            '''
+            CREATE TABLE IF NOT EXISTS "core_node_fingerprints" (
+                "node_id" INTEGER NOT NULL UNIQUE,
+                "fingerprint" TEXT,
+                PRIMARY KEY ("node_id")
+            );
+            '''
+        )
+        self.db_execute_one(
+            '''
+            CREATE INDEX IF NOT EXISTS "index_core_node_fingerprints_fingerprint" ON "core_node_fingerprints" ("fingerprint" ASC);
+            '''
+        )
+
         self.db_execute_one(
             '''
             CREATE TABLE IF NOT EXISTS "core_strings" (
@@ -579,7 +756,52 @@ class VfsDatabase(DbBase):
         self.db_execute_one(
             'CREATE INDEX IF NOT EXISTS "core_gtoc_file_entry_index_asc" ON "core_gtoc_file_entry" ("def_index" ASC)')
 
-        self.db_conn.commit()
+        # state of the game files as they were when their root nodes were added, for detecting patched archives
+        self.db_execute_one(
+            '''
+            CREATE TABLE IF NOT EXISTS "core_physical_files" (
+                "p_path" TEXT NOT NULL,
+                "root_p_path" TEXT NOT NULL,
+                "size" INTEGER NOT NULL,
+                "mtime_ns" INTEGER NOT NULL,
+                "fingerprint" TEXT NOT NULL,
+                PRIMARY KEY ("p_path")
+            );
+            '''
+        )
+
+        # durable progress of VfsProcessor.process: completed steps, chunks handed to workers and not yet finished,
+        #  and nodes that took a worker down. nodes with enough strikes are quarantined
+        self.db_execute_one(
+            '''
+            CREATE TABLE IF NOT EXISTS "core_process_checkpoints" (
+                "name" TEXT NOT NULL,
+                "value" INTEGER,
+                PRIMARY KEY ("name")
+            );
+            '''
+        )
+        self.db_execute_one(
+            '''
+            CREATE TABLE IF NOT EXISTS "core_process_chunks" (
+                "chunk_id" INTEGER PRIMARY KEY,
+                "cmd" TEXT NOT NULL,
+                "node_ids" BLOB NOT NULL
+            );
+            '''
+        )
+        self.db_execute_one(
+            '''
+            CREATE TABLE IF NOT EXISTS "core_process_strikes" (
+                "node_id" INTEGER NOT NULL,
+                "strikes" INTEGER NOT NULL,
+                "reason" TEXT,
+                PRIMARY KEY ("node_id")
+            );
+            '''
+        )
+
+        self.db_commit()
 
         self.db_changed_signal.call()
 
@@ -596,14 +818,73 @@ class VfsDatabase(DbBase):
 
         return None
 
-    def node_where_uid(self, uid):
+    def node_cache_clear(self):
+        if self._node_cache or self._node_chains or self._node_cache_key_parts:
+            self.node_cache_stats['clears'] += 1
+        self._node_cache.clear()
+        self._node_chains.clear()
+        self._node_cache_key_parts.clear()
+
+    def node_cache_sync(self):
+        # data_version only changes when another connection commits, our own commits signal db_changed_signal
+        data_version = self.db_query_one('PRAGMA data_version', dbg='node_cache_sync')[0]
+        if data_version != self._node_cache_data_version:
+            self._node_cache_data_version = data_version
+            self.node_cache_clear()
+
+    def node_cache_stats_str(self):
+        stats = self.node_cache_stats
+        lookups = stats['hits'] + stats['misses']
+        hit_rate = 0.0
+        if lookups > 0:
+            hit_rate = stats['hits'] / lookups * 100.0
+        return 'NODE CACHE: Hits|Misses|Hit Rate: {}|{}|{:3.1f}%, Chain Hits|Misses: {}|{}, Clears: {}'.format(
+            stats['hits'], stats['misses'], hit_rate, stats['chain_hits'], stats['chain_misses'], stats['clears'])
+
+    def _node_get(self, uid):
+        # returns the shared cached node, callers must not modify it
+        node = self._node_cache.get(uid, None)
+        if node is not None:
+            self.node_cache_stats['hits'] += 1
+            self._node_cache.move_to_end(uid)
+            return node
+
+        self.node_cache_stats['misses'] += 1
         r1 = self.db_query_one(
             "select * from core_nodes where node_id == (?)",
             [uid],
             dbg='node_where_uid')
 
-        r1 = db_to_vfs_node(r1)
-        return r1
+        node = db_to_vfs_node(r1)
+        self._node_cache[uid] = node
+        while len(self._node_cache) > self.node_cache_max:
+            self._node_cache.popitem(last=False)
+
+        return node
+
+    def node_where_uid(self, uid):
+        return self._node_get(uid).clone()
+
+    def node_ancestors(self, uid):
+        # parent, grandparent, ... of node uid
+        chain = self._node_chains.get(uid, None)
+        if chain is not None:
+            self.node_cache_stats['chain_hits'] += 1
+            return chain
+
+        self.node_cache_stats['chain_misses'] += 1
+        node = self._node_get(uid)
+        if node.pid is None:
+            chain = ()
+        else:
+            parent_node = self._node_get(node.pid)
+            chain = (parent_node,) + self.node_ancestors(parent_node.uid)
+
+        if len(self._node_chains) >= self.node_cache_max:
+            self._node_chains.clear()
+        self._node_chains[uid] = chain
+
+        return chain
 
     # def nodes_where_uid(self, uids):
     #     nodes = self.db_query_one(
@@ -713,10 +994,332 @@ class VfsDatabase(DbBase):
         return [v[0] for v in result]
 
     def nodes_where_flag_select_uid(self, mask, value, dbg='nodes_where_flag_select_uid'):
+        if self.node_index is not None:
+            return self.node_index.select(flag_mask=mask, flag_value=value).tolist()
+
         uids = self.db_query_all(
             "select node_id from core_nodes where flags & (?) == (?)", [mask, value], dbg=dbg)
         return [uid[0] for uid in uids]
 
+    def nodes_select_cost_hint(self, uids):
+        # relative cost of processing each node, its uncompressed size
+        if self.node_index is not None:
+            self.node_index.sync()
+            uids_np = np.array(uids, dtype=np.int64)
+            sizes = np.zeros(len(uids), dtype=np.int64)
+            in_range = uids_np < self.node_index.capacity
+            sizes[in_range] = np.maximum(self.node_index.size_u[uids_np[in_range]], 0)
+            return sizes.tolist()
+
+        sizes = {}
+        for i in range(0, len(uids), 512):
+            uids_chunk = uids[i:i + 512]
+            sizes.update(self.db_query_all(
+                "SELECT node_id, size_u FROM core_nodes WHERE node_id IN ({})".format(','.join(['?'] * len(uids_chunk))),
+                uids_chunk, dbg='nodes_select_cost_hint'))
+        return [sizes.get(uid, None) or 0 for uid in uids]
+
+    def nodes_select_locality_hint(self, uids):
+        # sort key per node that puts nodes next to each other when they are read from the same place: the physical
+        #  root file, the offset in it of the topmost ancestor that has one (an ARC's TAB has none, its entries do),
+        #  the direct parent container and the offset in that
+        if self.node_index is not None:
+            self.node_index.sync()
+            pid = self.node_index.pid
+            offset = self.node_index.offset
+            valid = self.node_index.valid
+        else:
+            known = {}
+            todo = set(uids)
+            while todo:
+                todo = list(todo)
+                for i in range(0, len(todo), 512):
+                    uids_chunk = todo[i:i + 512]
+                    for uid, parent_id, parent_offset in self.db_query_all(
+                            "SELECT node_id, parent_id, parent_offset FROM core_nodes WHERE node_id IN ({})".format(
+                                ','.join(['?'] * len(uids_chunk))),
+                            uids_chunk, dbg='nodes_select_locality_hint'):
+                        known[uid] = (parent_id, parent_offset)
+                todo = set([v[0] for v in known.values() if v[0] is not None and v[0] not in known]) - set(todo)
+            uid_max = max(list(known.keys()) + list(uids) + [0])
+            pid = np.full(uid_max + 1, -1, dtype=np.int64)
+            offset = np.full(uid_max + 1, -1, dtype=np.int64)
+            valid = np.zeros(uid_max + 1, dtype=np.bool_)
+            for uid, (parent_id, parent_offset) in known.items():
+                valid[uid] = True
+                pid[uid] = -1 if parent_id is None else parent_id
+                offset[uid] = -1 if parent_offset is None else parent_offset
+
+        uids_np = np.array(uids, dtype=np.int64)
+        uids_np = np.where(uids_np < len(pid), uids_np, 0)
+        parent = pid[uids_np]
+        own_offset = offset[uids_np]
+        cur = uids_np.copy()
+        top_offset = own_offset.copy()
+        active = (pid[cur] >= 0) & valid[np.maximum(pid[cur], 0)]
+        while active.any():
+            has_offset = active & (offset[cur] >= 0)
+            top_offset[has_offset] = offset[cur[has_offset]]
+            cur[active] = pid[cur[active]]
+            active = (pid[cur] >= 0) & valid[np.maximum(pid[cur], 0)]
+
+        return list(zip(cur.tolist(), top_offset.tolist(), parent.tolist(), own_offset.tolist()))
+
+    def nodes_select_subtree_uids(self, root_uids):
+        # root_uids and all of their descendants
+        if self.node_index is not None:
+            self.node_index.sync()
+            pid = self.node_index.pid
+            valid = self.node_index.valid
+        else:
+            rows = self.db_query_all('SELECT node_id, parent_id FROM core_nodes', dbg='nodes_select_subtree_uids')
+            uid_max = max([r[0] for r in rows], default=0)
+            pid = np.full(uid_max + 1, -1, dtype=np.int64)
+            valid = np.zeros(uid_max + 1, dtype=np.bool_)
+            for uid, parent_id in rows:
+                valid[uid] = True
+                if parent_id is not None:
+                    pid[uid] = parent_id
+
+        selected = np.zeros(len(pid), dtype=np.bool_)
+        frontier = np.array([uid for uid in root_uids if uid < len(pid)], dtype=np.int64)
+        selected[frontier] = True
+        while len(frontier) > 0:
+            frontier = np.flatnonzero(valid & ~selected & np.isin(pid, frontier))
+            selected[frontier] = True
+
+        return np.flatnonzero(selected & valid).tolist()
+
+    def nodes_delete_subtrees(self, root_uids):
+        # removes the nodes and everything that was derived from them: blocks, string references, objects and their
+        #  refs, gtoc archive definitions and their entries. strings stay, they are shared by name
+        uids = self.nodes_select_subtree_uids(root_uids)
+        counts = {'nodes': len(uids)}
+        if not uids:
+            return counts
+
+        with self.db_transaction(dbg='nodes_delete_subtrees'):
+            self.db_execute_one(
+                'CREATE TEMP TABLE IF NOT EXISTS stale_nodes ("node_id" INTEGER PRIMARY KEY)',
+                dbg='nodes_delete_subtrees:stage')
+            self.db_execute_one('DELETE FROM stale_nodes', dbg='nodes_delete_subtrees:stage_clear')
+            self.db_execute_many(
+                'INSERT INTO stale_nodes VALUES (?)', [(uid,) for uid in uids], dbg='nodes_delete_subtrees:stage_fill')
+
+            stale_objects = 'SELECT rowid FROM core_objects WHERE node_id_src IN (SELECT node_id FROM stale_nodes)'
+            stale_gtoc = 'SELECT rowid FROM core_gtoc_archive_def WHERE node_id_src IN (SELECT node_id FROM stale_nodes)'
+            deletes = [
+                ('string_refs', 'core_string_references WHERE node_id_src IN (SELECT node_id FROM stale_nodes)'),
+                ('object_id_refs', f'core_object_id_ref WHERE object_rowid IN ({stale_objects})'),
+                ('event_id_refs', f'core_event_id_ref WHERE object_rowid IN ({stale_objects})'),
+                ('objects', 'core_objects WHERE node_id_src IN (SELECT node_id FROM stale_nodes)'),
+                ('gtoc_file_entries', f'core_gtoc_file_entry WHERE def_rowid IN ({stale_gtoc})'),
+                ('gtoc_archive_defs', 'core_gtoc_archive_def WHERE node_id_src IN (SELECT node_id FROM stale_nodes)'),
+                ('blocks', 'core_node_blocks WHERE node_id IN (SELECT node_id FROM stale_nodes)'),
+                ('fingerprints', 'core_node_fingerprints WHERE node_id IN (SELECT node_id FROM stale_nodes)'),
+                ('strikes', 'core_process_strikes WHERE node_id IN (SELECT node_id FROM stale_nodes)'),
+                (None, 'core_nodes WHERE node_id IN (SELECT node_id FROM stale_nodes)'),
+            ]
+            for name, where in deletes:
+                self.db_execute_one(f'DELETE FROM {where}', dbg=f'nodes_delete_subtrees:{name}')
+                if name is not None:
+                    counts[name] = self.db_cur.rowcount
+
+            self.db_execute_one('DELETE FROM stale_nodes', dbg='nodes_delete_subtrees:stage_clear')
+
+        self.db_changed_signal.call()
+
+        return counts
+
+    def nodes_select_reuse_info(self, uids, flag, key_columns=('file_type',)):
+        # for nodes with the same content processing results can be copied instead of produced again. returns
+        #  {uid: key} for the uids that have a content hash and {key: donor uid} with a node already carrying flag for
+        #  each key, key is the content hash followed by key_columns. the key column fingerprint is the tier-1
+        #  fingerprint of the bytes as stored, nodes without one get no key
+        columns = ''.join([', ' + ('f.fingerprint' if c == 'fingerprint' else 'n.' + c) for c in key_columns])
+        join = ''
+        if 'fingerprint' in key_columns:
+            join = ' JOIN core_node_fingerprints f ON f.node_id = n.node_id'
+        with self.db_transaction(dbg='nodes_select_reuse_info'):
+            self.db_execute_one(
+                'CREATE TEMP TABLE IF NOT EXISTS reuse_nodes ("node_id" INTEGER PRIMARY KEY)',
+                dbg='nodes_select_reuse_info:stage')
+            self.db_execute_one('DELETE FROM reuse_nodes', dbg='nodes_select_reuse_info:stage_clear')
+            self.db_execute_many(
+                'INSERT OR IGNORE INTO reuse_nodes VALUES (?)', [(uid,) for uid in uids],
+                dbg='nodes_select_reuse_info:stage_fill')
+
+            rows = self.db_query_all(
+                f'SELECT n.node_id, n.content_hash{columns} FROM core_nodes n{join} '
+                'WHERE n.node_id IN (SELECT node_id FROM reuse_nodes) AND n.content_hash IS NOT NULL',
+                dbg='nodes_select_reuse_info:nodes')
+            keys = dict([(row[0], tuple(row[1:])) for row in rows])
+
+            rows = self.db_query_all(
+                f'SELECT n.node_id, n.content_hash{columns} FROM core_nodes n{join} WHERE n.content_hash IN '
+                '(SELECT content_hash FROM core_nodes WHERE node_id IN (SELECT node_id FROM reuse_nodes)) '
+                'AND (COALESCE(n.flags, 0) & (?)) != 0', [flag],
+                dbg='nodes_select_reuse_info:donors')
+            donors = {}
+            for row in sorted(rows):
+                donors.setdefault(tuple(row[1:]), row[0])
+
+            self.db_execute_one('DELETE FROM reuse_nodes', dbg='nodes_select_reuse_info:stage_clear')
+
+        return keys, donors
+
+    def nodes_results_clone(self, pairs, flag, columns=(), columns_fill=(), flags_mask=0, children=False):
+        # copies what processing recorded for each (donor uid, uid) pair onto uid: flag, the flags_mask bits of the
+        #  donor's flags, the node columns (columns_fill only where uid has none), string references, objects with their object and event id refs and, with
+        #  children, the child nodes as they were listed (unprocessed, under the new parent)
+        counts = {'nodes': len(pairs), 'string_refs': 0, 'objects': 0, 'children': 0}
+        if not pairs:
+            return counts
+
+        with self.db_transaction(dbg='nodes_results_clone'):
+            self.db_execute_one(
+                'CREATE TEMP TABLE IF NOT EXISTS reuse_pairs ("node_id" INTEGER PRIMARY KEY, "donor_id" INTEGER)',
+                dbg='nodes_results_clone:stage')
+            self.db_execute_one(
+                'CREATE INDEX IF NOT EXISTS reuse_pairs_donor_id ON reuse_pairs ("donor_id")',
+                dbg='nodes_results_clone:stage_index')
+            self.db_execute_one('DELETE FROM reuse_pairs', dbg='nodes_results_clone:stage_clear')
+            self.db_execute_many(
+                'INSERT OR REPLACE INTO reuse_pairs VALUES (?,?)', [(uid, donor) for donor, uid in pairs],
+                dbg='nodes_results_clone:stage_fill')
+
+            donor_value = 'SELECT d.{0} FROM core_nodes d JOIN reuse_pairs p ON d.node_id = p.donor_id ' \
+                          'WHERE p.node_id = core_nodes.node_id'
+            sets = ['flags = (COALESCE(flags, 0) & ~(?)) | (COALESCE(({}), 0) & (?)) | (?)'.format(
+                donor_value.format('flags'))]
+            sets += ['{0} = ({1})'.format(c, donor_value.format(c)) for c in columns]
+            sets += ['{0} = COALESCE({0}, ({1}))'.format(c, donor_value.format(c)) for c in columns_fill]
+            self.db_execute_one(
+                'UPDATE core_nodes SET {} WHERE node_id IN (SELECT node_id FROM reuse_pairs)'.format(', '.join(sets)),
+                [flags_mask, flags_mask, flag], dbg='nodes_results_clone:nodes')
+
+            self.db_execute_one(
+                'INSERT OR IGNORE INTO core_string_references '
+                'SELECT r.string_rowid, p.node_id, r.is_adf_field_name, r.used_at_runtime, r.possible_file_types '
+                'FROM core_string_references r JOIN reuse_pairs p ON r.node_id_src = p.donor_id',
+                dbg='nodes_results_clone:string_refs')
+            counts['string_refs'] = self.db_cur.rowcount
+
+            self.db_execute_one(
+                'INSERT OR IGNORE INTO core_objects '
+                'SELECT p.node_id, o.offset, o.class_str_rowid, o.name_str_rowid, o.object_id '
+                'FROM core_objects o JOIN reuse_pairs p ON o.node_id_src = p.donor_id',
+                dbg='nodes_results_clone:objects')
+            counts['objects'] = self.db_cur.rowcount
+
+            for table in ['core_object_id_ref', 'core_event_id_ref']:
+                self.db_execute_one(
+                    f'INSERT OR IGNORE INTO {table} '
+                    'SELECT n.rowid, r.id, r.flags FROM reuse_pairs p '
+                    'JOIN core_objects o ON o.node_id_src = p.donor_id '
+                    f'JOIN {table} r ON r.object_rowid = o.rowid '
+                    'JOIN core_objects n ON n.node_id_src = p.node_id AND n.offset = o.offset',
+                    dbg=f'nodes_results_clone:{table}')
+
+            if children:
+                rows = self.db_query_all(
+                    'SELECT c.*, p.node_id FROM core_nodes c JOIN reuse_pairs p ON c.parent_id = p.donor_id',
+                    dbg='nodes_results_clone:children')
+                flags_listed = \
+                    node_flag_compression_type_mask | node_flag_compression_flag_mask | node_flag_v_hash_type_mask
+                clones = []
+                for row in rows:
+                    child = db_to_vfs_node(row[:-1])
+                    clones.append(VfsNode(
+                        flags=(child.flags or 0) & flags_listed, v_hash=child.v_hash, v_path=child.v_path,
+                        ext_hash=child.ext_hash, pid=row[-1], index=child.index, offset=child.offset,
+                        size_c=child.size_c, size_u=child.size_u))
+                if clones:
+                    self.nodes_add_many(clones)
+                counts['children'] = len(clones)
+
+            self.db_execute_one('DELETE FROM reuse_pairs', dbg='nodes_results_clone:stage_clear')
+
+        self.db_changed_signal.call()
+
+        return counts
+
+    def physical_files_select(self):
+        # p_path -> (root_p_path, size, mtime_ns, fingerprint)
+        rows = self.db_query_all('SELECT * FROM core_physical_files', dbg='physical_files_select')
+        return dict([(r[0], r[1:]) for r in rows])
+
+    def physical_files_set(self, records):
+        # (p_path, root_p_path, size, mtime_ns, fingerprint)
+        self.db_execute_many(
+            'INSERT OR REPLACE INTO core_physical_files VALUES (?,?,?,?,?)', records, dbg='physical_files_set')
+        self.db_commit()
+
+    def physical_files_delete(self, p_paths):
+        self.db_execute_many(
+            'DELETE FROM core_physical_files WHERE p_path=(?)', [(p,) for p in p_paths], dbg='physical_files_delete')
+        self.db_commit()
+
+    def process_checkpoint_get(self, name):
+        result = self.db_query_one(
+            'SELECT value FROM core_process_checkpoints WHERE name=(?)', [name], dbg='process_checkpoint_get')
+        if result is None:
+            return None
+        return result[0]
+
+    def process_checkpoint_set(self, name, value=1):
+        self.db_execute_one(
+            'INSERT OR REPLACE INTO core_process_checkpoints VALUES (?,?)', [name, value], dbg='process_checkpoint_set')
+        self.db_commit()
+
+    def process_checkpoints_select(self):
+        return self.db_query_all('SELECT name, value FROM core_process_checkpoints', dbg='process_checkpoints_select')
+
+    def process_checkpoints_clear(self):
+        self.db_execute_one('DELETE FROM core_process_checkpoints', dbg='process_checkpoints_clear')
+        self.db_commit()
+
+    def process_chunk_begin(self, cmd, uids):
+        self.db_execute_one(
+            'INSERT INTO core_process_chunks (cmd, node_ids) VALUES (?,?)',
+            [cmd, np.array(uids, dtype=np.int64).tobytes()], dbg='process_chunk_begin')
+        chunk_id = self.db_cur.lastrowid
+        self.db_commit()
+        return chunk_id
+
+    def process_chunk_end(self, chunk_id):
+        self.db_execute_one('DELETE FROM core_process_chunks WHERE chunk_id=(?)', [chunk_id], dbg='process_chunk_end')
+        self.db_commit()
+
+    def process_chunks_select(self):
+        # [(chunk_id, cmd, uids)]
+        rows = self.db_query_all('SELECT * FROM core_process_chunks', dbg='process_chunks_select')
+        return [(chunk_id, cmd, np.frombuffer(node_ids, dtype=np.int64).tolist()) for chunk_id, cmd, node_ids in rows]
+
+    def process_chunks_clear(self):
+        self.db_execute_one('DELETE FROM core_process_chunks', dbg='process_chunks_clear')
+        self.db_commit()
+
+    def node_strikes_add(self, uids, reason):
+        self.db_execute_many(
+            'INSERT INTO core_process_strikes VALUES (?,1,?) '
+            'ON CONFLICT(node_id) DO UPDATE SET strikes=strikes+1, reason=excluded.reason',
+            [(uid, reason) for uid in uids], dbg='node_strikes_add')
+        self.db_commit()
+
+    def node_strikes_clear(self, uids=None):
+        if uids is None:
+            self.db_execute_one('DELETE FROM core_process_strikes', dbg='node_strikes_clear_all')
+        else:
+            self.db_execute_many(
+                'DELETE FROM core_process_strikes WHERE node_id=(?)', [(uid,) for uid in uids], dbg='node_strikes_clear')
+        self.db_commit()
+
+    def node_strikes_select(self):
+        # uid -> (strikes, reason)
+        rows = self.db_query_all('SELECT * FROM core_process_strikes', dbg='node_strikes_select')
+        return dict([(uid, (strikes, reason)) for uid, strikes, reason in rows])
+
     def nodes_where_temporary_select_uid(self, temporary):
         mask = node_flag_temporary_file
         if temporary:
@@ -727,6 +1330,9 @@ class VfsDatabase(DbBase):
 
     def nodes_where_f_type_select_uid_v_hash_processed(
             self, file_type, flag=node_flag_processed_file_type, has_any_path=None):
+        if self.node_index is not None:
+            return self.node_index.select_uid_v_hash_processed(flag, file_types=[file_type], has_any_path=has_any_path)
+
         params = []
         wheres = []
 
@@ -791,6 +1397,203 @@ class VfsDatabase(DbBase):
         result = [r[0] for r in result if r[0] is not None]
         return result
 
+    def nodes_select_distinct_vhash_unnamed(self):
+        result = self.db_query_all(
+            "SELECT DISTINCT v_hash FROM core_nodes WHERE v_path IS NULL AND v_hash IS NOT NULL",
+            dbg='nodes_select_distinct_vhash_unnamed')
+        result = [r[0] for r in result]
+        return result
+
+    def nodes_select_unnamed_vhash_file_types(self):
+        # {v_hash: set of file types} of the unnamed nodes whose file type is known
+        result = self.db_query_all(
+            "SELECT DISTINCT v_hash, file_type FROM core_nodes "
+            "WHERE v_path IS NULL AND v_hash IS NOT NULL AND file_type IS NOT NULL",
+            dbg='nodes_select_unnamed_vhash_file_types')
+        types = {}
+        for v_hash, file_type in result:
+            types.setdefault(v_hash, set()).add(file_type)
+        return types
+
+    def nodes_select_ext_hash_file_types(self):
+        # {ext_hash: set of file types} seen on the named nodes, what a file with that extension has turned out to be
+        result = self.db_query_all(
+            "SELECT DISTINCT ext_hash, file_type FROM core_nodes "
+            "WHERE v_path IS NOT NULL AND ext_hash IS NOT NULL AND file_type IS NOT NULL",
+            dbg='nodes_select_ext_hash_file_types')
+        types = {}
+        for ext_hash, file_type in result:
+            types.setdefault(ext_hash, set()).add(file_type)
+        return types
+
+    def nodes_vhash_resolve(self, chunk_size=64 * 1024):
+        # set based form of Processor.process_vhash_final over every v_hash: unnamed nodes take the first string
+        #  matching their v_hash that has a reference allowing their file type, nodes whose string is used at
+        #  runtime get depth 0, named nodes get file type (by extension) and ext hash. only rows that change are read
+        #  and written
+        if self.file_hash_type == node_flag_v_hash_type_4:
+            hash_col = 'hash32'
+        elif self.file_hash_type == node_flag_v_hash_type_8:
+            hash_col = 'hash64'
+        else:
+            raise NotImplementedError('Unhandled Hash Type {}'.format(self.file_hash_type))
+
+        counts = {'named': 0, 'runtime': 0, 'file_type': 0, 'ext_hash': 0, 'skipped_refs': 0}
+        names = {}
+        runtime = set()
+
+        cur = self.db_conn.cursor()
+        cur.execute(
+            f'''
+            SELECT n.node_id, n.file_type, n.ext_hash, s.rowid, s.string, r.used_at_runtime, r.possible_file_types
+            FROM core_nodes n
+            JOIN core_strings s ON s.{hash_col} == n.v_hash
+            JOIN core_string_references r ON r.string_rowid == s.rowid
+            WHERE n.v_path IS NULL AND n.v_hash IS NOT NULL AND n.node_id != 0
+            ORDER BY n.node_id, s.rowid, r.node_id_src, r.is_adf_field_name, r.used_at_runtime, r.possible_file_types
+            '''
+        )
+        # per node: the first string (by rowid) with a reference the file type fits names the node, any reference of
+        #  that string used at runtime flags it
+        ftype_int_cache = {}
+        node_id_last = None
+        named_rowid = None
+        rowid_last = None
+        rowid_runtime = False
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            for node_id, file_type, ext_hash, rowid, string, used_at_runtime, possible_ftypes in rows:
+                if node_id != node_id_last:
+                    node_id_last = node_id
+                    named_rowid = None
+                    rowid_last = None
+                if rowid != rowid_last:
+                    rowid_last = rowid
+                    rowid_runtime = False
+                rowid_runtime = rowid_runtime or bool(used_at_runtime)
+                if named_rowid is None:
+                    ftype_int = ftype_int_cache.get(file_type, None)
+                    if ftype_int is None:
+                        ftype_int = ftype_list[FTYPE_NO_TYPE if file_type is None else file_type]
+                        ftype_int_cache[file_type] = ftype_int
+                    if possible_ftypes is None or possible_ftypes == 0:
+                        possible_ftypes = ftype_list[FTYPE_ANY_TYPE]
+                    if (ftype_int & possible_ftypes) != 0:
+                        named_rowid = rowid
+                        names[node_id] = (string, file_type, ext_hash)
+                    else:
+                        counts['skipped_refs'] += 1
+                if named_rowid == rowid and rowid_runtime:
+                    runtime.add(node_id)
+        cur.close()
+
+        result = self.db_query_all(
+            f'''
+            SELECT DISTINCT n.node_id
+            FROM core_nodes n
+            JOIN core_strings s ON s.{hash_col} == n.v_hash AND s.string == n.v_path
+            JOIN core_string_references r ON r.string_rowid == s.rowid
+            WHERE n.v_path IS NOT NULL AND r.used_at_runtime AND
+                (n.used_at_runtime_depth IS NULL OR n.used_at_runtime_depth != 0)
+            ''',
+            dbg='nodes_vhash_resolve:runtime')
+        runtime.update([r[0] for r in result])
+
+        # file type and ext hash follow from the name, for nodes named just now and earlier
+        file_types = []
+        ext_hashes = []
+        result = self.db_query_all(
+            'SELECT node_id, v_path, file_type, ext_hash FROM core_nodes '
+            'WHERE v_path IS NOT NULL AND (file_type IS NULL OR ext_hash IS NULL)',
+            dbg='nodes_vhash_resolve:derived')
+        candidates = [(node_id, v_path, file_type, ext_hash) for node_id, v_path, file_type, ext_hash in result]
+        candidates += [(node_id, v_path, file_type, ext_hash) for node_id, (v_path, file_type, ext_hash) in names.items()]
+        for node_id, v_path, file_type, ext_hash in candidates:
+            file, ext = os.path.splitext(to_bytes(v_path))
+            if file_type is None:
+                if ext[0:4] == b'.atx':
+                    file_types.append((FTYPE_ATX, node_id))
+                elif ext == b'.hmddsc':
+                    file_types.append((FTYPE_HMDDSC, node_id))
+            if ext_hash is None:
+                ext_hashes.append((self.ext_hash(ext), node_id))
+
+        # one update per changed node, so each node costs one index update and one change log row
+        updates = {}
+        for node_id, (v_path, _, _) in names.items():
+            updates.setdefault(node_id, [None, 0, None, None])[0] = to_str(v_path)
+        for node_id in runtime:
+            updates.setdefault(node_id, [None, 0, None, None])[1] = 1
+        for file_type, node_id in file_types:
+            updates.setdefault(node_id, [None, 0, None, None])[2] = file_type
+        for ext_hash, node_id in ext_hashes:
+            updates.setdefault(node_id, [None, 0, None, None])[3] = ext_hash
+
+        with self.db_transaction(dbg='nodes_vhash_resolve'):
+            self.db_execute_many(
+                '''
+                UPDATE core_nodes SET
+                v_path=COALESCE((?), v_path),
+                used_at_runtime_depth=(CASE WHEN (?) THEN 0 ELSE used_at_runtime_depth END),
+                file_type=COALESCE((?), file_type),
+                ext_hash=COALESCE((?), ext_hash)
+                WHERE node_id=(?)
+                ''',
+                [tuple(v) + (k,) for k, v in updates.items()], dbg='nodes_vhash_resolve:update')
+
+        counts['named'] = len(names)
+        counts['runtime'] = len(runtime)
+        counts['file_type'] = len(file_types)
+        counts['ext_hash'] = len(ext_hashes)
+
+        if names or runtime or file_types or ext_hashes:
+            self.db_changed_signal.call()
+
+        return counts
+
+    def nodes_update_used_depths(self):
+        # used_at_runtime_depth of a node becomes the smallest of its own and its parent's plus one, propagated down
+        #  from the nodes that have a depth over the columnar parent array. returns (nodes changed, deepest level)
+        rows = self.db_query_all(
+            'SELECT node_id, COALESCE(parent_id, -1), COALESCE(used_at_runtime_depth, -1) FROM core_nodes',
+            dbg='nodes_update_used_depths:select')
+        if not rows:
+            return 0, 0
+
+        rows = np.array(rows, dtype=np.int64)
+        uids = rows[:, 0]
+        depth_none = np.int64(1) << 62
+        pid = np.full(uids.max() + 1, -1, dtype=np.int64)
+        depth = np.full(uids.max() + 1, depth_none, dtype=np.int64)
+        pid[uids] = rows[:, 1]
+        depth[uids] = np.where(rows[:, 2] >= 0, rows[:, 2], depth_none)
+        depth_orig = depth.copy()
+
+        children = uids[(rows[:, 1] >= 0) & (rows[:, 1] < len(pid))]
+        parents = pid[children]
+        levels = 0
+        while True:
+            depth_new = np.minimum(depth[parents], depth_none - 1) + 1
+            better = depth_new < depth[children]
+            if not better.any():
+                break
+            depth[children[better]] = depth_new[better]
+            levels += 1
+
+        changed = np.flatnonzero(depth != depth_orig)
+        with self.db_transaction(dbg='nodes_update_used_depths'):
+            self.db_execute_many(
+                'UPDATE core_nodes SET used_at_runtime_depth=(?) WHERE node_id=(?)',
+                zip(depth[changed].tolist(), changed.tolist()), dbg='nodes_update_used_depths:update')
+
+        if len(changed) > 0:
+            self.db_changed_signal.call()
+
+        depth_set = depth[depth < depth_none]
+        return len(changed), int(depth_set.max()) if len(depth_set) > 0 else 0
+
     def nodes_select_distinct_vpath(self):
         result = self.db_query_all(
             "SELECT DISTINCT v_path FROM core_nodes", dbg='nodes_select_distinct_vpath')
@@ -798,6 +1601,7 @@ class VfsDatabase(DbBase):
         return result
 
     def nodes_select_distinct_vpath_content_hash(self):
+        # content hashes are only computed for duplicates or on request, dump_vpaths fills them for named nodes first
         result = self.db_query_all(
             "SELECT DISTINCT v_path, content_hash FROM core_nodes", dbg='nodes_select_distinct_vpath_content_hash')
         result = [(to_str(r[0]), to_str(r[1])) for r in result if r[0] is not None]
@@ -904,45 +1708,50 @@ class VfsDatabase(DbBase):
         return result
 
     def nodes_delete_where_uid(self, uids):
-        self.db_execute_many(
-            "DELETE FROM core_nodes WHERE node_id=(?)", uids, dbg='nodes_delete_where_uid'
-        )
-        self.db_conn.commit()
+        with self.db_transaction(dbg='nodes_delete_where_uid'):
+            # uids are handed out again after the largest is deleted, nothing keyed by them may outlive the node
+            self.db_execute_many(
+                "DELETE FROM core_node_fingerprints WHERE node_id=(?)", uids, dbg='nodes_delete_where_uid:fingerprints'
+            )
+            self.db_execute_many(
+                "DELETE FROM core_nodes WHERE node_id=(?)", uids, dbg='nodes_delete_where_uid'
+            )
 
         self.db_changed_signal.call()
 
     def nodes_add_many(self, nodes):
-        db_nodes = [db_from_vfs_node(node) for node in nodes]
-
-        self.db_execute_many(
-            f"insert into core_nodes values {core_nodes_all_fields}",
-            db_nodes,
-            dbg='nodes_add_many:insert_nodes'
-        )
-        self.db_conn.commit()
-
-        blocks = []
-        node: VfsNode
-        for node in nodes:
-            if node.blocks_raw():
-                result = self.db_query_all(
-                    "SELECT node_id FROM core_nodes WHERE parent_id=(?) and parent_index=(?)",
-                    [node.pid, node.index],
-                    dbg='nodes_add_many:select_nodes'
-                )
+        with self.db_transaction(dbg='nodes_add_many'):
+            # uids are assigned here while holding the write lock, so blocks can be written without reading them back
+            uid_next = self.db_query_one(
+                "SELECT COALESCE(MAX(node_id), 0) + 1 FROM core_nodes", dbg='nodes_add_many:uid_next')[0]
+            # fingerprints past the largest uid belong to deleted nodes, the new nodes must not inherit them
+            self.db_execute_one(
+                'DELETE FROM core_node_fingerprints WHERE node_id >= (?)', [uid_next], dbg='nodes_add_many:fingerprints')
+            uid_next = max([uid_next] + [node.uid + 1 for node in nodes if node.uid is not None])
+
+            blocks = []
+            node: VfsNode
+            for node in nodes:
+                if node.uid is None:
+                    node.uid = uid_next
+                    uid_next += 1
+
+                if node.blocks_raw():
+                    for bi, block in enumerate(node.blocks_raw()):
+                        blocks.append((node.uid, bi, block[0], block[1], block[2]))
 
-                node.uid = result[0][0]
-
-                for bi, block in enumerate(node.blocks_raw()):
-                    blocks.append((node.uid, bi, block[0], block[1], block[2]))
-
-        if blocks:
             self.db_execute_many(
-                "insert into core_node_blocks values (?,?,?,?,?)",
-                blocks,
-                dbg='nodes_add_many:insert_blocks'
+                f"insert into core_nodes values {core_nodes_all_fields}",
+                [db_from_vfs_node(node) for node in nodes],
+                dbg='nodes_add_many:insert_nodes'
             )
-            self.db_conn.commit()
+
+            if blocks:
+                self.db_execute_many(
+                    "insert into core_node_blocks values (?,?,?,?,?)",
+                    blocks,
+                    dbg='nodes_add_many:insert_blocks'
+                )
 
         self.db_changed_signal.call()
 
@@ -950,34 +1759,47 @@ class VfsDatabase(DbBase):
         db_nodes = [db_from_vfs_node(node) for node in nodes]
         db_nodes = [db_node[1:] + db_node[0:1] for db_node in db_nodes]
         self.db_execute_many(core_nodes_update_all_where_node_id, db_nodes, dbg='node_update_many')
-        self.db_conn.commit()
+        self.db_commit()
         self.db_changed_signal.call()
 
+    def node_fingerprints_add_many(self, records):
+        # (node_id, fingerprint)
+        self.db_execute_many(
+            'INSERT OR REPLACE INTO core_node_fingerprints VALUES (?,?)', records, dbg='node_fingerprints_add_many')
+        self.db_commit()
+
+    def nodes_select_fingerprint_missing(self):
+        result = self.db_query_all(
+            'SELECT node_id FROM core_nodes WHERE node_id NOT IN (SELECT node_id FROM core_node_fingerprints)',
+            dbg='nodes_select_fingerprint_missing')
+        return [r[0] for r in result]
+
+    def nodes_select_named_content_hash_missing(self):
+        result = self.db_query_all(
+            'SELECT node_id FROM core_nodes WHERE v_path IS NOT NULL AND content_hash IS NULL',
+            dbg='nodes_select_named_content_hash_missing')
+        return [r[0] for r in result]
+
+    def nodes_select_fingerprint_collisions(self):
+        # nodes still without a content hash that share their fingerprint with another node
+        result = self.db_query_all(
+            'SELECT f.node_id FROM core_node_fingerprints f JOIN core_nodes n ON n.node_id = f.node_id '
+            'WHERE n.content_hash IS NULL AND f.fingerprint IN ('
+            'SELECT fingerprint FROM core_node_fingerprints WHERE node_id IN (SELECT node_id FROM core_nodes) '
+            'GROUP BY fingerprint HAVING COUNT(*) > 1)',
+            dbg='nodes_select_fingerprint_collisions')
+        return [r[0] for r in result]
+
     def hash_string_add_many_basic(self, hash_list):
         # (string, h4, h6, h8, ext_hash32)
         hash_list_str = [(to_str(h[0]), h[1], h[2], h[3], h[4]) for h in hash_list]
         hash_list_str_unique = list(set(hash_list_str))
-        self.db_execute_many(
-            "INSERT OR IGNORE INTO core_strings VALUES (?,?,?,?,?)",
-            hash_list_str_unique,
-            dbg='hash_string_add_many_basic:0:insert'
-        )
-        self.db_conn.commit()
-        self.db_changed_signal.call()
+        hash_list_map, n_inserted = self.db_strings_add_many(
+            'core_strings', hash_list_str_unique, dbg='hash_string_add_many_basic')
+        if n_inserted > 0:
+            self.db_changed_signal.call()
 
-        hash_list_map = {}
-        str_to_row_map = {}
-        for rec in hash_list_str_unique:
-            result = self.db_query_all(
-                "SELECT rowid FROM core_strings WHERE string=(?) and hash32=(?) and hash48=(?) and hash64=(?) and ext_hash32=(?)",
-                rec,
-                dbg='hash_string_add_many_basic:1:select')
-
-            # we expect one and only one match for a hash+string
-            assert len(result) == 1
-            row_id = result[0][0]
-            hash_list_map[rec] = row_id
-            str_to_row_map[to_bytes(rec[0])] = row_id
+        str_to_row_map = dict([(to_bytes(rec[0]), row_id) for rec, row_id in hash_list_map.items()])
 
         return hash_list_str, hash_list_map, str_to_row_map
 
@@ -992,7 +1814,7 @@ class VfsDatabase(DbBase):
             "INSERT OR IGNORE INTO core_string_references VALUES (?,?,?,?,?)",
             ref_list,
             dbg='hash_string_add_many:0:insert')
-        self.db_conn.commit()
+        self.db_commit()
         self.db_changed_signal.call()
 
     def object_info_add_many(self, objects):
@@ -1023,7 +1845,7 @@ class VfsDatabase(DbBase):
             object_insert,
             dbg='object_info_add_many:1:insert'
         )
-        self.db_conn.commit()
+        self.db_commit()
         self.db_changed_signal.call()
 
         # lookup records to get obj_rowids
@@ -1046,7 +1868,7 @@ class VfsDatabase(DbBase):
             records,
             dbg='object_id_refs_add_many:0:insert'
         )
-        self.db_conn.commit()
+        self.db_commit()
         self.db_changed_signal.call()
 
     def event_id_refs_add_many(self, refs, obj_rowids):
@@ -1058,7 +1880,7 @@ class VfsDatabase(DbBase):
             records,
             dbg='event_id_refs_add_many:0:insert'
         )
-        self.db_conn.commit()
+        self.db_commit()
         self.db_changed_signal.call()
 
     def gtoc_archive_add_many(self, archives: List[GtocArchiveEntry]):
@@ -1070,7 +1892,7 @@ class VfsDatabase(DbBase):
             entries,
             dbg='gtoc_archive_add_many:0:insert'
         )
-        self.db_conn.commit()
+        self.db_commit()
 
         # lookup gtoc archive definitions
         def_row_ids = []
@@ -1091,7 +1913,7 @@ class VfsDatabase(DbBase):
             for fe in a.file_entries:
                 file_entry_strings.add(fe.path)
 
-        hash_list = [make_hash_string_tuple(s) for s in file_entry_strings]
+        hash_list = make_hash_string_tuples(file_entry_strings)
         _, _, str_to_row_map = self.hash_string_add_many_basic(hash_list)
 
         # insert file entries into db
@@ -1119,7 +1941,7 @@ class VfsDatabase(DbBase):
             all_file_entries,
             dbg='gtoc_archive_add_many:2:insert'
         )
-        self.db_conn.commit()
+        self.db_commit()
         self.db_changed_signal.call()
 
     def gtoc_archive_where_hash32_magic(self, path_hash32=None, magic=None):
@@ -1240,159 +2062,297 @@ class VfsDatabase(DbBase):
 
         result = self.db_execute_many(
             "INSERT OR IGNORE INTO core_adf_types VALUES (?,?,?)", adf_list, dbg='adf_type_map_save')
-        self.db_conn.commit()
+        self.db_commit()
         self.db_changed_signal.call()
 
     def adf_type_map_load(self):
-        result = self.db_query_all("SELECT * FROM core_adf_types", dbg='adf_type_map_load')
-
-        adf_map = {}
-        adf_missing = set()
-        for k, miss, b in result:
-            if len(b) > 0:
-                with io.BytesIO(b) as f:
-                    v = pickle.load(f)
-                adf_map[k] = v
-            elif miss is not None and miss != 0:
-                adf_missing.add((k, miss))
-            else:
-                raise NotImplemented(f'Unknown type record: {k}, {miss}, {b}')
+        # rows are only ever added, so the last rowid identifies the contents. every DbWrap loads the map, long lived
+        #  worker processes only unpickle it again after another process saved new types
+        version = self.db_query_one("SELECT MAX(rowid) FROM core_adf_types", dbg='adf_type_map_load:version')[0]
+        if self._adf_type_map is None or self._adf_type_map[0] != version:
+            result = self.db_query_all("SELECT * FROM core_adf_types", dbg='adf_type_map_load')
+
+            adf_map = {}
+            adf_missing = set()
+            for k, miss, b in result:
+                if len(b) > 0:
+                    with io.BytesIO(b) as f:
+                        v = pickle.load(f)
+                    adf_map[k] = v
+                elif miss is not None and miss != 0:
+                    adf_missing.add((k, miss))
+                else:
+                    raise NotImplemented(f'Unknown type record: {k}, {miss}, {b}')
 
-        return adf_map, adf_missing
+            self._adf_type_map = (version, adf_map, adf_missing)
 
-    def generate_cache_file_name(self, node: VfsNode):
-        pid = node.pid
-        parent_nodes = []
-        parent_paths = []
-        while pid is not None:
-            parent_node = self.node_where_uid(pid)
-            pid = parent_node.pid
-            parent_nodes.append(parent_node)
-            pp = None
-            if parent_node.p_path is not None:
+        # callers add to what they get
+        _, adf_map, adf_missing = self._adf_type_map
+        return dict(adf_map), set(adf_missing)
+
+    def generate_cache_key(self, node: VfsNode):
+        # key on the physical file and the offsets down to the node, not the names along the way
+        parts = [node.offset, node.compression_type_get(), node.compression_flag_get(), node.size_c, node.size_u]
+        if node.pid is not None:
+            parts += self._cache_key_parts_get(node.pid)
+        parts.append(self.game_info.game_id)
+
+        return self.cache.key_make(*parts[::-1])
+
+    def _cache_key_parts_get(self, uid):
+        parts = self._node_cache_key_parts.get(uid, None)
+        if parts is not None:
+            return parts
+
+        parts = []
+        for parent_node in (self._node_get(uid),) + self.node_ancestors(uid):
+            if parent_node.file_type == FTYPE_TAB:
+                pass
+            elif parent_node.p_path is not None:
                 prefix, end0, end1 = common_prefix(parent_node.p_path, self.game_info.game_dir)
-                f, e = os.path.splitext(end0)
-                if e != '.tab':
-                    pp = end0
+                st = os.stat(parent_node.p_path)
+                parts += [st.st_mtime_ns, st.st_size, end0]
+                break
             else:
-                pp = parent_node.v_hash_to_str() + '.dat'
-            if pp is not None:
-                parent_paths.append(pp)
-        cache_dir = os.path.join(self.working_dir, '__CACHE__/', *parent_paths[::-1])
-        file_name = os.path.join(cache_dir, node.v_hash_to_str() + '.dat')
+                parts.append(parent_node.offset)
 
-        global dumped_cache_dir
-        if not dumped_cache_dir:
-            dumped_cache_dir = True
-            self.logger.log(f'CACHE DIRECTORY -> {cache_dir}')
+        if len(self._node_cache_key_parts) >= self.node_cache_max:
+            self._node_cache_key_parts.clear()
+        self._node_cache_key_parts[uid] = parts
+
+        return parts
+
+    def generate_cache_file_name(self, node: VfsNode):
+        return self.cache.file_name(self.generate_cache_key(node))
+
+    def cache_open(self, key):
+        file_name = self.cache.get(key)
+        if file_name is not None:
+            try:
+                return open(file_name, 'rb')
+            except FileNotFoundError:
+                # evicted by another process since the lookup
+                pass
+        return None
+
+    def block_decompress(self, compression_type, in_buffer, compressed_len, uncompressed_len):
+        if compression_type in {compression_v4_01_zlib}:
+            buffer_ret = zlib.decompress(in_buffer)
+            ret = len(buffer_ret)
+        elif compression_type in {compression_v4_03_zstd}:
+            if compressed_len == uncompressed_len:
+                buffer_ret, ret = in_buffer, len(in_buffer)
+            else:
+                dc = zstd.ZstdDecompressor()
+                buffer_ret = dc.decompress(in_buffer)
+                ret = len(buffer_ret)
+        elif compression_type in {compression_v4_04_oo}:
+            if compressed_len == uncompressed_len:
+                buffer_ret, ret = in_buffer, len(in_buffer)
+            else:
+                buffer_ret, ret = self.decompress_oodle_lz.decompress(
+                    in_buffer, compressed_len, uncompressed_len)
+        else:
+            raise EDecaUnknownCompressionType(compression_type)
 
-        return file_name
+        return buffer_ret, ret
 
-    def file_obj_from(self, node: VfsNode):
+    def block_executor_get(self, compression_type, n_blocks):
+        # zlib and zstd release the GIL, oodle goes through a single dll session so stays on the calling thread
+        if self.block_decompress_threads <= 1 or n_blocks < 2:
+            return None
+        if compression_type not in {compression_v4_01_zlib, compression_v4_03_zstd}:
+            return None
+        if self._block_executor is None:
+            self._block_executor = ThreadPoolExecutor(
+                max_workers=self.block_decompress_threads, thread_name_prefix='deca_block')
+        return self._block_executor
+
+    def block_decompress_n(self, compression_type, block, in_buffer, buffer_all=None, out_offset=0):
+        block_offset, compressed_len, uncompressed_len = block
+        buffer_ret, ret = self.block_decompress(compression_type, in_buffer, compressed_len, uncompressed_len)
+        if buffer_all is not None and ret == uncompressed_len:
+            buffer_all[out_offset:out_offset + uncompressed_len] = buffer_ret
+            buffer_ret = None
+        return buffer_ret, ret
+
+    def node_fingerprint(self, node: VfsNode, chunk_size=16 * 1024 * 1024):
+        # first tier of the content hash, over the bytes as stored so nothing is decompressed. the same content
+        #  stored with a different compression fingerprints differently, which only costs a missed duplicate
+        compression_type = node.compression_type_get()
+        h = ContentFingerprint('{}:{}:{}:'.format(compression_type, node.size_c, node.size_u).encode('ascii'))
+
+        if node.file_type not in {FTYPE_ARC, FTYPE_TAB} and \
+                compression_type in {compression_v4_01_zlib, compression_v4_03_zstd, compression_v4_04_oo}:
+            with self.file_obj_from(self._node_get(node.pid), copy_out=True) as f:
+                for block_offset, compressed_len, uncompressed_len in node.blocks_get(self):
+                    f.seek(block_offset)
+                    h.update(f.read(compressed_len))
+        elif node.file_type not in {FTYPE_ARC, FTYPE_TAB} and compression_type in {compression_v3_zlib}:
+            with ArchiveFile(self.file_obj_from(self._node_get(node.pid), copy_out=True)) as f:
+                f.seek(node.offset)
+                h.update(f.read(node.size_c))
+        else:
+            with self.file_obj_from(node, copy_out=True) as f:
+                while True:
+                    buf = f.read(chunk_size)
+                    if buf is None or len(buf) == 0:
+                        break
+                    h.update(buf)
+
+        return h.hexdigest()
+
+    def node_content_hash_compute(self, node: VfsNode):
+        # sha1 of the decompressed contents
+        h = hashlib.sha1()
+        with self.file_obj_from(node) as f:
+            if isinstance(f, MmapFile):
+                h.update(f.view())
+            else:
+                while True:
+                    buf = f.read(1024*10124)
+                    if buf is None or len(buf) == 0:
+                        break
+
+                    h.update(buf)
+        return h.hexdigest()
+
+    def node_content_hash(self, node: VfsNode):
+        # content hashes are only computed up front for nodes with colliding fingerprints, anyone else needing one
+        #  gets it here and it is kept
+        if node.content_hash is None:
+            node.content_hash = self.node_content_hash_compute(node)
+            self.db_execute_one(
+                'UPDATE core_nodes SET content_hash=(?) WHERE node_id=(?)', [node.content_hash, node.uid],
+                dbg='node_content_hash')
+            self.db_commit()
+            self.db_changed_signal.call()
+        return node.content_hash
+
+    def file_obj_from(self, node: VfsNode, copy_out=False):
         compression_type = node.compression_type_get()
 
         if node.file_type == FTYPE_ARC:
-            return open(node.p_path, 'rb')
+            return self.file_obj_from_path(node.p_path, copy_out)
         elif node.file_type == FTYPE_TAB:
-            return self.file_obj_from(self.node_where_uid(node.pid))
+            return self.file_obj_from(self._node_get(node.pid), copy_out)
         elif compression_type in {compression_v3_zlib}:
-            file_name = self.generate_cache_file_name(node)
-            if not os.path.isfile(file_name):
-                parent_node = self.node_where_uid(node.pid)
-                with ArchiveFile(self.file_obj_from(parent_node)) as pf:
-                    pf.seek(node.offset)
-                    buffer_in = pf.read(node.size_c)
-
-                self.logger.log(f'B: id:{node.uid}, pid:{node.pid}, v:{node.v_path}, p:{node.p_path}, cs:{node.size_c}, us:{node.size_u}')
-                buffer_out = extract_aaf(ArchiveFile(io.BytesIO(buffer_in)))
-                self.logger.log(f'E: id:{node.uid}, pid:{node.pid}, v:{node.v_path}, p:{node.p_path}, cs:{node.size_c}, us:{node.size_u}')
-
-                make_dir_for_file(file_name)
-                with open(file_name, 'wb') as fo:
-                    fo.write(buffer_out)
-
-                return io.BytesIO(buffer_out)
-            else:
-                return open(file_name, 'rb')
+            cache_key = self.generate_cache_key(node)
+            f_cache = self.cache_open(cache_key)
+            if f_cache is not None:
+                return f_cache
+
+            parent_node = self._node_get(node.pid)
+            with ArchiveFile(self.file_obj_from(parent_node, copy_out=True)) as pf:
+                pf.seek(node.offset)
+                buffer_in = pf.read(node.size_c)
+
+            self.logger.log(f'B: id:{node.uid}, pid:{node.pid}, v:{node.v_path}, p:{node.p_path}, cs:{node.size_c}, us:{node.size_u}')
+            buffer_out = extract_aaf(ArchiveFile(io.BytesIO(buffer_in)))
+            self.logger.log(f'E: id:{node.uid}, pid:{node.pid}, v:{node.v_path}, p:{node.p_path}, cs:{node.size_c}, us:{node.size_u}')
+
+            self.cache.put(cache_key, buffer_out)
+
+            return io.BytesIO(buffer_out)
 
         elif compression_type in {compression_v4_01_zlib, compression_v4_03_zstd, compression_v4_04_oo}:
-            file_name = self.generate_cache_file_name(node)
-
-            if not os.path.isfile(file_name):
-                parent_node = self.node_where_uid(node.pid)
-                make_dir_for_file(file_name)
-                good_blocks = []
-                bad_blocks = []
-                buffer_out = b''
-
-                blocks = node.blocks_get(self)
-
-                with self.file_obj_from(parent_node) as f_in:
-                    for bi, (block_offset, compressed_len, uncompressed_len) in enumerate(blocks):
-                        f_in.seek(block_offset)
-                        in_buffer = f_in.read(compressed_len)
-
-                        if compression_type in {compression_v4_01_zlib}:
-                            buffer_ret = zlib.decompress(in_buffer)
-                            ret = len(buffer_ret)
-                            # buffer_ret = in_buffer
-                            # ret = compressed_len
-                        elif compression_type in {compression_v4_03_zstd}:
-                            if compressed_len == uncompressed_len:
-                                buffer_ret, ret = in_buffer, len(in_buffer)
-                            else:
-                                dc = zstd.ZstdDecompressor()
-                                buffer_ret = dc.decompress(in_buffer)
-                                ret = len(buffer_ret)
-                        else:
-                            if compressed_len == uncompressed_len:
-                                buffer_ret, ret = in_buffer, len(in_buffer)
-                            else:
-                                buffer_ret, ret = self.decompress_oodle_lz.decompress(
-                                    in_buffer, compressed_len, uncompressed_len)
-
-                        bb = (bi, ret, block_offset, compressed_len, uncompressed_len)
-                        if ret == uncompressed_len:
-                            good_blocks.append(bb)
-                            buffer_out = buffer_out + buffer_ret
-                        else:
-                            bad_blocks.append(bb)
-                            buffer_out = buffer_out + in_buffer
-
-                with open(file_name, 'wb') as f_out:
-                    f_out.write(buffer_out)
-
-                all_blocks = good_blocks + bad_blocks
-                all_blocks.sort()
-                if bad_blocks:
-                    label = 'BAAD'
+            cache_key = self.generate_cache_key(node)
+            f_cache = self.cache_open(cache_key)
+            if f_cache is not None:
+                return f_cache
+
+            parent_node = self._node_get(node.pid)
+            blocks = node.blocks_get(self)
+
+            if node.size_u is not None and node.size_u >= self.block_stream_min_size:
+                def decompress(bi, in_buffer, compressed_len, uncompressed_len):
+                    buffer_ret, ret = self.block_decompress(
+                        compression_type, in_buffer, compressed_len, uncompressed_len)
+                    if ret == uncompressed_len:
+                        return buffer_ret
+                    self.logger.trace('BAAD: ct:{}, cf:{}, sc:{}, su:{}, b:{}, id:{}'.format(
+                        compression_type, node.compression_flag_get(), node.size_c, node.size_u,
+                        (bi, ret, blocks[bi][0], compressed_len, uncompressed_len), node.uid,
+                    ))
+                    return in_buffer
+
+                return BlockFile(
+                    self.file_obj_from(parent_node, copy_out=True), blocks, decompress,
+                    max_cached_blocks=self.block_stream_max_cached_blocks,
+                    executor=self.block_executor_get(compression_type, len(blocks)))
+
+            good_blocks = []
+            bad_blocks = []
+            buffer_out = []
+
+            with self.file_obj_from(parent_node, copy_out=True) as f_in:
+                in_buffers = []
+                for block_offset, compressed_len, uncompressed_len in blocks:
+                    f_in.seek(block_offset)
+                    in_buffers.append(f_in.read(compressed_len))
+
+            executor = self.block_executor_get(compression_type, len(blocks))
+            if executor is None:
+                results = map(self.block_decompress_n, [compression_type] * len(blocks), blocks, in_buffers)
+            else:
+                # decoded blocks land in one preallocated buffer at their final offsets
+                out_offsets = np.cumsum([0] + [b[2] for b in blocks]).tolist()
+                buffer_all = bytearray(out_offsets[-1])
+                results = executor.map(
+                    self.block_decompress_n, [compression_type] * len(blocks), blocks, in_buffers,
+                    [buffer_all] * len(blocks), out_offsets[:-1])
+
+            for bi, ((block_offset, compressed_len, uncompressed_len), in_buffer, (buffer_ret, ret)) in \
+                    enumerate(zip(blocks, in_buffers, results)):
+                bb = (bi, ret, block_offset, compressed_len, uncompressed_len)
+                if ret == uncompressed_len:
+                    good_blocks.append(bb)
+                    if buffer_ret is None:
+                        buffer_ret = memoryview(buffer_all)[out_offsets[bi]:out_offsets[bi + 1]]
+                    buffer_out.append(buffer_ret)
                 else:
-                    label = 'GOOD'
+                    # same as a BlockFile read of it
+                    bad_blocks.append(bb)
+                    buffer_out.append(block_fit(in_buffer, uncompressed_len))
 
-                if bad_blocks:
-                    self.logger.trace('{}: ct:{}, cf:{}, sc:{}, su:{}, bnn:{}, bl:{}, f:{}'.format(
-                        label, node.compression_type_get(), node.compression_flag_get(), node.size_c, node.size_u,
-                        len(blocks) > 0, all_blocks, file_name,
-                    ))
+            if executor is not None and not bad_blocks:
+                buffer_out = buffer_all
+            else:
+                buffer_out = b''.join(buffer_out)
+
+            file_name = self.cache.put(cache_key, buffer_out)
 
-                return io.BytesIO(buffer_out)
+            all_blocks = good_blocks + bad_blocks
+            all_blocks.sort()
+            if bad_blocks:
+                label = 'BAAD'
             else:
-                return open(file_name, 'rb')
+                label = 'GOOD'
+
+            if bad_blocks:
+                self.logger.trace('{}: ct:{}, cf:{}, sc:{}, su:{}, bnn:{}, bl:{}, f:{}'.format(
+                    label, node.compression_type_get(), node.compression_flag_get(), node.size_c, node.size_u,
+                    len(blocks) > 0, all_blocks, file_name,
+                ))
+
+            return io.BytesIO(buffer_out)
 
         elif compression_type != compression_00_none:
             self.logger.log(f'NOT IMPLEMENTED: COMPRESSION TYPE {compression_type}: B: id:{node.uid}, pid:{node.pid}, v:{node.v_path}, p:{node.p_path}, cs:{node.size_c}, us:{node.size_u}')
             raise EDecaUnknownCompressionType(compression_type)
         elif node.file_type == FTYPE_ADF_BARE:
-            parent_node = self.node_where_uid(node.pid)
-            return self.file_obj_from(parent_node)
+            parent_node = self._node_get(node.pid)
+            return self.file_obj_from(parent_node, copy_out)
         elif node.pid is not None:
-            parent_node = self.node_where_uid(node.pid)
-            pf = self.file_obj_from(parent_node)
+            parent_node = self._node_get(node.pid)
+            pf = self.file_obj_from(parent_node, copy_out)
+            if isinstance(pf, (MmapFile, PooledFile)):
+                return pf.subset(node.offset, node.size_u)
             pf.seek(node.offset)
             pf = SubsetFile(pf, node.size_u)
             return pf
         elif node.p_path is not None:
-            return open(node.p_path, 'rb')
+            return self.file_obj_from_path(node.p_path, copy_out)
         else:
             raise Exception('NOT IMPLEMENTED: DEFAULT')
 
@@ -24,6 +24,8 @@ class DbCrossGame(DbBase):
     def __init__(self,  working_dir, logger):
         super().__init__(os.path.join(working_dir, 'cross_game.db'), logger)
 
+        self._strings_known = set()
+
         self.db_execute_one(
             '''
             CREATE TABLE IF NOT EXISTS "field_strings" (
@@ -41,33 +43,25 @@ class DbCrossGame(DbBase):
         # (string, h4, h6, h8, ext_hash32)
         hash_list_str = [(to_str(h[0]), h[1], h[2], h[3], h[4]) for h in hash_list]
         hash_list_str_unique = list(set(hash_list_str))
-        self.db_execute_many(
-            "INSERT OR IGNORE INTO field_strings VALUES (?,?,?,?,?)",
-            hash_list_str_unique,
-            dbg='hash_string_add_many_basic:0:insert'
-        )
-        self.db_conn.commit()
-        self.db_changed_signal.call()
-
-        hash_list_map = {}
-        str_to_row_map = {}
-        for rec in hash_list_str_unique:
-            result = self.db_query_all(
-                "SELECT rowid FROM field_strings WHERE string=(?) and hash32=(?) and hash48=(?) and hash64=(?) and ext_hash32=(?)",
-                rec,
-                dbg='hash_string_add_many_basic:1:select')
+        hash_list_map, n_inserted = self.db_strings_add_many(
+            'field_strings', hash_list_str_unique, dbg='hash_string_add_many_basic')
+        if n_inserted > 0:
+            self.db_changed_signal.call()
 
-            # we expect one and only one match for a hash+string
-            assert len(result) == 1
-            row_id = result[0][0]
-            hash_list_map[rec] = row_id
-            str_to_row_map[to_bytes(rec[0])] = row_id
+        str_to_row_map = dict([(to_bytes(rec[0]), row_id) for rec, row_id in hash_list_map.items()])
 
         return hash_list_str, hash_list_map, str_to_row_map
 
     def hash_string_add_many(self, hash_list):
         # (h4, h6, h8, string, parent_uid, is_field_name, used_at_runtime, p_types)
+
+        # every flush proposes mostly the same field strings, skip the shared db when all of them are already there
+        hash_list = [h for h in hash_list if to_str(h[0]) not in self._strings_known]
+        if not hash_list:
+            return
+
         hash_list_str, hash_list_map, _ = self.hash_string_add_many_basic(hash_list)
+        self._strings_known.update([rec[0] for rec in hash_list_str])
 
         # row_ids = [hash_list_map[rec] for rec in hash_list_str]
         # ref_list = [(r, h[5], h[6], h[7], int(np.int64(np.uint64(h[8])))) for r, h in zip(row_ids, hash_list)]
@@ -76,5 +70,5 @@ class DbCrossGame(DbBase):
         #     "INSERT OR IGNORE INTO core_string_references VALUES (?,?,?,?,?)",
         #     ref_list,
         #     dbg='hash_string_add_many:0:insert')
-        # self.db_conn.commit()
+        # self.db_commit()
         # self.db_changed_signal.call()
\ No newline at end of file
@@ -0,0 +1,234 @@
+import os
+import time
+import uuid
+import numpy as np
+
+
+node_index_fields = \
+    'node_id, parent_id, v_hash, file_type, flags, parent_offset, size_c, size_u, v_path, (p_path IS NOT NULL)'
+
+
+# Columnar (struct of arrays) snapshot of core_nodes, arrays are indexed directly by node_id. It is loaded with one
+#  bulk read and then kept up to date from core_nodes_changes, which triggers on core_nodes fill for every insert,
+#  update and delete, from any connection, while at least one snapshot is registered as a reader. Changes every reader
+#  has seen are deleted, readers not heard from in reader_timeout seconds are dropped and reload when they notice.
+class NodeIndex:
+    def __init__(self, db, chunk_size=64 * 1024, reader_timeout=3600.0):
+        self.db = db
+        self.chunk_size = chunk_size
+        self.reader = '{}:{}'.format(os.getpid(), uuid.uuid4().hex)
+        self.reader_timeout = reader_timeout
+
+        self.seq = None
+        self.capacity = 0
+
+        self.valid = None
+        self.pid = None
+        self.v_hash = None
+        self.v_hash_valid = None
+        self.file_type = None
+        self.flags = None
+        self.offset = None
+        self.size_c = None
+        self.size_u = None
+        self.v_path_id = None
+        self.has_p_path = None
+
+        self.file_type_codes = {}
+        self.file_types = []
+        self.v_path_ids = {}
+        self.v_paths = []
+
+        self.arrays_alloc(0)
+
+    def arrays_alloc(self, capacity):
+        def grow(a, dtype, fill):
+            b = np.full(capacity, fill, dtype=dtype)
+            if a is not None:
+                b[:len(a)] = a
+            return b
+
+        self.valid = grow(self.valid, np.bool_, False)
+        self.pid = grow(self.pid, np.int64, -1)
+        self.v_hash = grow(self.v_hash, np.int64, 0)
+        self.v_hash_valid = grow(self.v_hash_valid, np.bool_, False)
+        self.file_type = grow(self.file_type, np.int32, -1)
+        self.flags = grow(self.flags, np.int64, 0)
+        self.offset = grow(self.offset, np.int64, -1)
+        self.size_c = grow(self.size_c, np.int64, -1)
+        self.size_u = grow(self.size_u, np.int64, -1)
+        self.v_path_id = grow(self.v_path_id, np.int64, -1)
+        self.has_p_path = grow(self.has_p_path, np.bool_, False)
+        self.capacity = capacity
+
+    def file_type_code(self, file_type):
+        if file_type is None:
+            return -1
+        code = self.file_type_codes.get(file_type, None)
+        if code is None:
+            code = len(self.file_types)
+            self.file_type_codes[file_type] = code
+            self.file_types.append(file_type)
+        return code
+
+    def v_path_intern(self, v_path):
+        if v_path is None:
+            return -1
+        if isinstance(v_path, str):
+            v_path = v_path.encode('utf-8')
+        vid = self.v_path_ids.get(v_path, None)
+        if vid is None:
+            vid = len(self.v_paths)
+            self.v_path_ids[v_path] = vid
+            self.v_paths.append(v_path)
+        return vid
+
+    def rows_apply(self, rows):
+        if not rows:
+            return
+
+        cols = list(zip(*rows))
+        uids = np.array(cols[0], dtype=np.int64)
+
+        uid_max = int(uids.max())
+        if uid_max >= self.capacity:
+            self.arrays_alloc(max(uid_max + 1, self.capacity * 2))
+
+        def as_int(col):
+            return np.array([-1 if v is None else v for v in col], dtype=np.int64)
+
+        self.valid[uids] = True
+        self.pid[uids] = as_int(cols[1])
+        self.v_hash[uids] = np.array([0 if v is None else v for v in cols[2]], dtype=np.int64)
+        self.v_hash_valid[uids] = np.array([v is not None for v in cols[2]], dtype=np.bool_)
+        self.file_type[uids] = np.array([self.file_type_code(v) for v in cols[3]], dtype=np.int32)
+        self.flags[uids] = np.array([0 if v is None else v for v in cols[4]], dtype=np.int64)
+        self.offset[uids] = as_int(cols[5])
+        self.size_c[uids] = as_int(cols[6])
+        self.size_u[uids] = as_int(cols[7])
+        self.v_path_id[uids] = np.array([self.v_path_intern(v) for v in cols[8]], dtype=np.int64)
+        self.has_p_path[uids] = np.array(cols[9], dtype=np.bool_)
+
+    def seq_last(self):
+        r = self.db.db_query_one(
+            "SELECT seq FROM sqlite_sequence WHERE name='core_nodes_changes'", dbg='node_index:seq_last')
+        if r is None:
+            return 0
+        return r[0]
+
+    def reader_registered(self):
+        r = self.db.db_query_one(
+            'SELECT 1 FROM core_node_index_readers WHERE reader=(?)', [self.reader], dbg='node_index:registered')
+        return r is not None
+
+    def compact(self):
+        t = time.time()
+        with self.db.db_transaction(dbg='node_index:compact'):
+            self.db.db_execute_one(
+                'INSERT OR REPLACE INTO core_node_index_readers VALUES (?,?,?)', [self.reader, self.seq, t],
+                dbg='node_index:reader_update')
+            self.db.db_execute_one(
+                'DELETE FROM core_node_index_readers WHERE time < (?)', [t - self.reader_timeout],
+                dbg='node_index:reader_expire')
+            self.db.db_execute_one(
+                'DELETE FROM core_nodes_changes WHERE seq <= (SELECT MIN(seq) FROM core_node_index_readers)',
+                dbg='node_index:compact')
+
+    def load(self):
+        t0 = time.time()
+
+        # registered first, so the triggers log every change made after the table is read
+        with self.db.db_transaction(dbg='node_index:register'):
+            self.db.db_execute_one(
+                'INSERT OR REPLACE INTO core_node_index_readers VALUES (?,?,?)', [self.reader, self.seq_last(), t0],
+                dbg='node_index:register')
+
+        self.valid[:] = False
+        seq = self.seq_last()
+        count = 0
+        cur = self.db.db_conn.cursor()
+        cur.execute(f'SELECT {node_index_fields} FROM core_nodes')
+        while True:
+            rows = cur.fetchmany(self.chunk_size)
+            if not rows:
+                break
+            self.rows_apply(rows)
+            count += len(rows)
+        cur.close()
+        self.seq = seq
+
+        self.compact()
+
+        self.db.logger.log('NODE INDEX: Loaded {} nodes in {:0.3f}s'.format(count, time.time() - t0))
+
+    def detach(self):
+        if self.seq is None:
+            return
+        with self.db.db_transaction(dbg='node_index:detach'):
+            self.db.db_execute_one(
+                'DELETE FROM core_node_index_readers WHERE reader=(?)', [self.reader], dbg='node_index:detach')
+            self.db.db_execute_one(
+                'DELETE FROM core_nodes_changes WHERE seq <= (SELECT COALESCE(MIN(seq), (?)) FROM core_node_index_readers)',
+                [self.seq_last()], dbg='node_index:detach_compact')
+        self.seq = None
+
+    def sync(self):
+        if self.seq is None or not self.reader_registered():
+            # dropped as a reader, changes may have gone unlogged since
+            self.load()
+            return
+
+        seq = self.seq_last()
+        if seq == self.seq:
+            return
+
+        seq_min = self.db.db_query_one('SELECT MIN(seq) FROM core_nodes_changes', dbg='node_index:seq_min')[0]
+        if seq_min is None or seq_min > self.seq + 1:
+            # changes were compacted away before we saw them
+            self.load()
+            return
+
+        uids = self.db.db_query_all(
+            'SELECT DISTINCT node_id FROM core_nodes_changes WHERE seq > (?) AND seq <= (?)',
+            [self.seq, seq], dbg='node_index:changes')
+        uids = np.array([v[0] for v in uids], dtype=np.int64)
+        uids = uids[uids < self.capacity]
+        self.valid[uids] = False
+
+        rows = self.db.db_query_all(
+            f'SELECT {node_index_fields} FROM core_nodes WHERE node_id IN '
+            '(SELECT node_id FROM core_nodes_changes WHERE seq > (?) AND seq <= (?))',
+            [self.seq, seq], dbg='node_index:rows')
+        self.rows_apply(rows)
+        self.seq = seq
+
+        self.compact()
+
+    def select(self, flag_mask=0, flag_value=0, file_types=None, has_any_path=None, v_hashes=None):
+        self.sync()
+
+        sel = self.valid.copy()
+        if flag_mask:
+            sel &= (self.flags & flag_mask) == flag_value
+        if file_types is not None:
+            codes = [self.file_type_codes.get(ft, -2) if ft is not None else -1 for ft in file_types]
+            sel &= np.isin(self.file_type, codes)
+        if has_any_path is not None:
+            any_path = (self.v_path_id >= 0) | self.has_p_path
+            if has_any_path:
+                sel &= any_path
+            else:
+                sel &= ~any_path
+        if v_hashes is not None:
+            sel &= self.v_hash_valid & np.isin(self.v_hash, np.array(list(v_hashes), dtype=np.int64))
+
+        return np.flatnonzero(sel)
+
+    def select_uid_v_hash_processed(self, flag, **kwargs):
+        uids = self.select(**kwargs)
+        v_hashes = self.v_hash[uids].tolist()
+        v_hash_valid = self.v_hash_valid[uids].tolist()
+        processed = ((self.flags[uids] & flag) == flag).astype(np.int64).tolist()
+        return [
+            (uid, v_hash if ok else None, p)
+            for uid, v_hash, ok, p in zip(uids.tolist(), v_hashes, v_hash_valid, processed)]
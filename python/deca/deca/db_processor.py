@@ -3,6 +3,9 @@ import re
 import csv
 import time
 import sys
+import hashlib
+import numpy as np
+import zstandard as zstd
 
 from .file import ArchiveFile
 from .db_types import *
@@ -14,11 +17,57 @@ from .ff_types import *
 from .ff_adf import AdfDatabase
 from .util import Logger, make_dir_for_file, deca_root
 from .digest import process_translation_adf
+from .hash_crack import CrackMemo, crack_rules_mine, hash_crack
 
 
 STATUS_UPDATE_TIME_S = 5.0
 
 
+class ContentReuse:
+    # results of a command that only depend on the node's content, they can be copied to every node with the same
+    #  content_hash and the same key_columns from a node carrying flag. columns are copied from that node, columns_fill
+    #  only where empty, flags_mask selects the bits of its flags that are copied
+    def __init__(self, flag, key_columns=('file_type',), columns=(), columns_fill=(), flags_mask=0, children=False):
+        self.flag = flag
+        self.key_columns = key_columns
+        self.columns = columns
+        self.columns_fill = columns_fill
+        self.flags_mask = flags_mask
+        self.children = children
+
+
+content_reuse_commands = {
+    # AAF detection changes the compression of the node itself, the file type is then that of the contents. the
+    #  content hash is over the decompressed bytes, so the fingerprint keeps copies stored another way apart
+    'process_file_type_find_no_name': ContentReuse(
+        node_flag_processed_file_raw_no_name, key_columns=('fingerprint',),
+        columns=('file_type', 'file_sub_type', 'magic', 'size_u'),
+        flags_mask=node_flag_compression_type_mask | node_flag_compression_flag_mask),
+    # self naming compares generated names with the node's own v_hash
+    'process_adf_initial': ContentReuse(
+        node_flag_processed_file_type, key_columns=('file_type', 'v_hash'), columns_fill=('v_path',)),
+    'process_rtpc_initial': ContentReuse(node_flag_processed_file_type),
+    'process_gfx_initial': ContentReuse(node_flag_processed_file_type),
+    'process_txt_initial': ContentReuse(node_flag_processed_file_type),
+    'process_sarc': ContentReuse(node_flag_processed_file_type, children=True),
+}
+
+
+def physical_file_fingerprint(path, size, sample_size=64 * 1024, sample_count=16):
+    # small files are hashed whole, large ones (archives) by evenly spaced samples. only consulted when the size is
+    #  unchanged but the mtime moved, to tell a rewritten file from a patched one
+    h = hashlib.sha1(str(size).encode('ascii'))
+    with open(path, 'rb') as f:
+        if size <= sample_size * sample_count:
+            h.update(f.read())
+        else:
+            step = (size - sample_size) // (sample_count - 1)
+            for i in range(sample_count):
+                f.seek(i * step)
+                h.update(f.read(sample_size))
+    return h.hexdigest()
+
+
 def none_to_str(v):
     if v is None:
         return ''
@@ -82,10 +131,23 @@ def game_file_to_sortable_string(v):
 
 class VfsProcessor(VfsDatabase):
     def __init__(self, project_file, working_dir, logger):
-        VfsDatabase.__init__(self, project_file, working_dir, logger, init_display=True)
+        VfsDatabase.__init__(self, project_file, working_dir, logger, init_display=True, use_node_index=True)
         self.last_status_update = None
         self.process_time_start = None
         self.process_time_last = None
+        self._commander = None
+        # candidates find_vpath_crack may hash per phase
+        self.crack_budget = 16 * 1024 * 1024
+        self.crack_memo = CrackMemo()
+        # keep generated names that matched no file hash in working_dir/candidates_unmatched for later runs
+        self.candidates_unmatched_keep = True
+        self.quarantine_strikes = 2
+        self.reuse_count = 0
+        # fingerprint the stored bytes first and only decompress for the content hash when fingerprints collide
+        self.content_hash_lazy = True
+        # hand out nodes in the order they sit in their files rather than most expensive first. opt in per project
+        #  with "locality_order": true in project.json, tool_db_benchmark locality measures the gain on a game
+        self.locality_order = bool(self.game_info.locality_order)
 
     def log(self, msg):
         self.logger.log(msg)
@@ -99,17 +161,18 @@ class VfsProcessor(VfsDatabase):
             self.last_status_update = curr_time
             self.log('Completed {} of {}'.format(i, n))
 
-    def find_initial_files(self, debug=False):
+    def initial_files_find(self):
+        # root nodes of the game install and the physical files each one is read from
         self.logger.log('Add EXE files')
 
-        initial_nodes = []
+        initial_files = []
 
         exe_path = os.path.join(self.game_info.game_dir, self.game_info.exe_name)
         f_size = os.stat(exe_path).st_size
         node = VfsNode(
             v_hash_type=self.file_hash_type,
             file_type=FTYPE_EXE, p_path=exe_path, size_u=f_size, size_c=f_size, offset=0)
-        initial_nodes.append(node)
+        initial_files.append((node, [exe_path]))
 
         self.logger.log('Add unarchived files')
         for ua_file in self.game_info.unarchived_files():
@@ -119,11 +182,11 @@ class VfsProcessor(VfsDatabase):
             node = VfsNode(
                 v_hash_type=self.file_hash_type,
                 v_hash=v_hash, v_path=v_path, p_path=ua_file, size_u=f_size, size_c=f_size, offset=0)
-            initial_nodes.append(node)
+            initial_files.append((node, [ua_file]))
 
         self.logger.log('Add TAB / ARC files')
         input_files = []
-        dir_in = self.game_info.archive_paths()
+        dir_in = list(self.game_info.archive_paths())
         dir_found = []
 
         while len(dir_in) > 0:
@@ -155,9 +218,90 @@ class VfsProcessor(VfsDatabase):
             node = VfsNode(
                 v_hash_type=self.file_hash_type,
                 file_type=FTYPE_ARC, p_path=file_arc, size_u=f_size, size_c=f_size, offset=0)
-            initial_nodes.append(node)
+            initial_files.append((node, [file_arc, inpath + '.tab']))
 
-        self.nodes_add_many(initial_nodes)
+        return initial_files
+
+    def find_initial_files(self, debug=False):
+        initial_files = self.initial_files_find()
+        self.nodes_add_many([node for node, _ in initial_files])
+        self.physical_files_record(initial_files)
+
+    def physical_files_record(self, initial_files):
+        records = []
+        for node, p_paths in initial_files:
+            for p_path in p_paths:
+                st = os.stat(p_path)
+                records.append((
+                    p_path, node.p_path, st.st_size, st.st_mtime_ns, physical_file_fingerprint(p_path, st.st_size)))
+        self.physical_files_set(records)
+
+    def process_physical_file_changes(self):
+        # invalidate the subtrees of root files that were added, removed or patched since they were processed.
+        #  returns True if anything has to be processed again
+        initial_files = dict([(node.p_path, (node, p_paths)) for node, p_paths in self.initial_files_find()])
+        known = self.physical_files_select()
+
+        if not known:
+            # project processed before files were tracked, take the current state as the baseline
+            self.logger.log('CHANGES: No file state recorded, recording current state')
+            self.physical_files_record(initial_files.values())
+            return False
+
+        known_roots = {}
+        for p_path, (root_p_path, size, mtime_ns, fingerprint) in known.items():
+            known_roots.setdefault(root_p_path, []).append(p_path)
+
+        added = [root for root in initial_files if root not in known_roots]
+        removed = [root for root in known_roots if root not in initial_files]
+        modified = []
+        touched = []
+        for root, (node, p_paths) in initial_files.items():
+            if root not in known_roots:
+                continue
+            if set(p_paths) != set(known_roots[root]):
+                modified.append(root)
+                continue
+            for p_path in p_paths:
+                _, size, mtime_ns, fingerprint = known[p_path]
+                st = os.stat(p_path)
+                if st.st_size != size:
+                    modified.append(root)
+                    break
+                elif st.st_mtime_ns != mtime_ns:
+                    if physical_file_fingerprint(p_path, st.st_size) != fingerprint:
+                        modified.append(root)
+                        break
+                    touched.append((p_path, root, size, st.st_mtime_ns, fingerprint))
+
+        if touched:
+            self.physical_files_set(touched)
+
+        if not (added or removed or modified):
+            self.logger.log('CHANGES: None, {} files touched but identical'.format(len(touched)))
+            return False
+
+        stale_roots = removed + modified
+        root_uids = []
+        for root in stale_roots:
+            root_uids += [r[0] for r in self.db_query_all(
+                'SELECT node_id FROM core_nodes WHERE parent_id IS NULL AND p_path=(?)', [root],
+                dbg='process_physical_file_changes:roots')]
+        counts = self.nodes_delete_subtrees(root_uids)
+        self.physical_files_delete([p_path for root in stale_roots for p_path in known_roots[root]])
+
+        fresh = [initial_files[root] for root in added + modified]
+        self.nodes_add_many([node for node, _ in fresh])
+        self.physical_files_record(fresh)
+
+        for name, roots in [('Added', added), ('Removed', removed), ('Modified', modified)]:
+            for root in roots:
+                self.logger.log('CHANGES: {}: {}'.format(name, root))
+        self.logger.log('CHANGES: {} added, {} removed, {} modified, {} touched but identical'.format(
+            len(added), len(removed), len(modified), len(touched)))
+        self.logger.log('CHANGES: Invalidated {}'.format(', '.join(['{} {}'.format(v, k) for k, v in counts.items()])))
+
+        return True
 
     def load_equipment_info(self):
         if self.game_info.game_id == 'gz':
@@ -239,7 +383,132 @@ class VfsProcessor(VfsDatabase):
             self.process_time_last = t_curr
             self.logger.log(f"ELAPSED TIME: {t_curr - self.process_time_start:.0f} seconds")
 
+    def commander_get(self):
+        # inside process() all phases share one pool of worker processes
+        if self._commander is not None:
+            return self._commander
+        return MultiProcessControl(self.project_file, self.working_dir, self.logger)
+
+    def nodes_do_map(self, cmd, indexes, step_id):
+        # quarantined nodes are left out, nodes with strikes run in chunks of their own
+        self.node_cache_sync()
+        strikes = self.node_strikes_select()
+        quarantined = [uid for uid in indexes if strikes.get(uid, (0, None))[0] >= self.quarantine_strikes]
+        if quarantined:
+            self.logger.warning('QUARANTINE: {}: skipping {} nodes'.format(step_id, len(quarantined)))
+            quarantined = set(quarantined)
+            indexes = [uid for uid in indexes if uid not in quarantined]
+        suspects = set([uid for uid in indexes if uid in strikes])
+
+        # nodes whose content was processed already take those results, of the rest only one per content is processed
+        reused = []
+        waiting = []
+        if cmd in content_reuse_commands:
+            reused, indexes, waiting = self.nodes_results_reuse(cmd, indexes)
+
+        results = []
+        if indexes:
+            commander = self.commander_get()
+            results = commander.do_map(
+                cmd, indexes, step_id=step_id, idle_call=self.idle_call,
+                costs=self.nodes_select_cost_hint(indexes), isolate=suspects, journal=self,
+                locality=self.nodes_select_locality_hint(indexes) if self.locality_order else None)
+            # the workers' results were committed by the batch writer's connection
+            self.node_cache_sync()
+
+        # nodes with strikes that came through are cleared, a node that failed alone has None as its result
+        strikes = self.node_strikes_select()
+        cleared = [uid for uid, v in results if v is not None and uid in strikes]
+        if cleared:
+            self.node_strikes_clear(cleared)
+
+        if waiting:
+            # what is still left had a node with the same content fail, it is tried again next pass
+            reused_after, _, _ = self.nodes_results_reuse(cmd, waiting)
+            reused += reused_after
+
+        if reused:
+            self.reuse_count += len(reused)
+            self.logger.log('REUSE: {}: {} nodes took the results of a node with the same content'.format(
+                step_id, len(reused)))
+
+        return results + [(uid, True) for uid in reused]
+
+    def nodes_results_reuse(self, cmd, uids):
+        # returns the uids that took the results of an already processed node with the same content, the uids to
+        #  process (one per content) and the uids waiting on those
+        reuse: ContentReuse = content_reuse_commands[cmd]
+        keys, donors = self.nodes_select_reuse_info(uids, reuse.flag, reuse.key_columns)
+
+        pairs = []
+        todo = []
+        waiting = []
+        keys_todo = set()
+        for uid in uids:
+            key = keys.get(uid, None)
+            if key is None:
+                todo.append(uid)
+            elif key in donors:
+                pairs.append((donors[key], uid))
+            elif key in keys_todo:
+                waiting.append(uid)
+            else:
+                keys_todo.add(key)
+                todo.append(uid)
+
+        if pairs:
+            self.nodes_results_clone(
+                pairs, reuse.flag, reuse.columns, reuse.columns_fill, reuse.flags_mask, reuse.children)
+
+        return [uid for _, uid in pairs], todo, waiting
+
+    def journal_chunk_begin(self, cmd, uids):
+        return self.process_chunk_begin(cmd, uids)
+
+    def journal_chunk_end(self, chunk_id):
+        self.process_chunk_end(chunk_id)
+
+    def journal_chunk_crashed(self, chunk_id, reason):
+        # every node of the chunk is a suspect, alone they either pass or earn the strike that quarantines them
+        for chunk_id_, cmd, uids in self.process_chunks_select():
+            if chunk_id_ == chunk_id:
+                self.node_strikes_add(uids, reason)
+        self.process_chunk_end(chunk_id)
+
+    def journal_node_failed(self, uid, reason):
+        self.node_strikes_add([uid], reason)
+
+    def process_chunks_recover(self):
+        # chunks still recorded as in flight were running when an earlier run died without stopping its workers
+        chunks = self.process_chunks_select()
+        for chunk_id, cmd, uids in chunks:
+            self.logger.warning('RESUME: chunk {} of {} with {} nodes was interrupted'.format(chunk_id, cmd, len(uids)))
+            self.journal_chunk_crashed(chunk_id, 'run died in {}'.format(cmd))
+        return len(chunks)
+
+    def process_step_once(self, name, func):
+        if self.process_checkpoint_get(name):
+            self.logger.log('RESUME: {} already done'.format(name))
+            return
+        func()
+        self.process_checkpoint_set(name)
+
     def process(self, debug=False):
+        self.process_chunks_recover()
+        if self.game_info.cache_dir is None:
+            # the default dir is where the old path keyed cache was written. removed here, before any worker runs,
+            #  rather than by every process that opens the db
+            self.cache.legacy_remove()
+        self._commander = MultiProcessControl(self.project_file, self.working_dir, self.logger, persistent=True)
+        try:
+            self.process_run(debug)
+        finally:
+            self._commander.stop()
+            self._commander = None
+            # stopped in an orderly way (done, interrupted, failed with a report), what was in flight is not suspect
+            self.process_chunks_clear()
+
+    def process_run(self, debug=False):
         self.process_time_start = time.time()
         self.process_time_last = 0.0
 
@@ -287,18 +556,24 @@ class VfsProcessor(VfsDatabase):
             self.db_reset()
             self.db_execute_one("PRAGMA user_version = 1;")
             self.find_initial_files(debug=debug)
+        elif self.process_physical_file_changes() and version >= 2:
+            # only the invalidated subtrees are unprocessed, the loop below skips everything else
+            version = 1
+            self.db_execute_one("PRAGMA user_version = 1;")
 
         self.process_remove_temporary_nodes()
 
         if version < 2:
-            self.find_vpath_procmon_dir()
-            self.find_vpath_resources()
-            self.find_vpath_guess()
+            self.process_step_once('find_vpath_procmon_dir', self.find_vpath_procmon_dir)
+            self.process_step_once('find_vpath_resources', self.find_vpath_resources)
 
             # success = [set() for _ in inner_loop]
             # failed = [set() for _ in inner_loop]
 
-            outer_phase_id = 0
+            # nodes carry their own processed flags, so a resumed run only picks up what is left of the phase
+            outer_phase_id = self.process_checkpoint_get('outer_phase') or 0
+            if outer_phase_id:
+                self.logger.log('RESUME: Continuing after phase {}'.format(outer_phase_id))
 
             do_process_v_hashes = True
             while True:
@@ -325,8 +600,13 @@ class VfsProcessor(VfsDatabase):
 
                 if do_process_v_hashes:
                     do_process_v_hashes = False
+                    # generated names are only kept when they hash to a file, so they are tried again as files appear
+                    self.find_vpath_unmatched()
+                    self.find_vpath_guess()
                     self.find_vpath_by_assoc()
-                    self.process_all_vhashes('process_vhash_final')
+                    self.find_vpath_crack()
+                    self.process_vhash_final_all()
+                    self.process_checkpoint_set('outer_phase', outer_phase_id)
                     self.logger.log('Phase {}: End'.format(outer_phase_id))
                 else:
                     self.logger.log('Phase {}: End'.format(outer_phase_id))
@@ -334,6 +614,7 @@ class VfsProcessor(VfsDatabase):
 
             self.update_used_depths()
             self.db_execute_one("PRAGMA user_version = 2;")
+            self.process_checkpoints_clear()
 
             self.dump_vpaths()
 
@@ -343,16 +624,22 @@ class VfsProcessor(VfsDatabase):
 
         self.dump_status()
 
+        self.logger.log('SUMMARY: Content reuse: {} parses skipped'.format(self.reuse_count))
         self.logger.log('PROCESSING: COMPLETE')
 
     def dump_vpaths(self):
         vpath_file = os.path.join(self.working_dir, 'vpaths.txt')
-        vpaths = self.nodes_select_distinct_vpath_content_hash()
-        vpaths = [(none_to_str(v[0]), none_to_str(v[1])) for v in vpaths]
-        vpaths = list(set(vpaths))
-        vpaths = sorted(vpaths)
         if not os.path.isfile(vpath_file):
             self.logger.log('CREATING: vpaths.txt')
+            # with content_hash_lazy only nodes sharing a fingerprint have a content hash, the named nodes still
+            #  without one are hashed now so every line of vpaths.txt carries its hash
+            indexes = self.nodes_select_named_content_hash_missing()
+            if indexes:
+                self.nodes_do_map('process_hash_file_contents', indexes, step_id='Determine content hash for vpaths.txt')
+            vpaths = self.nodes_select_distinct_vpath_content_hash()
+            vpaths = [(none_to_str(v[0]), none_to_str(v[1])) for v in vpaths]
+            vpaths = list(set(vpaths))
+            vpaths = sorted(vpaths)
             with open(vpath_file, 'w') as f:
                 for v_path, content_hash in vpaths:
                     f.write('{}\t{}\n'.format(v_path, content_hash))
@@ -470,26 +757,36 @@ class VfsProcessor(VfsDatabase):
     def process_no_content_hash(self, f_type, cmd):
         self.logger.log('PROCESS: Determine content hash: Begin'.format())
 
-        indexes = self.nodes_where_match(
-            content_hash_empty=True,
-            uid_only=True
-        )
+        results = []
+        n_fingerprinted = 0
+        if self.content_hash_lazy:
+            indexes = self.nodes_select_fingerprint_missing()
+            if indexes:
+                fp_results = self.nodes_do_map(
+                    'process_fingerprint_file_contents', indexes, step_id='Determine content fingerprint')
+                n_fingerprinted = len([k for k, v in fp_results if v])
+                results += fp_results
+
+            indexes = self.nodes_select_fingerprint_collisions()
+        else:
+            indexes = self.nodes_where_match(
+                content_hash_empty=True,
+                uid_only=True
+            )
         done_set = set()
 
-        indexes_processed = []
-        indexes_success = []
-        indexes_failed = []
         if indexes:
-            commander = MultiProcessControl(self.project_file, self.working_dir, self.logger)
-            results = commander.do_map(cmd, indexes, step_id='Determine content hash', idle_call=self.idle_call)
+            results += self.nodes_do_map(cmd, indexes, step_id='Determine content hash')
 
-            indexes_processed = [k for k, v in results]
-            indexes_success = [k for k, v in results if v]
-            indexes_failed = [k for k, v in results if not v]
+        indexes_processed = [k for k, v in results]
+        indexes_success = [k for k, v in results if v]
+        indexes_failed = [k for k, v in results if not v]
 
         self.logger.log(
-            'PROCESS: Determine content hash: End: Already Processed: {}, Additional: {}, Success: {}, Failed: {}'.format(
-                len(done_set), len(indexes_processed), len(indexes_success), len(indexes_failed)
+            'PROCESS: Determine content hash: End: Already Processed: {}, Additional: {}, Success: {}, Failed: {}, '
+            'Fingerprinted: {}, Hashed: {}'.format(
+                len(done_set), len(indexes_processed), len(indexes_success), len(indexes_failed),
+                n_fingerprinted, len(indexes_success) - n_fingerprinted,
             )
         )
 
@@ -508,8 +805,7 @@ class VfsProcessor(VfsDatabase):
         indexes_success = []
         indexes_failed = []
         if indexes:
-            commander = MultiProcessControl(self.project_file, self.working_dir, self.logger)
-            results = commander.do_map(cmd, indexes, step_id='Determine file type', idle_call=self.idle_call)
+            results = self.nodes_do_map(cmd, indexes, step_id='Determine file type')
 
             indexes_processed = [k for k, v in results]
             indexes_success = [k for k, v in results if v]
@@ -537,8 +833,7 @@ class VfsProcessor(VfsDatabase):
         indexes_success = []
         indexes_failed = []
         if indexes:
-            commander = MultiProcessControl(self.project_file, self.working_dir, self.logger)
-            results = commander.do_map(cmd, indexes, step_id='Determine file type with name', idle_call=self.idle_call)
+            results = self.nodes_do_map(cmd, indexes, step_id='Determine file type with name')
 
             indexes_processed = [k for k, v in results]
             indexes_success = [k for k, v in results if v]
@@ -562,8 +857,7 @@ class VfsProcessor(VfsDatabase):
         indexes_success = []
         indexes_failed = []
         if indexes:
-            commander = MultiProcessControl(self.project_file, self.working_dir, self.logger)
-            results = commander.do_map(cmd, indexes, step_id=f_type, idle_call=self.idle_call)
+            results = self.nodes_do_map(cmd, indexes, step_id=f_type)
 
             indexes_processed = [k for k, v in results]
             indexes_success = [k for k, v in results if v]
@@ -587,8 +881,7 @@ class VfsProcessor(VfsDatabase):
         indexes_success = []
         indexes_failed = []
         if indexes:
-            commander = MultiProcessControl(self.project_file, self.working_dir, self.logger)
-            results = commander.do_map(cmd, indexes, step_id=f'v_hash = {v_hash}', idle_call=self.idle_call)
+            results = self.nodes_do_map(cmd, indexes, step_id=f'v_hash = {v_hash}')
 
             indexes_processed = [k for k, v in results]
             indexes_success = [k for k, v in results if v]
@@ -612,8 +905,7 @@ class VfsProcessor(VfsDatabase):
         indexes_success = []
         indexes_failed = []
         if indexes:
-            commander = MultiProcessControl(self.project_file, self.working_dir, self.logger)
-            results = commander.do_map(cmd, indexes, step_id=f'ext_hash = {ext_hash}', idle_call=self.idle_call)
+            results = self.nodes_do_map(cmd, indexes, step_id=f'ext_hash = {ext_hash}')
 
             indexes_processed = [k for k, v in results]
             indexes_success = [k for k, v in results if v]
@@ -633,8 +925,7 @@ class VfsProcessor(VfsDatabase):
         indexes_success = []
         indexes_failed = []
         if indexes:
-            commander = MultiProcessControl(self.project_file, self.working_dir, self.logger)
-            results = commander.do_map(cmd, indexes, step_id=f'endswith = {suffix}', idle_call=self.idle_call)
+            results = self.nodes_do_map(cmd, indexes, step_id=f'endswith = {suffix}')
 
             indexes_processed = [k for k, v in results]
             indexes_success = [k for k, v in results if v]
@@ -649,10 +940,19 @@ class VfsProcessor(VfsDatabase):
         self.logger.log('PROCESS: VHASHes: Begin')
         vhashes = self.nodes_select_distinct_vhash()
         if len(vhashes) > 0:
-            commander = MultiProcessControl(self.project_file, self.working_dir, self.logger)
+            commander = self.commander_get()
             commander.do_map(cmd, vhashes, step_id='v_hash', idle_call=self.idle_call)
         self.logger.log('PROCESS: VHASHes: End: Total VHASHes {}'.format(len(vhashes)))
 
+    def process_vhash_final_all(self):
+        # process_all_vhashes('process_vhash_final') as a few joins in this process instead of queries per v_hash
+        self.logger.log('PROCESS: VHASHes: Begin')
+        t0 = time.time()
+        counts = self.nodes_vhash_resolve()
+        self.logger.log('PROCESS: VHASHes: End: Named {named}, Used at runtime {runtime}, File types {file_type}, '
+                        'Ext hashes {ext_hash}, Skipped refs {skipped_refs}, '.format(**counts) +
+                        '{:0.1f} seconds'.format(time.time() - t0))
+
     def find_vpath_procmon_dir(self):
         path_name = os.path.join(deca_root(), 'procmon_csv', '{}'.format(self.game_info.game_id))
 
@@ -804,13 +1104,13 @@ class VfsProcessor(VfsDatabase):
             fn = 'text/master_{}.stringlookup'.format(lng)
             guess_strings[fn] = [FTYPE_ADF, FTYPE_ADF_BARE]
 
+        hash_present = self.nodes_select_distinct_vhash()
+        unmatched = []
         with DbWrap(self, logger=self) as db:
-            for k, v in guess_strings.items():
-                fn = k
-                fn = fn.encode('ascii')
-                db.propose_string(fn, None, possible_file_types=v)
+            matched = db.propose_candidates(guess_strings, hash_present, unmatched=unmatched)
+        self.candidates_unmatched_save('guess', unmatched)
 
-        self.logger.log('STRINGS BY GUESSING: Total {} guesses'.format(len(guess_strings)))
+        self.logger.log('STRINGS BY GUESSING: Total {} guesses, {} matched'.format(len(guess_strings), len(matched)))
 
     def find_vpath_by_assoc(self):
         self.logger.log('STRINGS BY FILE NAME ASSOCIATION: epe/ee, blo/bl/nl/fl/nl.mdic/fl.mdic, mesh*/model*, avtx/atx?]')
@@ -844,46 +1144,106 @@ class VfsProcessor(VfsDatabase):
                 nf = b'textures/hp_ai_textures/' + mr.group(1) + b'_user.ddsc'
                 assoc_strings[nf] = [FTYPE_DDS, FTYPE_AVTX]
 
-        hash_present = set(self.nodes_select_distinct_vhash())
-
+        hash_present = self.nodes_select_distinct_vhash()
+        unmatched = []
         with DbWrap(self, logger=self) as db:
-            for k, v in assoc_strings.items():
-                fn = k
-                fh = self.file_hash(fn)
-                if fh in hash_present:
-                    db.propose_string(fn, None, possible_file_types=v)
+            matched = db.propose_candidates(assoc_strings, hash_present, unmatched=unmatched)
+        self.candidates_unmatched_save('assoc', unmatched)
+
+        self.logger.log('STRINGS BY FILE NAME ASSOCIATION: Found {}, {} matched'.format(
+            len(assoc_strings), len(matched)))
+
+    def candidates_unmatched_save(self, label, names):
+        # names is [(name, possible file types)], one line per name: the name, a tab and the types comma separated
+        if not self.candidates_unmatched_keep:
+            return
+        lines = set()
+        for name, possible_file_types in names:
+            if possible_file_types is None:
+                possible_file_types = []
+            elif not isinstance(possible_file_types, list):
+                possible_file_types = [possible_file_types]
+            lines.add(name + b'\t' + ','.join(possible_file_types).encode('ascii'))
+        fn = os.path.join(self.working_dir, 'candidates_unmatched', '{}.txt.zst'.format(label))
+        make_dir_for_file(fn)
+        with open(fn, 'wb') as f:
+            f.write(zstd.ZstdCompressor().compress(b'\n'.join(sorted(lines))))
+
+    def candidates_unmatched_load(self):
+        # {name: possible file types or None}
+        candidates = {}
+        path = os.path.join(self.working_dir, 'candidates_unmatched')
+        if os.path.isdir(path):
+            for fn in sorted(os.listdir(path)):
+                with open(os.path.join(path, fn), 'rb') as f:
+                    lines = zstd.ZstdDecompressor().decompress(f.read()).split(b'\n')
+                for line in lines:
+                    name, _, possible_file_types = line.partition(b'\t')
+                    if not name:
+                        continue
+                    if possible_file_types:
+                        candidates[name] = possible_file_types.decode('ascii').split(',')
+                    else:
+                        candidates[name] = None
+        return candidates
 
-        self.logger.log('STRINGS BY FILE NAME ASSOCIATION: Found {}'.format(len(assoc_strings)))
+    def find_vpath_unmatched(self):
+        # names generated earlier that matched nothing then may match files added since, they are checked again
+        #  with the file types they were generated for
+        candidates = self.candidates_unmatched_load()
+        if not candidates:
+            return
 
-    def update_used_depths(self):
-        level = 0
-        keep_going = True
-        while keep_going:
-            keep_going = False
-            self.logger.log('UPDATING USE DEPTH: {}'.format(level))
-            # puids = self.db_query_all("SELECT uid FROM core_nodes WHERE used_at_runtime_depth == (?)", [level])
-            # puids = [n[0] for n in puids]
-            #
-            # if len(puids) == 0:
-            #     break
-
-            child_nodes = self.db_query_all(
-                """
-                SELECT * FROM core_nodes WHERE 
-                    parent_id IN (SELECT node_id FROM core_nodes WHERE used_at_runtime_depth == (?))
-                """,
-                [level]
-            )
-            child_nodes = [db_to_vfs_node(n) for n in child_nodes]
+        hash_present = self.nodes_select_distinct_vhash()
+        with DbWrap(self, logger=self) as db:
+            matched = db.propose_candidates(candidates, hash_present)
+
+        self.logger.log('STRINGS BY EARLIER CANDIDATES: Total {} names, {} matched'.format(
+            len(candidates), len(matched)))
+
+    def find_vpath_crack(self):
+        # guess names for the hashes still unresolved from patterns in the strings known so far
+        targets = self.nodes_select_distinct_vhash_unnamed()
+        self.logger.log('STRINGS BY CRACKING: {} unresolved hashes'.format(len(targets)))
+        if not targets:
+            return
+
+        known = self.hash_string_select_distinct_string()
+        rules = crack_rules_mine(known)
+
+        hits = hash_crack(rules, targets, self.game_info.file_hash_size, self.crack_budget, logger=self.logger, memo=self.crack_memo)
+
+        known = set(known)
+        hits = [(name, s) for name, s in hits if s not in known]
+        n_found = len(hits)
+
+        proposals = [(s, None) for name, s in hits]
+        if self.game_info.file_hash_size == 4:
+            # with 4 byte hashes most hits are chance collisions. a hit is only kept when its extension has been seen
+            #  on named nodes of a file type some node with that hash has, and it is the only such hit for the hash.
+            #  it is proposed for those file types only so it can not name a node of another type
+            ext_types = self.nodes_select_ext_hash_file_types()
+            node_types = self.nodes_select_unnamed_vhash_file_types()
+            confirmed = {}
+            for name, s in hits:
+                h = self.file_hash(s)
+                types = ext_types.get(self.ext_hash(os.path.splitext(to_bytes(s))[1]), set()) & node_types.get(h, set())
+                if types:
+                    confirmed.setdefault(h, []).append((s, sorted(types)))
+            proposals = [v[0] for v in confirmed.values() if len(v) == 1]
 
-            level = level + 1
+        with DbWrap(self, logger=self) as db:
+            for s, possible_file_types in proposals:
+                db.propose_string(s, None, possible_file_types=possible_file_types)
 
-            with DbWrap(self, logger=self) as db:
-                for child_node in child_nodes:
-                    if child_node.used_at_runtime_depth is None or child_node.used_at_runtime_depth > level:
-                        keep_going = True
-                        child_node.used_at_runtime_depth = level
-                        db.node_update(child_node)
+        self.logger.log('STRINGS BY CRACKING: Found {} new strings, {} proposed'.format(n_found, len(proposals)))
+
+    def update_used_depths(self):
+        self.logger.log('UPDATING USE DEPTH: Begin')
+        t0 = time.time()
+        n_changed, depth_max = self.nodes_update_used_depths()
+        self.logger.log('UPDATING USE DEPTH: End: {} nodes changed, max depth {}, {:0.1f} seconds'.format(
+            n_changed, depth_max, time.time() - t0))
 
     def process_remove_temporary_nodes(self):
         uids = self.nodes_where_temporary_select_uid(True)
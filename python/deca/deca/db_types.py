@@ -1,7 +1,11 @@
-import sqlite3
+import os
 import re
+import time
+import random
+import sqlite3
+import contextlib
 from deca.util import make_dir_for_file, DecaSignal
-from deca.hashes import hash32_func, hash_all_func
+from deca.hashes import hash32_func, hash_all_func, hash_all_many
 
 
 node_flag_compression_type_mask = 0xFF
@@ -48,6 +52,17 @@ def make_hash_string_tuple(string):
     return string, hash32, hash48, hash64, ext_hash32
 
 
+def make_hash_string_tuples(strings):
+    # make_hash_string_tuple for many strings with one call into the batched hash kernels
+    strings = [to_bytes(s) for s in strings]
+    if len(strings) == 0:
+        return []
+
+    hash32, hash48, hash64, ext_hash32 = hash_all_many(strings)
+
+    return list(zip(strings, hash32.tolist(), hash48.tolist(), hash64.tolist(), ext_hash32.tolist()))
+
+
 def regexp(expr, item):
     if item is None or expr is None:
         return False
@@ -59,41 +74,156 @@ def regexp(expr, item):
     return reg.search(item) is not None
 
 
+# storage profiles, pragmas applied to every connection. 'compat' is the original plain connection, 'bulk' is tuned for
+#  many processes ingesting at once. the profile can be chosen per process tree with DECA_DB_STORAGE_PROFILE
+db_storage_profiles = {
+    'compat': {
+        'busy_timeout': 5.0,
+        # journal_mode is kept in the db file, a db once opened with bulk would otherwise stay in WAL
+        'pragmas': [
+            ('journal_mode', 'DELETE'),
+        ],
+    },
+    'bulk': {
+        'busy_timeout': 1.0,
+        'pragmas': [
+            ('journal_mode', 'WAL'),
+            ('synchronous', 'NORMAL'),
+            ('cache_size', -256 * 1024),  # KiB
+            ('mmap_size', 1024 ** 3),
+            ('temp_store', 'MEMORY'),
+        ],
+    },
+}
+
+db_storage_profile_default = 'bulk'
+
+db_contention_stat_names = ['waits', 'wait_time', 'wait_time_max', 'ops_contended', 'transactions']
+
+
 class DbBase:
-    def __init__(self, db_filename, logger):
+    def __init__(self, db_filename, logger, storage_profile=None, backoff_base=0.005, backoff_max=1.0):
         self.logger = logger
 
         self.db_changed_signal = DecaSignal()
 
+        if storage_profile is None:
+            storage_profile = os.environ.get('DECA_DB_STORAGE_PROFILE', db_storage_profile_default)
+        self.storage_profile = storage_profile
+        profile = db_storage_profiles[storage_profile]
+
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.db_contention = dict([(k, 0) for k in db_contention_stat_names])
+        self._transaction_depth = 0
+
         # setup data base
         self.db_filename = db_filename
         make_dir_for_file(self.db_filename)
 
-        self.db_conn = sqlite3.connect(self.db_filename)
+        self.db_conn = sqlite3.connect(self.db_filename, timeout=profile['busy_timeout'])
         # self.db_conn.text_factory = bytes
         self.db_conn.create_function("REGEXP", 2, regexp)
         self.db_cur = self.db_conn.cursor()
 
+        for name, value in profile['pragmas']:
+            self.db_execute_one(f'PRAGMA {name}={value};', dbg=f'db_setup:pragma:{name}')
+
     def logger_set(self, logger):
         self.logger = logger
 
-    def handle_exception(self, dbg, exc: sqlite3.OperationalError):
-        if len(exc.args) == 1 and exc.args[0] == 'database is locked':
-            self.logger.log(f'{dbg}: Waiting on database...')
+    def handle_exception(self, dbg, exc: sqlite3.OperationalError, attempt=0):
+        if len(exc.args) == 1 and exc.args[0] in {'database is locked', 'database is busy'}:
+            # exponential backoff with jitter, so waiting writers do not retry in lock step
+            wait_time = min(self.backoff_max, self.backoff_base * (2 ** attempt)) * random.uniform(0.5, 1.0)
+            if attempt == 0:
+                self.db_contention['ops_contended'] += 1
+            if attempt == 4:
+                self.logger.log(f'{dbg}: Waiting on database...')
+            self.db_contention['waits'] += 1
+            self.db_contention['wait_time'] += wait_time
+            self.db_contention['wait_time_max'] = max(self.db_contention['wait_time_max'], wait_time)
+            time.sleep(wait_time)
         else:
             print(dbg, exc, exc.args)
             raise
 
+    def db_contention_str(self):
+        c = self.db_contention
+        return 'DATABASE: {}: profile: {}, transactions: {}, contended ops: {}, waits: {}, wait time: {:0.3f}s (max {:0.3f}s)'.format(
+            os.path.basename(self.db_filename), self.storage_profile, c['transactions'], c['ops_contended'], c['waits'],
+            c['wait_time'], c['wait_time_max'])
+
+    def db_commit(self):
+        # inside db_transaction the commit is deferred to the end of the outermost transaction
+        if self._transaction_depth == 0:
+            self.db_conn.commit()
+
+    @contextlib.contextmanager
+    def db_transaction(self, dbg='db_transaction'):
+        if self._transaction_depth == 0:
+            # take the write lock up front, a deferred transaction that upgrades later can fail without waiting
+            self.db_conn.commit()
+            self.db_execute_one('BEGIN IMMEDIATE', dbg=dbg)
+            self.db_contention['transactions'] += 1
+
+        self._transaction_depth += 1
+        try:
+            yield self
+        except:
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                self.db_conn.rollback()
+            raise
+
+        self._transaction_depth -= 1
+        if self._transaction_depth == 0:
+            self.db_conn.commit()
+
+    def db_strings_add_many(self, table, records, dbg='db_strings_add_many'):
+        # records are unique (string, hash32, hash48, hash64, ext_hash32), staged in a temp table so the insert and the
+        #  rowid lookup are each one statement. returns {record: rowid} and the number of newly inserted records
+        with self.db_transaction(dbg=dbg):
+            self.db_execute_one(
+                'CREATE TEMP TABLE IF NOT EXISTS "strings_stage" '
+                '("string" TEXT, "hash32" INTEGER, "hash48" INTEGER, "hash64" INTEGER, "ext_hash32" INTEGER)',
+                dbg=dbg + ':stage_create')
+            self.db_execute_one('DELETE FROM temp.strings_stage', dbg=dbg + ':stage_clear')
+            self.db_execute_many(
+                'INSERT INTO temp.strings_stage VALUES (?,?,?,?,?)', records, dbg=dbg + ':stage_insert')
+
+            changes = self.db_conn.total_changes
+            self.db_execute_one(
+                f'INSERT OR IGNORE INTO {table} SELECT * FROM temp.strings_stage', dbg=dbg + ':insert')
+            n_inserted = self.db_conn.total_changes - changes
+
+            result = self.db_query_all(
+                'SELECT s.string, s.hash32, s.hash48, s.hash64, s.ext_hash32, t.rowid '
+                f'FROM temp.strings_stage s JOIN {table} t ON '
+                't.string = s.string AND t.hash32 = s.hash32 AND t.hash48 = s.hash48 AND t.hash64 = s.hash64 AND '
+                't.ext_hash32 = s.ext_hash32',
+                dbg=dbg + ':select')
+            self.db_execute_one('DELETE FROM temp.strings_stage', dbg=dbg + ':stage_clear')
+
+        rowids = dict([(r[:5], r[5]) for r in result])
+
+        # we expect one and only one match for a hash+string
+        assert len(result) == len(records) == len(rowids)
+
+        return rowids, n_inserted
+
     def db_execute_one(self, stmt, params=None, dbg='db_execute_one'):
         if params is None:
             params = []
 
+        attempt = 0
         while True:
             try:
                 result = self.db_cur.execute(stmt, params)
                 break
             except sqlite3.OperationalError as exc:
-                self.handle_exception(dbg, exc)
+                self.handle_exception(dbg, exc, attempt)
+                attempt += 1
 
         return result
 
@@ -101,12 +231,14 @@ class DbBase:
         if params is None:
             params = []
 
+        attempt = 0
         while True:
             try:
                 result = self.db_cur.executemany(stmt, params)
                 break
             except sqlite3.OperationalError as exc:
-                self.handle_exception(dbg, exc)
+                self.handle_exception(dbg, exc, attempt)
+                attempt += 1
 
         return result
 
@@ -114,13 +246,15 @@ class DbBase:
         if params is None:
             params = []
 
+        attempt = 0
         while True:
             try:
                 result = self.db_cur.execute(stmt, params)
                 result = result.fetchone()
                 break
             except sqlite3.OperationalError as exc:
-                self.handle_exception(dbg, exc)
+                self.handle_exception(dbg, exc, attempt)
+                attempt += 1
 
         return result
 
@@ -128,12 +262,14 @@ class DbBase:
         if params is None:
             params = []
 
+        attempt = 0
         while True:
             try:
                 result = self.db_cur.execute(stmt, params)
                 result = result.fetchall()
                 break
             except sqlite3.OperationalError as exc:
-                self.handle_exception(dbg, exc)
+                self.handle_exception(dbg, exc, attempt)
+                attempt += 1
 
         return result
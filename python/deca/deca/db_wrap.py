@@ -1,4 +1,6 @@
 import os
+import numpy as np
+from array import array
 from .db_core import VfsDatabase, VfsNode, GtocArchiveEntry
 from .db_cross_game import DbCrossGame
 from .ff_adf import AdfDatabase
@@ -85,16 +87,207 @@ def determine_file_type(vfs: VfsDatabase, node: VfsNode):
         node.file_sub_type = adf_type
 
 
+class ProposeCache:
+    # per process memo of what propose_string derives from a raw string, so strings that recur across files are
+    #  checked, normalized, split and hashed once. each table is dropped whole when it reaches max_entries
+    def __init__(self, max_entries=256 * 1024):
+        self.max_entries = max_entries
+        self.splits = {}  # (raw string, fix_paths) -> (string, substrings) or None for a string that is not proposed
+        self.hashes = {}  # string -> make_hash_string_tuple(string)
+
+    def split(self, raw, fix_paths):
+        # anything else, numbers or the dicts and lists of parsed json, is not proposed (and may not be hashable)
+        if not isinstance(raw, (str, bytes)):
+            return None
+
+        key = (raw, fix_paths)
+        result = self.splits.get(key, False)
+        if result is not False:
+            return result
+
+        result = None
+        string = raw
+        if isinstance(string, str):
+            string = string.encode('ascii', 'ignore')
+        try:
+            string.decode('utf-8')
+        except UnicodeDecodeError:
+            string = None
+
+        if string is not None:
+            if fix_paths:
+                string = string.replace(b'\\\\', b'/').replace(b'\\', b'/')
+
+            # find substrings spliting on , and |
+            substrings = [string]
+            # TODO put b'/', b' ' back
+            seps = [b',', b'|']
+            for sep in seps:
+                substrings_new = []
+                for substring in substrings:
+                    substrings_new += substring.split(sep)
+                substrings = substrings_new
+
+            result = (string, [substring.strip() for substring in substrings if substring != string])
+
+        if len(self.splits) >= self.max_entries:
+            self.splits.clear()
+        self.splits[key] = result
+        return result
+
+    def hash_tuples(self, strings):
+        missing = [s for s in strings if s not in self.hashes]
+        if len(self.hashes) + len(missing) > self.max_entries:
+            self.hashes.clear()
+            missing = strings
+        for hash_string_tuple in make_hash_string_tuples(missing):
+            self.hashes[hash_string_tuple[0]] = hash_string_tuple
+        return [self.hashes[s] for s in strings]
+
+
+propose_cache = ProposeCache()
+
+
+class StringProposals:
+    # the strings proposed to one DbWrap as columns, repeated proposals are dropped on the way in
+    used_at_runtime_flags = {None: 0, False: 2, True: 4}
+
+    def __init__(self):
+        self.strings = []
+        self.string_ids = {}
+        self.string_id = array('q')
+        self.parent_uid = array('q')
+        self.flags = array('b')  # 1: is_field_name, 2: not used at runtime, 4: used at runtime
+        self.p_types = array('Q')  # possible file types bitmask, FTYPE_ANY_TYPE sets all 64 bits
+        self.seen = set()
+        self.n_proposed = 0
+
+    def __len__(self):
+        return len(self.string_id)
+
+    def add(self, string, parent_uid, is_field_name, used_at_runtime, p_types):
+        self.n_proposed += 1
+        sid = self.string_ids.get(string)
+        if sid is None:
+            sid = len(self.strings)
+            self.strings.append(string)
+            self.string_ids[string] = sid
+        parent_uid = -1 if parent_uid is None else parent_uid
+        flags = (1 if is_field_name else 0) | self.used_at_runtime_flags[used_at_runtime]
+
+        key = (sid, parent_uid, flags, p_types)
+        if key in self.seen:
+            return
+        self.seen.add(key)
+        self.string_id.append(sid)
+        self.parent_uid.append(parent_uid)
+        self.flags.append(flags)
+        self.p_types.append(p_types)
+
+    def records(self, cache):
+        # (string, hash32, hash48, hash64, ext_hash32, parent_uid, is_field_name, used_at_runtime, p_types)
+        hash_string_tuples = cache.hash_tuples(self.strings)
+        recs = []
+        for sid, parent_uid, flags, p_types in zip(self.string_id, self.parent_uid, self.flags, self.p_types):
+            used_at_runtime = True if flags & 4 else (False if flags & 2 else None)
+            recs.append((
+                *hash_string_tuples[sid], None if parent_uid < 0 else parent_uid, bool(flags & 1), used_at_runtime,
+                p_types))
+        return recs
+
+
+class DbBatch:
+    # the writes collected by one DbWrap, plain lists that pickle cheaply so a worker process can hand them to the
+    #  single writer instead of writing the shared database itself
+    def __init__(
+            self, nodes_to_add=None, nodes_to_update=None, string_hash_to_add=None, gtoc_archive_defs=None,
+            objects=None, object_id_refs=None, event_id_refs=None, strings_proposed=0, fingerprints=None):
+        self.nodes_to_add = nodes_to_add or []
+        self.nodes_to_update = nodes_to_update or []
+        self.string_hash_to_add = string_hash_to_add or []
+        self.gtoc_archive_defs = gtoc_archive_defs or []
+        self.objects = objects or []  # uid(ROWID), src_node_id, offset, class_str(_rowid), name_str(_rowid), object_id
+        self.object_id_refs = object_id_refs or []  # object_rowid((src_node_id,offset)), id, flags
+        self.event_id_refs = event_id_refs or []  # object_rowid((src_node_id,offset)), id, flags
+        self.strings_proposed = strings_proposed  # propose_string calls, before repeats were dropped
+        self.fingerprints = fingerprints or []  # node_id, fingerprint
+
+    def size(self):
+        return \
+            len(self.nodes_to_add) + len(self.nodes_to_update) + len(self.string_hash_to_add) + \
+            len(self.gtoc_archive_defs) + len(self.objects) + len(self.object_id_refs) + len(self.event_id_refs) + \
+            len(self.fingerprints)
+
+    def extend(self, other):
+        # object uids are indexes into the batch's own object list, shift the other batch's past ours
+        obj_offset = len(self.objects)
+        self.nodes_to_add += other.nodes_to_add
+        self.nodes_to_update += other.nodes_to_update
+        self.string_hash_to_add += other.string_hash_to_add
+        self.strings_proposed += other.strings_proposed
+        self.fingerprints += other.fingerprints
+        self.gtoc_archive_defs += other.gtoc_archive_defs
+        self.objects += [[obj[0] + obj_offset] + list(obj[1:]) for obj in other.objects]
+        self.object_id_refs += [[ref[0] + obj_offset] + list(ref[1:]) for ref in other.object_id_refs]
+        self.event_id_refs += [[ref[0] + obj_offset] + list(ref[1:]) for ref in other.event_id_refs]
+
+    def apply(self, db: VfsDatabase, logger=None):
+        def log(msg):
+            if logger is not None:
+                logger.log(msg)
+
+        if len(self.nodes_to_add) > 0:
+            log('DATABASE: Inserting {} nodes'.format(len(self.nodes_to_add)))
+            db.nodes_add_many(self.nodes_to_add)
+
+        if len(self.nodes_to_update) > 0:
+            log('DATABASE: Updating {} nodes'.format(len(self.nodes_to_update)))
+            db.node_update_many(self.nodes_to_update)
+
+        if len(self.fingerprints) > 0:
+            log('DATABASE: Inserting {} content fingerprints'.format(len(self.fingerprints)))
+            db.node_fingerprints_add_many(self.fingerprints)
+
+        hash_strings_to_add = list(set(self.string_hash_to_add))
+        if len(hash_strings_to_add) > 0:
+            log('DATABASE: Inserting {} hash strings, {} proposed'.format(
+                len(hash_strings_to_add), self.strings_proposed))
+            db.hash_string_add_many(hash_strings_to_add)
+
+        hash_field_strings_to_add = [hs for hs in hash_strings_to_add if hs[-3]]
+        if len(hash_field_strings_to_add) > 0:
+            log('DATABASE: Inserting {} hash field strings'.format(len(hash_field_strings_to_add)))
+            db.db_cg.hash_string_add_many(hash_field_strings_to_add)
+
+        if len(self.gtoc_archive_defs) > 0:
+            log('DATABASE: Inserting {} gt0c archive definitions'.format(len(self.gtoc_archive_defs)))
+            db.gtoc_archive_add_many(self.gtoc_archive_defs)
+
+        if len(self.objects) > 0:
+            log('DATABASE: Inserting {} objects'.format(len(self.objects)))
+            obj_rowids = db.object_info_add_many(self.objects)
+
+            if len(self.object_id_refs) > 0:
+                log('DATABASE: Inserting {} object id ref'.format(len(self.object_id_refs)))
+                db.object_id_refs_add_many(self.object_id_refs, obj_rowids)
+
+            if len(self.event_id_refs) > 0:
+                log('DATABASE: Inserting {} event id refs'.format(len(self.event_id_refs)))
+                db.event_id_refs_add_many(self.event_id_refs, obj_rowids)
+
+
 class DbWrap:
-    def __init__(self, db: VfsDatabase, logger=None, index_offset=0):
+    def __init__(self, db: VfsDatabase, logger=None, index_offset=0, batch_sink=None):
         self._db = db
         self._adf_db = AdfDatabase()
         self._logger = logger
         self._index_offset = index_offset
+        self._batch_sink = batch_sink
         self._drop_results = False
         self._nodes_to_add = []
         self._nodes_to_update = set()
-        self._string_hash_to_add = []
+        self._proposals = StringProposals()
+        self._fingerprints = []
         self._gtoc_archive_defs = []
         self._objects = []  # uid(ROWID), src_node_id, offset, class_str(_rowid), name_str(_rowid), object_id
         self._object_id_refs = []  # object_rowid((src_node_id,offset)), id, flags
@@ -104,6 +297,7 @@ class DbWrap:
 
         self.file_hash_type = self._db.file_hash_type
         self.file_hash = self._db.file_hash
+        self.file_hash_many = self._db.file_hash_many
 
     def db(self) -> VfsDatabase:
         return self._db
@@ -130,52 +324,31 @@ class DbWrap:
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if exc_type is None and not self._drop_results:
-            n_nodes_to_add = len(self._nodes_to_add)
-            if n_nodes_to_add > 0:
-                # self.log('Determining file types: {} nodes'.format(len(self._nodes_to_add)))
-                # for ii, node in enumerate(self._nodes_to_add):
-                #     self.status(ii + self._index_offset, n_nodes_to_add + self._index_offset)
-                #     determine_file_type_by_name(self._db, node)
-                #     determine_file_type(self._db, node)
-
-                # self.status(n_nodes_to_add + self._index_offset, n_nodes_to_add + self._index_offset)
-
-                self.log('DATABASE: Inserting {} nodes'.format(len(self._nodes_to_add)))
-                self._db.nodes_add_many(self._nodes_to_add)
-
-            if len(self._nodes_to_update) > 0:
-                self.log('DATABASE: Updating {} nodes'.format(len(self._nodes_to_update)))
-                self._db.node_update_many(self._nodes_to_update)
-
-            hash_strings_to_add = list(set(self._string_hash_to_add))
-            if len(hash_strings_to_add) > 0:
-                self.log('DATABASE: Inserting {} hash strings'.format(len(hash_strings_to_add)))
-                self._db.hash_string_add_many(hash_strings_to_add)
-
-            hash_field_strings_to_add = [hs for hs in hash_strings_to_add if hs[-3]]
-            if len(hash_field_strings_to_add) > 0:
-                self.log('DATABASE: Inserting {} hash field strings'.format(len(hash_field_strings_to_add)))
-                self._db.db_cg.hash_string_add_many(hash_field_strings_to_add)
-
-            if len(self._gtoc_archive_defs) > 0:
-                self.log('DATABASE: Inserting {} gt0c archive definitions'.format(len(self._gtoc_archive_defs)))
-                self._db.gtoc_archive_add_many(self._gtoc_archive_defs)
-
-            if self._adf_db.has_type_map_changed():
-                self.log('DATABASE: Saving ADF Types: {} Types'.format(len(self._adf_db.type_map_def)))
-                self._adf_db.save_to_database(self._db)
-
-            if len(self._objects) > 0:
-                self.log('DATABASE: Inserting {} objects'.format(len(self._objects)))
-                obj_rowids = self._db.object_info_add_many(self._objects)
-
-                if len(self._object_id_refs) > 0:
-                    self.log('DATABASE: Inserting {} object id ref'.format(len(self._object_id_refs)))
-                    self._db.object_id_refs_add_many(self._object_id_refs, obj_rowids)
-
-                if len(self._event_id_refs) > 0:
-                    self.log('DATABASE: Inserting {} event id refs'.format(len(self._event_id_refs)))
-                    self._db.event_id_refs_add_many(self._event_id_refs, obj_rowids)
+            if self._batch_sink is None:
+                with self._db.db_transaction(dbg='DbWrap:flush'):
+                    self.flush()
+            else:
+                # adf types are rare and later commands in this process read them back, so they are still saved here
+                self.adf_types_flush()
+                batch = self.batch_make()
+                if batch.size() > 0:
+                    self._batch_sink(batch)
+
+    def batch_make(self):
+        # proposed strings are hashed here all at once
+        return DbBatch(
+            self._nodes_to_add, list(self._nodes_to_update), self._proposals.records(propose_cache),
+            self._gtoc_archive_defs, self._objects, self._object_id_refs, self._event_id_refs,
+            strings_proposed=self._proposals.n_proposed, fingerprints=self._fingerprints)
+
+    def adf_types_flush(self):
+        if self._adf_db.has_type_map_changed():
+            self.log('DATABASE: Saving ADF Types: {} Types'.format(len(self._adf_db.type_map_def)))
+            self._adf_db.save_to_database(self._db)
+
+    def flush(self):
+        self.batch_make().apply(self._db, self)
+        self.adf_types_flush()
 
     def node_add(self, node):
         self._nodes_to_add.append(node)
@@ -183,32 +356,22 @@ class DbWrap:
     def node_update(self, node):
         self._nodes_to_update.add(node)
 
+    def node_fingerprint_set(self, node, fingerprint):
+        self._fingerprints.append((node.uid, fingerprint))
+
     def propose_string(
             self, string, parent_node=None, is_field_name=False, possible_file_types=None,
             used_at_runtime=None, fix_paths=True):
-        p_types = 0
-
-        if isinstance(string, str):
-            string = string.encode('ascii', 'ignore')
-        elif isinstance(string, bytes):
-            try:
-                string.decode('utf-8')
-            except UnicodeDecodeError:
-                # if logger is not None:
-                #     logger.log('propose: BAD STRING NOT UTF-8 {}'.format(string))
-                return None
-        else:
-            # if logger is not None:
-            #     logger.log('propose: BAD STRING {}'.format(string))
+        split = propose_cache.split(string, fix_paths)
+        if split is None:
             return None
-
-        if fix_paths:
-            string = string.replace(b'\\\\', b'/').replace(b'\\', b'/')
+        string, substrings = split
 
         parent_uid = None
         if parent_node is not None:
             parent_uid = parent_node.uid
 
+        p_types = 0
         if possible_file_types is None:
             pass
         elif isinstance(possible_file_types, list):
@@ -217,28 +380,37 @@ class DbWrap:
         else:
             p_types = p_types | ftype_list[possible_file_types]
 
-        hash_string_tuple = make_hash_string_tuple(string)
-
-        rec = (*hash_string_tuple, parent_uid, is_field_name, used_at_runtime, p_types)
+        self._proposals.add(string, parent_uid, is_field_name, used_at_runtime, p_types)
 
-        self._string_hash_to_add.append(rec)
-
-        # find substrings spliting on , and |
-        substrings = [string]
-        # TODO put b'/', b' ' back
-        seps = [b',', b'|']
-        for sep in seps:
-            substrings_new = []
-            for substring in substrings:
-                substrings_new += substring.split(sep)
-            substrings = substrings_new
-
-        is_field_name = False  # for substrings to be possible field names
+        # substrings can not be field names
         for substring in substrings:
-            if substring != string:
-                self.propose_string(substring.strip(), parent_node, is_field_name, possible_file_types, used_at_runtime, fix_paths)
-
-        return rec
+            self._proposals.add(substring, parent_uid, False, used_at_runtime, p_types)
+
+        return string
+
+    def propose_candidates(
+            self, candidates, hashes_present, parent_node=None, hashes=None, unmatched=None, used_at_runtime=None):
+        # candidates is {name: possible file types}, the names are file hashed in one batch and only those whose hash
+        #  is in hashes_present are proposed. names that did not match go to unmatched with their possible file types
+        #  when it is given. hashes can carry the file hashes of the names when they are already known. returns the
+        #  proposed names in order
+        names = list(candidates.keys())
+        if len(names) == 0:
+            return []
+        if hashes is None:
+            hashes = self.file_hash_many(names)
+        is_present = np.isin(hashes, np.asarray(hashes_present, dtype=np.int64))
+
+        matched = []
+        for name, present in zip(names, is_present):
+            if present:
+                self.propose_string(
+                    name, parent_node, possible_file_types=candidates[name], used_at_runtime=used_at_runtime)
+                matched.append(name)
+            elif unmatched is not None:
+                unmatched.append((to_bytes(name), candidates[name]))
+
+        return matched
 
     def gtoc_archive_add(self, archive):
         if isinstance(archive, GtocArchiveEntry):
@@ -1,6 +1,7 @@
 import struct
 import numpy as np
 from deca.db_processor import VfsProcessor
+from deca.file import ArchiveFile
 
 
 class Obc:
@@ -21,7 +22,7 @@ class Obc:
         header = struct.unpack('II', header)
 
         size = 80 * header[1]
-        data = file.read(size)
+        data = ArchiveFile(file).read_view(size)
 
         dtype = np.dtype('20f4')
         self.table = np.frombuffer(data, dtype=dtype)
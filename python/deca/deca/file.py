@@ -1,4 +1,8 @@
+import os
 import struct
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
 from deca.errors import EDecaOutOfData
 
 
@@ -34,6 +38,9 @@ class SubsetFile:
             epos = min(epos, self.epos)
         return self.f.read(epos - bpos)
 
+    def read_view(self, n=None):
+        return memoryview(self.read(n))
+
     def write(self, blk):
         bpos = self.f.tell()
         epos = bpos + len(blk)
@@ -42,6 +49,296 @@ class SubsetFile:
         return self.f.write(blk)
 
 
+class MmapFile:
+    # read only view into a shared memory mapped file, read_view() returns memoryview slices without copying
+    def __init__(self, buffer, offset=0, size=None):
+        self.buffer = memoryview(buffer)
+        self.bpos = offset
+        if size is None:
+            self.epos = len(self.buffer)
+        else:
+            self.epos = min(offset + size, len(self.buffer))
+        self.pos = self.bpos
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, value, traceback):
+        pass
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos = self.tell() + pos
+        elif whence == 2:
+            pos = self.epos - self.bpos + pos
+        npos = self.bpos + pos
+        if npos < self.bpos or npos > self.epos:
+            raise Exception('Seek Beyond End Of File')
+        self.pos = npos
+        return pos
+
+    def tell(self):
+        return self.pos - self.bpos
+
+    def read_view(self, n=None):
+        if n is None or n < 0:
+            epos = self.epos
+        else:
+            epos = min(self.pos + n, self.epos)
+        view = self.buffer[self.pos:epos]
+        self.pos = epos
+        return view
+
+    def read(self, n=None):
+        return self.read_view(n).tobytes()
+
+    def view(self):
+        return self.buffer[self.bpos:self.epos]
+
+    def subset(self, offset, size):
+        return MmapFile(self.buffer, self.bpos + offset, size)
+
+    def write(self, blk):
+        raise Exception('Write Not Supported On Mapped File')
+
+
+class FileHandlePool:
+    # per process pool of read only file handles keyed by path, at most max_open handles that are not in use are kept.
+    #  reads are positional (os.pread where available) so readers on different threads never share a file position
+    def __init__(self, max_open=64):
+        self.max_open = max_open
+        self.lock = threading.Lock()
+        self.handles = OrderedDict()  # path -> [file, refs, lock]
+        self.opens = 0
+        self.reuses = 0
+
+    def acquire(self, path):
+        with self.lock:
+            h = self.handles.get(path, None)
+            if h is None:
+                h = [open(path, 'rb'), 1, threading.Lock()]
+                self.handles[path] = h
+                self.opens += 1
+                self.evict()
+            else:
+                self.handles.move_to_end(path)
+                self.reuses += 1
+                h[1] += 1
+            return h
+
+    def release(self, h):
+        with self.lock:
+            h[1] -= 1
+            if h[1] == 0:
+                self.evict()
+
+    def evict(self):
+        # only handles no reader holds can be closed, the pool may go over max_open until they are released
+        over = len(self.handles) - self.max_open
+        for path in list(self.handles.keys()):
+            if over <= 0:
+                break
+            h = self.handles[path]
+            if h[1] == 0:
+                del self.handles[path]
+                h[0].close()
+                over -= 1
+
+    def pread(self, path, pos, n):
+        h = self.acquire(path)
+        try:
+            if hasattr(os, 'pread'):
+                return os.pread(h[0].fileno(), n, pos)
+            with h[2]:
+                h[0].seek(pos)
+                return h[0].read(n)
+        finally:
+            self.release(h)
+
+    def size(self, path):
+        h = self.acquire(path)
+        try:
+            return os.fstat(h[0].fileno()).st_size
+        finally:
+            self.release(h)
+
+    def close_all(self):
+        with self.lock:
+            for path in list(self.handles.keys()):
+                h = self.handles[path]
+                if h[1] == 0:
+                    del self.handles[path]
+                    h[0].close()
+
+
+class PooledFile:
+    # read only file object over a FileHandlePool handle with its own position, closing it leaves the handle pooled
+    def __init__(self, pool: FileHandlePool, path, offset=0, size=None):
+        self.pool = pool
+        self.path = path
+        self.bpos = offset
+        if size is None:
+            self.epos = pool.size(path)
+        else:
+            self.epos = offset + size
+        self.pos = self.bpos
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, value, traceback):
+        pass
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos = self.tell() + pos
+        elif whence == 2:
+            pos = self.epos - self.bpos + pos
+        npos = self.bpos + pos
+        if npos < self.bpos or npos > self.epos:
+            raise Exception('Seek Beyond End Of File')
+        self.pos = npos
+        return pos
+
+    def tell(self):
+        return self.pos - self.bpos
+
+    def read(self, n=None):
+        if n is None or n < 0:
+            n = self.epos - self.pos
+        else:
+            n = min(n, self.epos - self.pos)
+        if n <= 0:
+            return b''
+        buffer = self.pool.pread(self.path, self.pos, n)
+        self.pos += len(buffer)
+        return buffer
+
+    def read_view(self, n=None):
+        return memoryview(self.read(n))
+
+    def subset(self, offset, size):
+        return PooledFile(self.pool, self.path, self.bpos + offset, size)
+
+    def write(self, blk):
+        raise Exception('Write Not Supported On Pooled File')
+
+
+def block_fit(buffer, uncompressed_len):
+    # a block that failed to decompress is used as stored, cut or zero padded to its uncompressed size so the block
+    #  layout stays fixed
+    if len(buffer) != uncompressed_len:
+        buffer = bytes(buffer[:uncompressed_len]).ljust(uncompressed_len, b'\00')
+    return buffer
+
+
+class BlockFile:
+    # read only view of a file stored as independently compressed blocks, blocks are only decompressed when a read
+    #  touches them and a small LRU of decompressed blocks is kept
+    def __init__(self, f, blocks, decompress, max_cached_blocks=8, executor=None):
+        self.f = f
+        self.f0 = f
+        self.blocks = blocks  # [(block_offset, compressed_len, uncompressed_len), ...]
+        self.decompress = decompress  # decompress(block_index, in_buffer, compressed_len, uncompressed_len)
+        self.max_cached_blocks = max(1, max_cached_blocks)
+        self.executor = executor  # when set, reads spanning several blocks decompress them concurrently
+        self.cache = OrderedDict()
+
+        self.block_starts = []
+        pos = 0
+        for _, _, uncompressed_len in blocks:
+            self.block_starts.append(pos)
+            pos += uncompressed_len
+        self.size = pos
+        self.pos = 0
+
+    def __enter__(self):
+        self.f = self.f0.__enter__()
+        return self
+
+    def __exit__(self, t, value, traceback):
+        self.cache.clear()
+        self.f0.__exit__(t, value, traceback)
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos = self.pos + pos
+        elif whence == 2:
+            pos = self.size + pos
+        if pos < 0 or pos > self.size:
+            raise Exception('Seek Beyond End Of File')
+        self.pos = pos
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def block_decompress(self, bi, in_buffer):
+        _, compressed_len, uncompressed_len = self.blocks[bi]
+        buffer = self.decompress(bi, in_buffer, compressed_len, uncompressed_len)
+
+        # keep the block layout fixed so random access stays valid even if a block failed to decompress
+        return block_fit(buffer, uncompressed_len)
+
+    def block_read(self, bi):
+        block_offset, compressed_len, _ = self.blocks[bi]
+        self.f.seek(block_offset)
+        return self.f.read(compressed_len)
+
+    def block_cache_add(self, bi, buffer):
+        self.cache[bi] = buffer
+        while len(self.cache) > self.max_cached_blocks:
+            self.cache.popitem(last=False)
+
+    def block_get(self, bi):
+        buffer = self.cache.get(bi, None)
+        if buffer is not None:
+            self.cache.move_to_end(bi)
+            return buffer
+
+        buffer = self.block_decompress(bi, self.block_read(bi))
+        self.block_cache_add(bi, buffer)
+
+        return buffer
+
+    def read(self, n=None):
+        if n is None or n < 0:
+            epos = self.size
+        else:
+            epos = min(self.pos + n, self.size)
+
+        decoded = {}
+        if self.executor is not None and epos > self.pos:
+            bi0 = bisect_right(self.block_starts, self.pos) - 1
+            bi1 = bisect_right(self.block_starts, epos - 1) - 1
+            missing = [bi for bi in range(bi0, bi1 + 1) if bi not in self.cache]
+            if len(missing) > 1:
+                # file reads stay on this thread, only the decompression is spread over the pool
+                in_buffers = [self.block_read(bi) for bi in missing]
+                decoded = dict(zip(missing, self.executor.map(self.block_decompress, missing, in_buffers)))
+
+        parts = []
+        while self.pos < epos:
+            bi = bisect_right(self.block_starts, self.pos) - 1
+            buffer = decoded.get(bi, None)
+            if buffer is None:
+                buffer = self.block_get(bi)
+            bpos = self.pos - self.block_starts[bi]
+            blen = min(epos - self.pos, len(buffer) - bpos)
+            parts.append(memoryview(buffer)[bpos:bpos + blen])
+            self.pos += blen
+
+        for bi, buffer in list(decoded.items())[-self.max_cached_blocks:]:
+            self.block_cache_add(bi, buffer)
+
+        if len(parts) == 1:
+            return parts[0].tobytes()
+        return b''.join(parts)
+
+    def write(self, blk):
+        raise Exception('Write Not Supported On Block File')
+
+
 class ArchiveFile:
     def __init__(self, f, debug=False, endian=None):
         self.f0 = f
@@ -64,6 +361,11 @@ class ArchiveFile:
     def read(self, n=None):
         return self.f.read(n)
 
+    def read_view(self, n=None):
+        if hasattr(self.f, 'read_view'):
+            return self.f.read_view(n)
+        return memoryview(self.f.read(n))
+
     def write(self, blk):
         return self.f.write(blk)
 
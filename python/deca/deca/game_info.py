@@ -23,6 +23,13 @@ class GameInfo:
         self.oo_decompress_dll = None
         self.area_prefixes = ['']
 
+        # optional project settings for the decompression cache
+        self.cache_dir = None
+        self.cache_max_size = None
+
+        # optional project setting, process nodes in the order they sit in their files. off unless set
+        self.locality_order = False
+
         self.world_patches = [
             'terrain/hp/patches/',
             'terrain/jc3/patches/'
@@ -61,6 +68,15 @@ class GameInfo:
             'archive_paths': self.archive_paths(),
         }
 
+        if self.cache_dir is not None:
+            settings['cache_dir'] = self.cache_dir
+
+        if self.cache_max_size is not None:
+            settings['cache_max_size'] = self.cache_max_size
+
+        if self.locality_order:
+            settings['locality_order'] = self.locality_order
+
         with open(filename, 'w') as f:
             json.dump(settings, f, indent=2)
 
@@ -703,6 +719,9 @@ def game_info_load(project_file):
 
     game_info = determine_game_info(game_dir, exe_name, game_id=game_id)
     if game_info is not None:
+        game_info.cache_dir = settings.get('cache_dir', None)
+        game_info.cache_max_size = settings.get('cache_max_size', None)
+        game_info.locality_order = settings.get('locality_order', False)
         return game_info
 
     raise NotImplementedError()
@@ -0,0 +1,231 @@
+import re
+import time
+import numpy as np
+from collections import Counter
+from numba import njit, prange
+from deca.hashes import hashlittle2, murmur3_x64_128, hash_strings_pack, parallel_kernel_lock
+
+
+@njit(parallel=True, cache=True)
+def crack_kernel(parts_buffer, parts_offsets, slot_start, slot_size, start, count, targets, hash_size, max_len):
+    # candidate i is the concatenation of one part from every slot, the last slot varying fastest. flags the candidates
+    #  in [start, start + count) whose hash is in the sorted targets
+    block_size = 4096
+    n_slots = len(slot_size)
+    n_blocks = (count + block_size - 1) // block_size
+    hits = np.zeros(count, dtype=np.uint8)
+    for bi in prange(n_blocks):
+        scratch = np.empty(max_len, dtype=np.uint8)
+        digits = np.empty(n_slots, dtype=np.int64)
+        for k in range(bi * block_size, min(count, (bi + 1) * block_size)):
+            rem = start + k
+            for s in range(n_slots - 1, -1, -1):
+                digits[s] = rem % slot_size[s]
+                rem //= slot_size[s]
+
+            length = 0
+            for s in range(n_slots):
+                p = slot_start[s] + digits[s]
+                for b in range(parts_offsets[p], parts_offsets[p + 1]):
+                    scratch[length] = parts_buffer[b]
+                    length += 1
+
+            if hash_size == 4:
+                c, _ = hashlittle2(scratch[:length], 0, 0)
+                h = np.int64(c)
+            else:
+                h1, _ = murmur3_x64_128(scratch[:length], 0)
+                h = np.int64(h1)
+
+            pos = np.searchsorted(targets, h)
+            if pos < len(targets) and targets[pos] == h:
+                hits[k] = 1
+    return hits
+
+
+def box_size(counts):
+    size = 1
+    for count in counts:
+        size *= count
+    return size
+
+
+class CrackMemo:
+    # what earlier hash_crack calls hashed: per rule name the slots it covered. a candidate hashed before can only
+    #  hit a target that is new since, so the memo is dropped whenever new targets show up
+    def __init__(self):
+        self.targets = np.zeros(0, dtype=np.int64)
+        self.tried = {}
+
+    def begin(self, targets):
+        if not np.all(np.isin(targets, self.targets)):
+            self.targets = targets
+            self.tried = {}
+
+
+class CrackRule:
+    # candidate space is the product of the slots, each slot a list of byte strings in priority order
+    def __init__(self, name, slots):
+        self.name = name
+        self.slots = [list(slot) for slot in slots]
+
+    def size(self):
+        size = 1
+        for slot in self.slots:
+            size *= len(slot)
+        return size
+
+    def arrange(self, tried):
+        # move the parts of every slot that an earlier call already hashed to the front, returns how many per slot.
+        #  the candidates of those front parts form a box that needs no hashing again
+        if tried is None or len(tried) != len(self.slots):
+            return [0] * len(self.slots)
+        counts = []
+        for i, slot in enumerate(self.slots):
+            done = set(tried[i])
+            front = [part for part in slot if part in done]
+            self.slots[i] = front + [part for part in slot if part not in done]
+            counts.append(len(front))
+        return counts
+
+    def trim(self, budget, counts=None):
+        # drop the low priority end of the largest slot until the candidates outside the tried box fit, never
+        #  cutting into the box itself
+        counts = counts or [0] * len(self.slots)
+        while self.size() - box_size(counts) > budget:
+            slots = [i for i, slot in enumerate(self.slots) if len(slot) > max(1, counts[i])]
+            if not slots:
+                break
+            i = max(slots, key=lambda i: len(self.slots[i]))
+            slot = self.slots[i]
+            # halve it, or less when that already fits
+            fit = (budget + box_size(counts)) // (self.size() // len(slot))
+            del slot[max(1, counts[i], len(slot) // 2, fit):]
+
+    def remainder(self, counts):
+        # split the candidates outside the tried box into disjoint rules, rule s takes the new parts of slot s
+        #  with the tried parts of the slots before it and all parts of the slots after it
+        rules = []
+        for s in range(len(self.slots)):
+            slots = [slot[:counts[i]] for i, slot in enumerate(self.slots[:s])]
+            slots += [self.slots[s][counts[s]:]] + self.slots[s + 1:]
+            rule = CrackRule(self.name, slots)
+            if rule.size() > 0:
+                rules.append(rule)
+        return rules
+
+    def candidate(self, index):
+        parts = []
+        for slot in reversed(self.slots):
+            parts.append(slot[index % len(slot)])
+            index //= len(slot)
+        return b''.join(reversed(parts))
+
+
+re_crack_path = re.compile(rb'^((?:[a-z0-9_\-]+/)*)([a-z0-9_\-]*?)(\d*)((?:\.[a-z0-9_]+)+)$')
+
+
+def crack_rules_mine(strings, number_max=1024, ext_max=64, dir_max=256, basename_max=4096):
+    # split known path like strings into directory, stem, number and extension, then recombine the pieces, most
+    #  common pieces first so trimming drops the rare ones:
+    #  numbered: the numbered stems of an extension with every number in the widths seen
+    #  extensions: every known path with the common extensions
+    #  directories: the common file names in the common directories
+    dirs = Counter()
+    exts = Counter()
+    basenames = Counter()
+    paths = Counter()
+    numbered = {}
+    for s in strings:
+        mr = re_crack_path.match(s)
+        if mr is None:
+            continue
+        d, stem, num, ext = mr.groups()
+        dirs[d] += 1
+        exts[ext] += 1
+        basenames[stem + num + ext] += 1
+        paths[d + stem + num] += 1
+        if num:
+            heads, widths, num_seen = numbered.get(ext, (Counter(), set(), 0))
+            heads[d + stem] += 1
+            widths.add(len(num) if num[0:1] == b'0' and len(num) > 1 else 0)
+            numbered[ext] = (heads, widths, max(num_seen, int(num)))
+
+    rules = []
+    for ext, (heads, widths, num_seen) in sorted(numbered.items(), key=lambda item: (-exts[item[0]], item[0])):
+        num_limit = min(number_max, max(64, 2 * num_seen + 1))
+        numbers = []
+        for width in sorted(widths):
+            numbers += ['{:0{}d}'.format(i, width).encode('ascii') if width else str(i).encode('ascii')
+                        for i in range(min(num_limit, 10 ** width) if width else num_limit)]
+        rules.append(CrackRule('numbered{}'.format(ext.decode('ascii')), [[h for h, _ in heads.most_common()], numbers, [ext]]))
+
+    top_exts = [e for e, _ in exts.most_common(ext_max)]
+    rules.append(CrackRule('extensions', [[p for p, _ in paths.most_common()], top_exts]))
+
+    top_dirs = [d for d, _ in dirs.most_common(dir_max)]
+    top_basenames = [b for b, _ in basenames.most_common(basename_max)]
+    rules.append(CrackRule('directories', [top_dirs, top_basenames]))
+
+    return rules
+
+
+def hash_crack(rules, targets, hash_size, budget, logger=None, chunk_size=4 * 1024 * 1024, memo=None):
+    # returns [(rule name, string)] for every generated candidate whose file hash is in targets. with 4 byte hashes
+    #  roughly candidates * targets / 2**32 of the hits are collisions. every rule gets an even share of the budget
+    #  the rules before it left, with a memo the candidates earlier calls hashed are skipped
+    targets = np.unique(np.asarray(targets, dtype=np.int64))
+    hits = []
+    n_hashed = 0
+    n_skipped = 0
+    t0 = time.time()
+    if len(targets) == 0:
+        return hits
+
+    if memo is not None:
+        memo.begin(targets)
+
+    for ri, rule in enumerate(rules):
+        if budget - n_hashed <= 0:
+            break
+        counts = rule.arrange(memo.tried.get(rule.name) if memo is not None else None)
+        rule.trim((budget - n_hashed) // (len(rules) - ri), counts)
+        if memo is not None:
+            memo.tried[rule.name] = [list(slot) for slot in rule.slots]
+        n_skipped += box_size(counts)
+
+        parts = rule.remainder(counts)
+        size = sum(part.size() for part in parts)
+        done = 0
+        rule_hits = 0
+        for part in parts:
+            strings = [s for slot in part.slots for s in slot]
+            parts_buffer, parts_offsets = hash_strings_pack(strings)
+            slot_size = np.array([len(slot) for slot in part.slots], dtype=np.int64)
+            slot_start = np.zeros(len(slot_size), dtype=np.int64)
+            np.cumsum(slot_size[:-1], out=slot_start[1:])
+            max_len = sum(max(len(s) for s in slot) for slot in part.slots)
+
+            for start in range(0, part.size(), chunk_size):
+                count = min(chunk_size, part.size() - start)
+                with parallel_kernel_lock:
+                    flags = crack_kernel(
+                        parts_buffer, parts_offsets, slot_start, slot_size, start, count, targets, hash_size, max_len)
+                for k in np.flatnonzero(flags):
+                    hits.append((rule.name, part.candidate(start + int(k))))
+                    rule_hits += 1
+                n_hashed += count
+                done += count
+
+                if logger is not None:
+                    dt = max(time.time() - t0, 1e-6)
+                    logger.log('CRACK: {}: {}/{} candidates, {} hits, {:0.2f} Mhash/s'.format(
+                        rule.name, done, size, rule_hits, n_hashed / dt / 1e6))
+
+    if logger is not None:
+        dt = max(time.time() - t0, 1e-6)
+        collisions = n_hashed * len(targets) / 2.0 ** 32 if hash_size == 4 else 0.0
+        logger.log('CRACK: {} candidates ({} hashed before) against {} hashes in {:0.1f}s, {:0.2f} Mhash/s, {} hits (~{:0.0f} collisions)'.format(
+            n_hashed, n_skipped, len(targets), dt, n_hashed / dt / 1e6, len(hits), collisions))
+
+    return hits
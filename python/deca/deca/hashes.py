@@ -1,7 +1,17 @@
+import os
 import sys
+import threading
 import mmh3
+import numba
 import numpy as np
-from numba import njit
+from numba import njit, prange
+
+# processing forks its workers from a process that has already run the parallel kernels below, with the tbb
+#  threading layer that process then hangs on exit. workqueue is fork safe but not thread safe, so the kernels are
+#  only launched under parallel_kernel_lock
+if 'NUMBA_THREADING_LAYER' not in os.environ:
+    numba.config.THREADING_LAYER = 'workqueue'
+parallel_kernel_lock = threading.Lock()
 
 # Need to constrain U32 to only 32 bits using the & 0xffffffff
 # since Python has no native notion of integers limited to 32 bit
@@ -139,6 +149,170 @@ def hash_all_func(data):
     return c, (v >> 16) & 0x0000FFFFFFFFFFFF, int(np.int64(np.uint64(v & 0xFFFFFFFFFFFFFFFF)))
 
 
+@njit(inline=CostModel(cost_model_params))
+def rotl64(x, r):
+    return (x << np.uint64(r)) | (x >> np.uint64(64 - r))
+
+
+@njit(inline=CostModel(cost_model_params))
+def fmix64(k):
+    k ^= k >> np.uint64(33)
+    k *= np.uint64(0xff51afd7ed558ccd)
+    k ^= k >> np.uint64(33)
+    k *= np.uint64(0xc4ceb9fe1a85ec53)
+    k ^= k >> np.uint64(33)
+    return k
+
+
+@njit(inline=CostModel(cost_model_params))
+def murmur3_x64_128(data, seed=0):
+    # same as mmh3.hash128(data, seed, x64arch=True), returns the low and high 64 bits
+    length = len(data)
+    n_blocks = length // 16
+    c1 = np.uint64(0x87c37b91114253d5)
+    c2 = np.uint64(0x4cf5ad432745937f)
+    h1 = np.uint64(seed)
+    h2 = np.uint64(seed)
+
+    for bi in range(n_blocks):
+        p = bi * 16
+        k1 = np.uint64(0)
+        k2 = np.uint64(0)
+        for i in range(8):
+            k1 |= np.uint64(data[p + i]) << np.uint64(i * 8)
+            k2 |= np.uint64(data[p + 8 + i]) << np.uint64(i * 8)
+
+        k1 *= c1; k1 = rotl64(k1, 31); k1 *= c2; h1 ^= k1
+        h1 = rotl64(h1, 27); h1 += h2; h1 = h1 * np.uint64(5) + np.uint64(0x52dce729)
+        k2 *= c2; k2 = rotl64(k2, 33); k2 *= c1; h2 ^= k2
+        h2 = rotl64(h2, 31); h2 += h1; h2 = h2 * np.uint64(5) + np.uint64(0x38495ab5)
+
+    p = n_blocks * 16
+    tail = length - p
+    k1 = np.uint64(0)
+    k2 = np.uint64(0)
+    for i in range(8, tail):
+        k2 |= np.uint64(data[p + i]) << np.uint64((i - 8) * 8)
+    for i in range(min(tail, 8)):
+        k1 |= np.uint64(data[p + i]) << np.uint64(i * 8)
+    if tail > 8:
+        k2 *= c2; k2 = rotl64(k2, 33); k2 *= c1; h2 ^= k2
+    if tail > 0:
+        k1 *= c1; k1 = rotl64(k1, 31); k1 *= c2; h1 ^= k1
+
+    h1 ^= np.uint64(length); h2 ^= np.uint64(length)
+    h1 += h2; h2 += h1
+    h1 = fmix64(h1); h2 = fmix64(h2)
+    h1 += h2; h2 += h1
+
+    return h1, h2
+
+
+@njit(parallel=True, cache=True)
+def hash32_many_kernel(buffer, offsets, init_val):
+    n = len(offsets) - 1
+    hash32 = np.empty(n, dtype=np.int64)
+    for i in prange(n):
+        c, b = hashlittle2(buffer[offsets[i]:offsets[i + 1]], init_val, 0)
+        hash32[i] = c
+    return hash32
+
+
+@njit(parallel=True, cache=True)
+def hash_murmur_many_kernel(buffer, offsets):
+    n = len(offsets) - 1
+    hash48 = np.empty(n, dtype=np.int64)
+    hash64 = np.empty(n, dtype=np.int64)
+    for i in prange(n):
+        h1, h2 = murmur3_x64_128(buffer[offsets[i]:offsets[i + 1]], 0)
+        hash48[i] = np.int64((h1 >> np.uint64(16)) & np.uint64(0x0000FFFFFFFFFFFF))
+        hash64[i] = np.int64(h1)
+    return hash48, hash64
+
+
+@njit(parallel=True, cache=True)
+def hash_all_many_kernel(buffer, offsets):
+    # ext_hash32 is the hash32 of everything from the last period on, or of the empty string without one
+    n = len(offsets) - 1
+    hash32 = np.empty(n, dtype=np.int64)
+    hash48 = np.empty(n, dtype=np.int64)
+    hash64 = np.empty(n, dtype=np.int64)
+    ext_hash32 = np.empty(n, dtype=np.int64)
+    for i in prange(n):
+        data = buffer[offsets[i]:offsets[i + 1]]
+        c, b = hashlittle2(data, 0, 0)
+        hash32[i] = c
+
+        h1, h2 = murmur3_x64_128(data, 0)
+        hash48[i] = np.int64((h1 >> np.uint64(16)) & np.uint64(0x0000FFFFFFFFFFFF))
+        hash64[i] = np.int64(h1)
+
+        period_pos = len(data)
+        for j in range(len(data) - 1, -1, -1):
+            if data[j] == 0x2e:
+                period_pos = j
+                break
+        c, b = hashlittle2(data[period_pos:], 0, 0)
+        ext_hash32[i] = c
+    return hash32, hash48, hash64, ext_hash32
+
+
+def hash_strings_pack(strings):
+    # concatenate the strings into one uint8 buffer, string i is buffer[offsets[i]:offsets[i + 1]]
+    strings = [s.encode('ascii') if isinstance(s, str) else s for s in strings]
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in strings], out=offsets[1:])
+    buffer = np.frombuffer(b''.join(strings), dtype=np.uint8)
+    return buffer, offsets
+
+
+def hash_strings_unpack(data, offsets):
+    if offsets is None:
+        return hash_strings_pack(data)
+    return np.asarray(data, dtype=np.uint8), np.asarray(offsets, dtype=np.int64)
+
+
+# batched versions of the *_func hashes, take a list of str/bytes or a packed buffer with offsets from
+#  hash_strings_pack, and return int64 numpy arrays with the same values the single string functions return
+
+
+def hash32_many(data, offsets=None, init_val=0):
+    buffer, offsets = hash_strings_unpack(data, offsets)
+    with parallel_kernel_lock:
+        return hash32_many_kernel(buffer, offsets, init_val)
+
+
+def hash48_many(data, offsets=None):
+    buffer, offsets = hash_strings_unpack(data, offsets)
+    with parallel_kernel_lock:
+        return hash_murmur_many_kernel(buffer, offsets)[0]
+
+
+def hash64_many(data, offsets=None):
+    buffer, offsets = hash_strings_unpack(data, offsets)
+    with parallel_kernel_lock:
+        return hash_murmur_many_kernel(buffer, offsets)[1]
+
+
+def hash_all_many(data, offsets=None):
+    buffer, offsets = hash_strings_unpack(data, offsets)
+    with parallel_kernel_lock:
+        return hash_all_many_kernel(buffer, offsets)
+
+
+class ContentFingerprint:
+    # hashlib like 128 bit murmur3 for content fingerprints, each update is hashed on its own and the digest is the
+    #  hash of the header and the update hashes, so the same parts have to be fed in the same pieces
+    def __init__(self, header=b''):
+        self.parts = [header]
+
+    def update(self, data):
+        self.parts.append(mmh3.hash_bytes(bytes(data), 0, True))
+
+    def hexdigest(self):
+        return mmh3.hash_bytes(b''.join(self.parts), 0, True).hex()
+
+
 def main():
     data = sys.argv[1]
 